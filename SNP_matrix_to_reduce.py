@@ -4,6 +4,8 @@ from datetime import timedelta
 from pathlib import Path, PurePath
 import os
 from lib.transform import make_reduce_file
+from lib.catalog import update_catalog
+from lib.trace import PROFILERS, span, start_trace, trace_summary
 
 def main():
     parser = argparse.ArgumentParser(description="Convert reduced file to plink")
@@ -11,8 +13,18 @@ def main():
     parser.add_argument("--SNP_folder", required=True, type=Path, help="Folder that output reduced SNP files.")
     parser.add_argument("--skip_rows", type=int, default=9, help="How many rows in the matrix file before the IDs (default: 9)")
     parser.add_argument("--chunk_size", type=int, default=100000, help="How many snp will be transformed per chunk (default: 100000)")
+    parser.add_argument("--encoder", type=str, default="vectorized", choices=["vectorized", "legacy"], help="Genotype encoder, vectorized lookup table or legacy per-cell mapping (default: vectorized)")
+    parser.add_argument("--packed", action="store_true", help="Save PLINK-style 2-bit packed genotypes with a per-SNP allele table instead of one uint8 column per sample.")
+    parser.add_argument("--workers", type=int, default=1, help="How many processes encode matrix files at the same time (default: 1)")
+    parser.add_argument("--split_mb", type=int, default=0, help="Split matrix files larger than this size (MB) into parts encoded by different workers (default: 0, no split)")
+    parser.add_argument("--append", action="store_true", help="Only encode matrix files that have no reduced file yet or changed since (eg a new genotyping batch)")
+    parser.add_argument("--row_group_size", type=int, default=100000, help="Max SNPs per parquet row group of reduced files, smaller groups allow reading SNP ranges (default: 100000)")
+    parser.add_argument("--trace", type=Path, help="Append timings, peak memory and rows / bytes of every part, file and chunk to this JSON-lines file, and print a summary table at the end")
+    parser.add_argument("--profile", type=str, choices=PROFILERS, help="Profile every part and worker with cProfile or pyinstrument, saved next to the trace file (needs --trace)")
     
     args = parser.parse_args()
+    if args.profile and not args.trace:
+        parser.error("--profile needs --trace")
     matrix_folder = PurePath(args.matrix_folder)
     reduce_folder = PurePath(args.SNP_folder)
     
@@ -26,11 +38,26 @@ def main():
     # Part 2
     def matrix_to_reduce():
         if os.path.exists(matrix_folder):
-            make_reduce_file(matrix_folder, args.skip_rows, args.chunk_size, reduce_folder)
+            make_reduce_file(matrix_folder, args.skip_rows, args.chunk_size, reduce_folder, args.encoder, args.packed, args.workers, args.split_mb, args.row_group_size, args.append)
+
+    # Part 3
+    def update_reduce_catalog():
+        # Index new or changed reduced files (sample ID -> file, column)
+        print("Part 3: Update catalog of reduced files")
+        update_catalog(reduce_folder)
 
     # Main workflow
-    make_reduce_folder()
-    matrix_to_reduce()
+    if args.trace:
+        start_trace(args.trace, args.profile)
+    try:
+        make_reduce_folder()
+        with span("Part 2: matrix to reduce", profile=True):
+            matrix_to_reduce()
+        with span("Part 3: catalog", profile=True):
+            update_reduce_catalog()
+    finally:
+        if args.trace:
+            trace_summary()
 
 if __name__ == "__main__":
     try:
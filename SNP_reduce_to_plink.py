@@ -2,13 +2,244 @@ import argparse
 from timeit import default_timer as timer
 from datetime import timedelta
 from pathlib import Path, PurePath
+import importlib.util
 import subprocess
 import os
 import shutil
-from lib.filter import snp_map_filter, dataset_ID_filter, pheno_ID_filter
+from lib.filter import PATIENT_CACHE_NAME, snp_map_filter, dataset_ID_filter, pheno_ID_filters, covar_ID_filter
 from lib.select import select_reduce_by_id, selected_chr_SNP_map, select_clump_snp, select_top_list
-from lib.merge import merge_temp_file, merge_selected_SNP_by_range
-from lib.transform import make_map_file, make_ped_file, extract_raw_to_csv
+from lib.merge import merge_temp_file, merge_append_ids, write_merge_state
+from lib.snpmap import snp_map_ranges
+from lib.store import build_genotype_store, merged_file_list, GenotypeStore
+from lib.transform import make_map_file, make_ped_file, make_bed_file, extract_snp_file
+from lib.schedule import available_memory_mb, estimate_chr_memory_mb, estimate_plink_memory_mb, estimate_prune_memory_mb, estimate_plot_memory_mb, run_jobs
+from lib.assoc import run_assoc
+from lib.qc import genotype_qc, qc_snp_mask, qc_samples
+from lib.ld import ld_prune
+from lib.plot import plot_assoc
+from lib.cache import MANIFEST_NAME, StageCache, tmp_path, replace_output, replace_prefix, prefix_files
+from lib.trace import PROFILERS, span, start_trace, trace_summary
+
+def chr_files(snp_folder: PurePath, patient_data_file_prefix: str, chr: str):
+    chr_folder = PurePath(snp_folder, "chr", str(chr))
+    return {
+        "chr_snp_map_file": PurePath(chr_folder, patient_data_file_prefix + r"_chr" + str(chr) + r"_SNP_map.csv"),
+        "chr_map_file": PurePath(snp_folder, "map", patient_data_file_prefix + r"_chr" + str(chr) + r".map"),
+        "chr_ped_file": PurePath(snp_folder, "ped", patient_data_file_prefix + r"_chr" + str(chr) + r".ped"),
+        "chr_bed": PurePath(snp_folder, "bed", patient_data_file_prefix + r"_chr" + str(chr))}
+
+def chr_job(chr: str, files: dict, options: dict):
+    # Part 4-6 of one chr, runs in a worker process,
+    # options["run_chr"] / options["run_bed"] tell which of its stages are not up to date
+    snp_keep, sample_keep = None, None
+    if options["qc"] == "native":
+        # SNPs and samples failing the genotype QC are not written
+        snp_keep = qc_snp_mask(options["snp_qc_file"], chr)
+        sample_keep = qc_samples(options["sample_qc_file"])
+    if options["run_chr"]:
+        # Part 4: make selected chr filter
+        print("Part 4: Select chr: " + str(chr))
+        Path(Path(files["chr_snp_map_file"]).parent.absolute()).mkdir(parents=True, exist_ok=True)
+        selected_chr_SNP_map(chr, options["new_SNP_map_file"], tmp_path(files["chr_snp_map_file"]))
+        replace_output(tmp_path(files["chr_snp_map_file"]), files["chr_snp_map_file"])
+
+        if options["bed_writer"] == "plink":
+            # Part 5: generate map file
+            print("Part 5: Generate map file of chr: "+ str(chr))
+            Path(Path(files["chr_map_file"]).parent.absolute()).mkdir(parents=True, exist_ok=True)
+            make_map_file(files["chr_snp_map_file"], tmp_path(files["chr_map_file"]), snp_keep)
+            replace_output(tmp_path(files["chr_map_file"]), files["chr_map_file"])
+
+            # Part 5: generate dataset-based ped file (without phenotype)
+            print("Part 5: Generate ped file of chr: "+ str(chr))
+            Path(Path(files["chr_ped_file"]).parent.absolute()).mkdir(parents=True, exist_ok=True)
+            make_ped_file(options["store_folder"], chr, files["chr_snp_map_file"], options["dataseta_ID_file"], tmp_path(files["chr_ped_file"]), snp_keep, sample_keep)
+            replace_output(tmp_path(files["chr_ped_file"]), files["chr_ped_file"])
+
+    if options["run_bed"]:
+        Path(Path(files["chr_bed"]).parent.absolute()).mkdir(parents=True, exist_ok=True)
+        if options["bed_writer"] == "native":
+            # Part 6: write bed/bim/fam straight from the genotype store (without phenotype)
+            print("Part 6: Generate bed files from genotype codes, now on chr: "+ str(chr))
+            make_bed_file(options["store_folder"], chr, files["chr_snp_map_file"], options["dataseta_ID_file"], None, options["chunk_size"], tmp_path(files["chr_bed"]),
+                          snp_keep, sample_keep)
+            replace_prefix(tmp_path(files["chr_bed"]), files["chr_bed"])
+        # else Part 6 (plink --make-bed) is run by the scheduler after this job
+
+def chr_stages(chr: str, files: dict, options: dict):
+    # Stages of one chr: (name, inputs, params, outputs) of its dataset-level files and of its bed files
+    chr_inputs = [options["new_SNP_map_file"]]
+    chr_outputs = [files["chr_snp_map_file"]]
+    bed_inputs = [options["store_folder"], files["chr_snp_map_file"], options["dataseta_ID_file"]]
+    if options["bed_writer"] == "plink":
+        chr_inputs = chr_inputs + [options["store_folder"], options["dataseta_ID_file"]]
+        chr_outputs = chr_outputs + [files["chr_map_file"], files["chr_ped_file"]]
+        bed_inputs = [files["chr_map_file"], files["chr_ped_file"]]
+    params = {"bed_writer": options["bed_writer"], "chunk_size": options["chunk_size"], "qc": options["qc"]}
+    if options["qc"] == "native":
+        qc_files = [options["snp_qc_file"], options["sample_qc_file"]]
+        bed_inputs = bed_inputs + qc_files
+        if options["bed_writer"] == "plink":
+            chr_inputs = chr_inputs + qc_files
+    return (("chr " + str(chr), chr_inputs, params, chr_outputs),
+            ("bed chr " + str(chr), bed_inputs, params, prefix_files(files["chr_bed"], ["bed", "bim", "fam"])))
+
+def prune_job(chr: str, files: dict, options: dict):
+    # Part 6: LD pruning (as plink --indep-pairwise 50 5 0.2) of the bed files of one chr, runs in a worker process
+    print("Part 6: LD prune bed files of chr: " + str(chr))
+    ld_prune(files["chr_bed"], tmp_path(files["chr_bed"]), memory_mb=options["ld_memory"])
+    replace_prefix(tmp_path(files["chr_bed"]), files["chr_bed"])
+
+def parse_phenotypes(phenotype: str, type: str):
+    # --phenotype: a name, comma-delimited names (eg BMI,DM) or a file with one "name" or "name,type" per line
+    # --type: one type for all phenotypes or comma-delimited types in the same order
+    if os.path.isfile(phenotype):
+        with open(phenotype) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+        names = [line.split(",")[0].strip() for line in lines]
+        file_types = [line.split(",")[1].strip() if "," in line else None for line in lines]
+    else:
+        names = [name.strip() for name in phenotype.split(",")]
+        file_types = [None] * len(names)
+    types = [t.strip() for t in type.split(",")]
+    if len(types) == 1:
+        types = types * len(names)
+    elif len(types) != len(names):
+        raise ValueError("--type needs one type or one type per phenotype (" + str(len(names)) + " phenotypes).")
+    return [[name, file_type or t] for name, file_type, t in zip(names, file_types, types)]
+
+def phenotype_files(dataset_folder: PurePath, patient_data_file_prefix: str, phenotype: list):
+    # Outputs of one phenotype, in its own folder <dataset>/<phenotype>
+    final_folder = PurePath(dataset_folder, phenotype[0])
+    name = patient_data_file_prefix + r"_" + phenotype[0]
+    assoc_analysis = "logistic" if phenotype[1] == "category" else "linear"
+    return {
+        "final_folder": final_folder,
+        "assoc_analysis": assoc_analysis,
+        "ID_phenotype_file": PurePath(final_folder, name + r"_list.csv"),
+        "QC_name": PurePath(final_folder, name + r"_merged_QC_prune"),
+        "QC_file": PurePath(final_folder, name + r"_merged_QC_prune.assoc." + assoc_analysis),
+        "clump_name": PurePath(final_folder, name + r"_clump"),
+        "clump_file": PurePath(final_folder, name + r"_clump.clumped"),
+        "clump_log_file": PurePath(final_folder, name + r"_clump.log"),
+        "final_clump_file": PurePath(final_folder, name + r"_clump.csv"),
+        "top_snp_file": PurePath(final_folder, name + r"_Top_SNPs.csv"),
+        "manhattan_file": PurePath(final_folder, name + r"_plot_manhattan.tiff"),
+        "qq_file": PurePath(final_folder, name + r"_plot_qq.tiff"),
+        "extract_file": PurePath(final_folder, name + r"_extract.csv")}
+
+def phenotype_stages(phenotype: list, files: dict, options: dict):
+    # Stages of Part 8-10 of one phenotype: (name, inputs, params, outputs)
+    merged_files = prefix_files(options["merged_name"], ["bed", "bim", "fam"])
+    stages = []
+    if options["prune"]:
+        covar_files = [options["covar_file"]] if options["covar"] else []
+        stages.append(("QC prune " + phenotype[0], merged_files + [files["ID_phenotype_file"]] + covar_files,
+                       {"assoc": files["assoc_analysis"], "assoc_engine": options["assoc_engine"], "covar": options["covar"], "qc_filters": options["qc_filters"],
+                        "prune_engine": options["prune_engine"]}, [files["QC_file"]]))
+        # plink writes no .clumped file if no SNP passes --clump-p1, the stage then records only its log
+        stages.append(("clump " + phenotype[0], merged_files + [files["QC_file"]], {}, [files["clump_log_file"], files["clump_file"]]))
+        stages.append(("re-clump " + phenotype[0], [files["clump_file"]], {"clump_kb": options["clump_kb"], "method": "best-P"}, [files["final_clump_file"]]))
+    if options["make_plot"]:
+        if options["plot_engine"] == "R":
+            stages.append(("plot " + phenotype[0], [files["QC_file"], options["rfile"]], {"type": phenotype[1]}, [files["top_snp_file"]]))
+        else:
+            stages.append(("plot " + phenotype[0], [files["QC_file"]], {"type": phenotype[1], "plot_engine": options["plot_engine"]},
+                           [files["top_snp_file"], files["manhattan_file"], files["qq_file"]]))
+        snp_source = [] if options["snp"] else [files["final_clump_file"], files["top_snp_file"]]
+        stages.append(("extract " + phenotype[0], merged_files + [options["store_folder"], files["ID_phenotype_file"]] + snp_source, {"snp": options["snp"]}, [files["extract_file"]]))
+    return stages
+
+def run_command(command):
+    # plink / Rscript of Part 7 or of a phenotype job, a failed command stops the part or the job
+    program = command.split()[0] if isinstance(command, str) else command[0]
+    with span("command", program=program, command=command) as record:
+        returncode = subprocess.call(command, shell=isinstance(command, str))
+        record["returncode"] = returncode
+    if returncode != 0:
+        raise RuntimeError("command exited with code " + str(returncode) + ": " + str(command))
+
+def phenotype_job(phenotype: list, files: dict, options: dict):
+    # Part 8-10 of one phenotype on the merged bed files (without phenotype), runs in a worker process,
+    # the phenotype is given to plink by --pheno; options["run"] are the stages that are not up to date
+    run = options["run"]
+    merged_name = str(options["merged_name"])
+    plink = r".\\plink --silent --memory " + str(options["plink_memory"]) + r" --threads " + str(options["plink_threads"])
+    Path(files["final_folder"]).mkdir(parents=True, exist_ok=True)
+
+    # Part 8: QC + prune + association
+    if "QC prune " + phenotype[0] in run:
+        print("Part 8: Prune merged binary file of phenotype: " + phenotype[0])
+        covar = r" --covar .\\" + str(options["covar_file"]) + r" --covar-name " + options["covar"] + r" --hide-covar" if options["covar"] else ""
+        plink_prune = plink + r" --bfile .\\" + merged_name + r" --pheno .\\" + str(files["ID_phenotype_file"]) + r" --not-chr 0 x y xy" + options["qc_filters"] + (r" --indep-pairwise 50 5 0.2" if options["prune_engine"] == "plink" else "")
+        if options["assoc_engine"] == "plink":
+            plink_prune += covar + r" --" + files["assoc_analysis"] + r" --ci 0.95 --out .\\" + str(tmp_path(files["QC_name"]))
+            run_command(plink_prune)
+        else:
+            # plink only writes the SNPs and samples passing QC, the association runs in this process
+            plink_prune += r" --write-snplist --make-just-fam --out .\\" + str(tmp_path(files["QC_name"]))
+            run_command(plink_prune)
+            print("Part 8: Association of phenotype: " + phenotype[0])
+            run_assoc(merged_name, files["ID_phenotype_file"], files["assoc_analysis"], tmp_path(files["QC_name"]),
+                      options["covar_file"] if options["covar"] else None, options["covar"].split(",") if options["covar"] else None,
+                      PurePath(str(tmp_path(files["QC_name"])) + r".snplist"), PurePath(str(tmp_path(files["QC_name"])) + r".fam"),
+                      0.95, options["assoc_memory"])
+        replace_prefix(tmp_path(files["QC_name"]), files["QC_name"])
+    # Part 8: clump
+    if "clump " + phenotype[0] in run:
+        print("Part 8: Clump snps of phenotype: " + phenotype[0])
+        if os.path.exists(files["clump_file"]):
+            os.remove(files["clump_file"])
+        plink_clump = plink + r" --bfile .\\" + merged_name + r" --clump " + str(files["QC_file"]) + r" --clump-allow-overlap --clump-best --clump-kb 1000 --clump-p1 5e-8 --clump-r2 0.2 --out .\\" + str(tmp_path(files["clump_name"]))
+        run_command(plink_clump)
+        replace_prefix(tmp_path(files["clump_name"]), files["clump_name"])
+    # Part 8: final-clump, the clump list of an earlier run is removed if no SNP is clumped now
+    if "re-clump " + phenotype[0] in run and os.path.exists(files["clump_file"]):
+        print("Part 8: Re-clump of snps of phenotype: " + phenotype[0])
+        select_clump_snp(files["clump_file"], options["clump_kb"], tmp_path(files["final_clump_file"]))
+        replace_output(tmp_path(files["final_clump_file"]), files["final_clump_file"])
+    elif "re-clump " + phenotype[0] in run and os.path.exists(files["final_clump_file"]):
+        os.remove(files["final_clump_file"])
+
+    # Part 9: R plots, the R script writes its files in place,
+    # the old top snps file is removed first so a failed run is never taken as finished
+    if "plot " + phenotype[0] in run and options["plot_engine"] == "R":
+        print("Part 9: Use R to make plots of phenotype: " + phenotype[0])
+        if os.path.exists(files["top_snp_file"]):
+            os.remove(files["top_snp_file"])
+        r_bat = [options["rscript"], r"--vanilla", options["rfile"], r"--dataset=" + options["dataset"], r"--phenotype=" + phenotype[0], r"--type=" + phenotype[1]]
+        run_command(r_bat)
+    # Part 9: the same plots and top snps file in this process
+    elif "plot " + phenotype[0] in run:
+        print("Part 9: Make plots of phenotype: " + phenotype[0])
+        plot_assoc(files["QC_file"], phenotype[0], tmp_path(files["manhattan_file"]), tmp_path(files["qq_file"]), tmp_path(files["top_snp_file"]))
+        for name in ["manhattan_file", "qq_file", "top_snp_file"]:
+            replace_output(tmp_path(files[name]), files[name])
+
+    # Part 10: extract genotype of designated or top snps from the genotype store,
+    # samples and A1/A2 of the SNPs are those of the merged bed files (as plink --recodeA include-alt)
+    if "extract " + phenotype[0] in run:
+        if options["snp"]:
+            extract_snp_list = options["snp"]
+        else:
+            try:
+                extract_snp_list = select_top_list(files["final_clump_file"])
+            except FileNotFoundError:
+                extract_snp_list = select_top_list(files["top_snp_file"])
+
+        snps = 0
+        if len(extract_snp_list) != 0:
+            print("Part 10: Extract genotype of specific snps of phenotype: " + phenotype[0])
+            snps = extract_snp_file(options["store_folder"], merged_name, files["ID_phenotype_file"], extract_snp_list.split(","),
+                                    options["id_name"], phenotype[0], tmp_path(files["extract_file"]))
+        if snps != 0:
+            replace_output(tmp_path(files["extract_file"]), files["extract_file"])
+        else:
+            print('Part 10: No designated snp or significant snp found in the top snps file of phenotype: ' + phenotype[0])
+            # the genotypes of an earlier run are not kept
+            for file in [tmp_path(files["extract_file"]), files["extract_file"]]:
+                if os.path.exists(file):
+                    os.remove(file)
 
 def main():
     parser = argparse.ArgumentParser(description="Convert reduced file to plink")
@@ -16,21 +247,46 @@ def main():
     parser.add_argument("--SNP_map", required=True, type=Path, help="CSV file that contains list of SNP, with at least chr, SNP_id, BP.")
     parser.add_argument("--patient_file", required=True, type=Path, help="File that contains patients information (including phenotype).")
     parser.add_argument("--id_name", required=True, type=str, help="Column name of patients' identity in both patient file and SNP file.")
-    parser.add_argument("--phenotype", required=True, type=str, help="Phenotype's name in the file")
-    parser.add_argument("--type", required=True, type=str, help="Phenotype's type in the file, eg category or continuous")
+    parser.add_argument("--phenotype", required=True, type=str, help="Phenotype's name in the file. Could use comma-delimited names (eg BMI,DM) or a file with one phenotype (name or name,type) per line")
+    parser.add_argument("--type", required=True, type=str, help="Phenotype's type in the file, eg category or continuous. Could use comma-delimited types, one per phenotype")
     parser.add_argument("--chr", type=str, help="Select specific chromosomes to analyze (without filter). Could use single or comma-delimited string (eg 1,7,11)")
     parser.add_argument("--merge_size", type=int, default=800, help="Merge temp file by how many cases (default: 800)")
+    parser.add_argument("--append", action="store_true", help="Only select and merge the cases not merged yet (eg a new batch of reduced files) and add them to the merged files and genotype store, instead of merging all cases again")
+    parser.add_argument("--merge_memory", type=int, default=0, help="Memory budget (MB) of each merged file, sets the merge size from the number of SNPs (default: 0, use merge_size)")
     parser.add_argument("--chunk_size", type=int, default=50000, help="Generate ped file with how many snp per chunk (default: 50000)")
+    parser.add_argument("--bed_writer", type=str, default="native", choices=["native", "plink"], help="Write bed files directly from genotype codes (native) or through ped/map files and plink (default: native)")
+    parser.add_argument("--workers", type=int, default=1, help="How many chr jobs of Part 4-6 and phenotype jobs of Part 8-10 run at the same time (default: 1)")
+    parser.add_argument("--max_memory", type=int, default=0, help="Memory limit (GB) of the jobs running at the same time (default: 80%% of free memory)")
+    parser.add_argument("--dry-run", "--dry_run", dest="dry_run", action="store_true", help="Only list the stages that would run (their inputs or parameters changed), nothing is written.")
     parser.add_argument("--keep_temp", type=bool, default=False, help="Keep all temp files (need more disk space).")
     parser.add_argument("--make_bed", type=bool, default=True, help="Use plink to make bed file.")
     parser.add_argument("--prune", type=bool, default=True, help="Use plink to QC and prune bed file.")
+    parser.add_argument("--qc", type=str, default="plink", choices=["plink", "native"], help="Filter SNPs and samples with plink in Part 8 or from the genotype codes before the bed files are written (default: plink)")
+    parser.add_argument("--maf", type=float, default=0.05, help="QC: minimum minor allele frequency of SNPs (default: 0.05)")
+    parser.add_argument("--geno", type=float, default=0.05, help="QC: maximum missing call rate of SNPs (default: 0.05)")
+    parser.add_argument("--mind", type=float, default=0.05, help="QC: maximum missing call rate of samples (default: 0.05)")
+    parser.add_argument("--prune_engine", type=str, default="plink", choices=["plink", "native"], help="LD pruning (--indep-pairwise 50 5 0.2) with plink in Part 8 or per chr on the bed files in Part 6, native needs --qc native (default: plink)")
+    parser.add_argument("--hwe", type=float, default=0.000001, help="QC: minimum Hardy-Weinberg exact test p-value of SNPs (default: 0.000001)")
+    parser.add_argument("--assoc_engine", type=str, default="plink", choices=["plink", "numpy"], help="Run the association of Part 8 with plink or in this process with NumPy (default: plink)")
+    parser.add_argument("--covar", type=str, help="Covariates of the association, comma-delimited column names in the patient file (eg Age,Sex)")
     parser.add_argument("--clump_kb", type=int, default=250, help="The distance of SNP BP for Re-clumping.")
     parser.add_argument("--make_plot", type=bool, default=True, help="Use R to make manhattan plot and qq plot.")
+    parser.add_argument("--plot_engine", type=str, default="R", choices=["R", "python"], help="Make the plots and top SNPs file of Part 9 with the R script or in this process with matplotlib (default: R)")
     parser.add_argument("--rscript", type=str, default="C:\\Program Files\\R\\R-4.3.1\\bin\\Rscript", help="Path to R script file.")
     parser.add_argument("--rfile", type=str, default="SNP_manhattan_top.R", help="Path to R plot script file.")
     parser.add_argument("--snp", type=str, help="Select specific snps to extract. Could use single or comma-delimited string (eg rs1883832,rs11569323)")
+    parser.add_argument("--trace", type=Path, help="Append timings, peak memory and rows / bytes of every part, stage, job, command and chunk to this JSON-lines file, and print a summary table at the end")
+    parser.add_argument("--profile", type=str, choices=PROFILERS, help="Profile every part and job with cProfile or pyinstrument, saved next to the trace file (needs --trace)")
     
     args = parser.parse_args()
+    if args.profile and not args.trace:
+        parser.error("--profile needs --trace")
+    if args.prune_engine == "native" and args.qc != "native":
+        # the native pruning runs on the chr bed files, they are QC filtered only with --qc native
+        parser.error("--prune_engine native needs --qc native")
+    if args.plot_engine == "python" and args.make_plot and importlib.util.find_spec("matplotlib") is None:
+        # matplotlib is installed only for the plots in Python (see README)
+        parser.error("--plot_engine python needs matplotlib (pip install matplotlib)")
 
     # 1-22, X, Y, XY (pseudo-autosomal region of X), and MT
     SNP_map_file = args.SNP_map # chr,SNP_id,BP
@@ -38,12 +294,7 @@ def main():
     patient_data_file = args.patient_file
     patient_data_file_prefix = Path(patient_data_file).stem
     patient_data_id = args.id_name
-    phenotype = [args.phenotype, args.type] # category, continuous
-    
-    if args.type == "category":
-        assoc_analysis = "logistic"
-    else:
-        assoc_analysis = "linear"
+    phenotypes = parse_phenotypes(args.phenotype, args.type) # [name, category or continuous]
     
     if args.chr:
         selected_chr = args.chr.split(",")
@@ -58,224 +309,326 @@ def main():
     snp_folder = PurePath(dataset_folder, "SNP_files")
     temp_folder = PurePath(snp_folder, "temp")
     merged_folder = PurePath(snp_folder, "merged")
-    final_folder = PurePath(dataset_folder, phenotype[0])
+    pheno_files = [phenotype_files(dataset_folder, patient_data_file_prefix, phenotype) for phenotype in phenotypes]
+    memory_limit = args.max_memory * 1024 if args.max_memory else (available_memory_mb() or 12 * 1024) * 8 // 10
     
+    # Every stage below runs only if its inputs or parameters changed since its last run
+    # (or an output is missing), see lib/cache.py
+    cache = StageCache(PurePath(dataset_folder, MANIFEST_NAME), args.dry_run)
+
     # Part 1
     def make_dataset_folder():
         # Generate working folder
-        if not os.path.exists(dataset_folder):
+        if not os.path.exists(dataset_folder) and not args.dry_run:
             print("Part 1: Generate working folders")
             Path(dataset_folder).mkdir(parents=True, exist_ok=True)    
     
     # Part 2
     dataseta_ID_file = PurePath(dataset_folder, patient_data_file_prefix + r"_ID_list.csv")
-    ID_phenotype_file = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_list.csv")
+    covar_file = PurePath(dataset_folder, patient_data_file_prefix + r"_covar.txt")
+    # the patient file is parsed once into a parquet copy, the ID files read their columns from it
+    patient_cache_folder = PurePath(dataset_folder, PATIENT_CACHE_NAME)
     def make_id_files():
         # Use all ID in dataset to generate dataset-level ID filter 
         # Labels: ID S
-        if not os.path.exists(dataseta_ID_file):
+        if cache.needs_run("dataset ID", [patient_data_file], {"id_name": patient_data_id}, [dataseta_ID_file]):
             print("Part 2: Generate dataset ID filter.")
             Path(Path(dataseta_ID_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-            dataset_ID_filter(patient_data_file, patient_data_id, dataseta_ID_file)
+            dataset_ID_filter(patient_data_file, patient_data_id, tmp_path(dataseta_ID_file), patient_cache_folder)
+            replace_output(tmp_path(dataseta_ID_file), dataseta_ID_file)
+            cache.done("dataset ID")
         
-        # Generate phenotype-based ID filter (phenotype=-9 if missing)
+        # Generate phenotype-based ID filter of every phenotype (phenotype=-9 if missing)
         # Labels: FID ID P
-        if not os.path.exists(ID_phenotype_file):
-            print("Part 2: Generate phenotype-based patient ID file.")
-            Path(Path(ID_phenotype_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-            pheno_ID_filter(patient_data_file, patient_data_id, phenotype, ID_phenotype_file)
+        ID_phenotype_files = [files["ID_phenotype_file"] for files in pheno_files]
+        if cache.needs_run("phenotype ID", [patient_data_file], {"id_name": patient_data_id, "phenotypes": phenotypes}, ID_phenotype_files):
+            print("Part 2: Generate phenotype-based patient ID files of " + str(len(phenotypes)) + " phenotypes.")
+            for ID_phenotype_file in ID_phenotype_files:
+                Path(Path(ID_phenotype_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
+            pheno_ID_filters(patient_data_file, patient_data_id, phenotypes, [tmp_path(f) for f in ID_phenotype_files], patient_cache_folder)
+            for ID_phenotype_file in ID_phenotype_files:
+                replace_output(tmp_path(ID_phenotype_file), ID_phenotype_file)
+            cache.done("phenotype ID")
+
+        # Generate covariate file (covariate=-9 if missing)
+        # Labels: FID IID covariates...
+        if args.covar and cache.needs_run("covariates", [patient_data_file], {"id_name": patient_data_id, "covar": args.covar}, [covar_file]):
+            print("Part 2: Generate covariate file.")
+            covar_ID_filter(patient_data_file, patient_data_id, args.covar.split(","), tmp_path(covar_file), patient_cache_folder)
+            replace_output(tmp_path(covar_file), covar_file)
+            cache.done("covariates")
     
     # Part 3
     # Merge dataset-level SNP files
-    new_SNP_map_file = PurePath(snp_folder, r"SNP_map_sorted.csv")
-    new_SNP_map_range_file = PurePath(snp_folder, r"SNP_map_sorted_range.csv")
+    # sorted SNP map with its chr ranges (see lib/snpmap.py)
+    new_SNP_map_file = PurePath(snp_folder, r"SNP_map_sorted.parquet")
     def merge_reduce_snp_files():
         # Generate sorted SNP file
-        if not os.path.exists(new_SNP_map_range_file):
-            print("Part 3: Generate sorted SNP file and file for split merged file.")
-            Path(Path(new_SNP_map_range_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-            snp_map_filter(SNP_map_file, new_SNP_map_file, new_SNP_map_range_file)
+        if cache.needs_run("sorted SNP map", [SNP_map_file], {}, [new_SNP_map_file]):
+            print("Part 3: Generate sorted SNP file with the chr ranges for split merged file.")
+            Path(Path(new_SNP_map_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
+            snp_map_filter(SNP_map_file, tmp_path(new_SNP_map_file))
+            replace_output(tmp_path(new_SNP_map_file), new_SNP_map_file)
+            cache.done("sorted SNP map")
 
         # Generate merged snp files
-        if not os.path.exists(merged_folder): 
-            if not os.path.exists(temp_folder):
+        reduce_files = sorted(Path(reduce_folder).glob("*.parquet"))
+        if cache.needs_run("merged SNP files", reduce_files + [dataseta_ID_file, new_SNP_map_file], {"merge_size": args.merge_size, "merge_memory": args.merge_memory}, [merged_folder]):
+            merge_key = {"snp_map": cache.input_hash(new_SNP_map_file), "merge_size": args.merge_size, "merge_memory": args.merge_memory}
+            new_ids = None
+            if args.append and os.path.exists(merged_folder):
+                new_ids = merge_append_ids(merged_folder, dataseta_ID_file, merge_key)
+                if new_ids is None:
+                    print("Part 3: Cannot append to the merged files, merge all cases again.")
+            if os.path.exists(temp_folder):
+                shutil.rmtree(temp_folder)
+            Path(temp_folder).mkdir(parents=True, exist_ok=True)
+            if os.path.exists(tmp_path(merged_folder)):
+                shutil.rmtree(tmp_path(merged_folder))
+            Path(tmp_path(merged_folder)).mkdir(parents=True, exist_ok=True)
+            if new_ids is not None:
+                # Only the new cases are selected and merged into new merged files next to the old ones
+                print("Part 3: Append " + str(len(new_ids)) + " new cases to the merged files.")
+                if new_ids:
+                    sources = select_reduce_by_id(reduce_folder, dataseta_ID_file, temp_folder, new_ids)
+                    merge_temp_file(temp_folder, tmp_path(merged_folder), new_SNP_map_file, args.merge_size, args.merge_memory, len(merged_file_list(merged_folder)) + 1)
+                    for f in sorted(Path(tmp_path(merged_folder)).iterdir()):
+                        os.replace(f, PurePath(merged_folder, f.name))
+                    write_merge_state(merged_folder, merge_key, sources, append=True)
+                shutil.rmtree(tmp_path(merged_folder))
+            else:
                 print("Part 3: Select SNP files by patient ID filter.")
-                Path(temp_folder).mkdir(parents=True, exist_ok=True)
-                select_reduce_by_id(reduce_folder, dataseta_ID_file, temp_folder)
-            
-            print("Part 3: Merge selected SNP files.")
-            Path(merged_folder).mkdir(parents=True, exist_ok=True)
-            merge_temp_file(temp_folder, merged_folder, new_SNP_map_file, args.merge_size)
+                sources = select_reduce_by_id(reduce_folder, dataseta_ID_file, temp_folder)
+
+                print("Part 3: Merge selected SNP files.")
+                merge_temp_file(temp_folder, tmp_path(merged_folder), new_SNP_map_file, args.merge_size, args.merge_memory)
+                write_merge_state(tmp_path(merged_folder), merge_key, sources)
+                replace_output(tmp_path(merged_folder), merged_folder)
+            cache.done("merged SNP files")
 
         # Remove temp folder
-        if not args.keep_temp and os.path.exists(temp_folder):
+        if not args.keep_temp and os.path.exists(temp_folder) and not args.dry_run:
             print("Part 3: Remove temp folder...")
             shutil.rmtree(temp_folder)
 
-    # Part 4
-    # Split dataset-level SNP files to chr-level and merge them
-    def chr_split_merge():
-        for chr in selected_chr:
-            # Make selected chr filter 
-            chr_folder = PurePath(snp_folder, "chr", str(chr))
-            chr_map_file = PurePath(chr_folder, patient_data_file_prefix + r"_chr" + str(chr) + r"_SNP_map.csv")
-            if not os.path.exists(chr_map_file):
-                print("Part 4: Select chr: " + str(chr))
-                Path(Path(chr_map_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-                selected_chr_SNP_map(chr, new_SNP_map_file, chr_map_file)
-            
-            # Split dataset-level SNP files and merge to chr-level file
-            # and merge chr map and patient genotype together
-            chr_map_patient_file = PurePath(chr_folder, patient_data_file_prefix + r"_chr" + str(chr) + r"_SNP_map_patient.csv")
-            if not os.path.exists(chr_map_patient_file):
-                print("Part 4: Generate chr map patient file of chr: "+ str(chr))
-                Path(Path(chr_map_patient_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-                merge_selected_SNP_by_range(merged_folder, chr, new_SNP_map_range_file, chr_map_file, chr_map_patient_file)
-
-    # Part 5
-    # Make dataset-level Map and Ped file
-    def chr_map_ped():
+    # Part 4-6
+    # Split dataset-level SNP files to chr-level files, make map/ped files and bed files of each chr.
+    # Chromosomes are independent, they run at the same time under a memory limit
+    store_folder = PurePath(snp_folder, "store")
+    merge_files_txt = PurePath(dataset_folder, patient_data_file_prefix + r"_mergefiles.txt")
+    snp_qc_file = PurePath(dataset_folder, patient_data_file_prefix + r"_snp_qc.parquet")
+    sample_qc_file = PurePath(dataset_folder, patient_data_file_prefix + r"_sample_qc.parquet")
+    chr_beds = {}
+    def chr_parts():
+        # Copy the merged files into the memory-mapped genotype store, every chr is a range of its rows
+        if cache.needs_run("genotype store", [merged_folder, new_SNP_map_file], {}, [store_folder]):
+            print("Part 4: Build genotype store of merged files.")
+            build_genotype_store(merged_folder, new_SNP_map_file, store_folder)
+            cache.done("genotype store")
+
+        # Genotype QC of all chr from the codes, its reports are the masks of the bed files
+        qc_params = {"chr": selected_chr, "chunk_size": args.chunk_size, "maf": args.maf, "geno": args.geno, "mind": args.mind, "hwe": args.hwe}
+        if args.qc == "native" and cache.needs_run("genotype QC", [store_folder, new_SNP_map_file], qc_params, [snp_qc_file, sample_qc_file]):
+            print("Part 4: Genotype QC of the genotype store.")
+            genotype_qc(store_folder, new_SNP_map_file, snp_map_ranges(new_SNP_map_file), selected_chr, args.chunk_size,
+                        args.maf, args.geno, args.mind, args.hwe, tmp_path(snp_qc_file), tmp_path(sample_qc_file))
+            replace_output(tmp_path(snp_qc_file), snp_qc_file)
+            replace_output(tmp_path(sample_qc_file), sample_qc_file)
+            cache.done("genotype QC")
+
+        options = {"bed_writer": args.bed_writer, "chunk_size": args.chunk_size,
+                   "new_SNP_map_file": new_SNP_map_file,
+                   "store_folder": store_folder, "dataseta_ID_file": dataseta_ID_file,
+                   "qc": args.qc, "snp_qc_file": snp_qc_file, "sample_qc_file": sample_qc_file}
+        stages = {}
         for chr in selected_chr:
-            chr_folder = PurePath(snp_folder, "chr", str(chr))
-            chr_map_patient_file = PurePath(chr_folder, patient_data_file_prefix + r"_chr" + str(chr) + r"_SNP_map_patient.csv")
-            
-            # Generate map file
-            chr_map_file = PurePath(snp_folder, "map", patient_data_file_prefix + r"_chr" + str(chr) + r".map")
-            if not os.path.exists(chr_map_file):
-                print("Part 5: Generate map file of chr: "+ str(chr))
-                Path(Path(chr_map_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-                make_map_file(chr_map_patient_file, chr_map_file)
-
-            # Generate dataset-based ped file (without phenotype)
-            chr_ped_file = PurePath(snp_folder, "ped", patient_data_file_prefix + r"_chr" + str(chr) + r".ped")
-            if not os.path.exists(chr_ped_file):
-                print("Part 5: Generate ped file of chr: "+ str(chr))
-                Path(Path(chr_ped_file).parent.absolute()).mkdir(parents=True, exist_ok=True)
-                make_ped_file(chr_map_patient_file, dataseta_ID_file, args.chunk_size, chr_ped_file)
+            files = chr_files(snp_folder, patient_data_file_prefix, chr)
+            chr_beds[chr] = files["chr_bed"]
+            chr_stage, bed_stage = chr_stages(chr, files, options)
+            run_chr = cache.needs_run(*chr_stage)
+            run_bed = args.make_bed and cache.needs_run(*bed_stage)
+            if run_chr or run_bed:
+                stages[chr] = (files, chr_stage[0] if run_chr else None, bed_stage[0] if run_bed else None)
+        if not stages:
+            return
+
+        ranges = snp_map_ranges(new_SNP_map_file)
+        store_samples = len(GenotypeStore(store_folder).samples)
+        jobs = []
+        for chr, (files, chr_stage, bed_stage) in stages.items():
+            snps = ranges[str(chr)][1] - ranges[str(chr)][0] + 1 if str(chr) in ranges else 0
+            samples = store_samples if str(chr) in ranges else 0
+            commands = []
+            if args.bed_writer == "plink" and bed_stage:
+                plink_memory = estimate_plink_memory_mb(snps, samples)
+                plink_makebed = r".\\plink --silent --memory " + str(plink_memory) + r" --map .\\" + str(files["chr_map_file"]) + r" --ped .\\" + str(files["chr_ped_file"]) + r" --make-bed --out .\\" + str(tmp_path(files["chr_bed"]))
+                commands.append((plink_makebed, plink_memory))
+            jobs.append({"name": "chr " + str(chr), "memory_mb": estimate_chr_memory_mb(snps, samples, args.chunk_size, args.bed_writer),
+                         "func": chr_job, "args": (chr, files, dict(options, run_chr=bool(chr_stage), run_bed=bool(bed_stage))), "commands": commands})
+
+        print("Part 4-6: Run " + str(len(jobs)) + " chr jobs with " + str(args.workers) + " workers, memory limit " + str(memory_limit) + " MB.")
+        results = run_jobs(jobs, args.workers, memory_limit)
+        failed = [r for r in results if r["error"]]
+        # Record the stages of the chr jobs that finished
+        for chr, result in zip(stages, results):
+            files, chr_stage, bed_stage = stages[chr]
+            if result["error"]:
+                continue
+            if args.bed_writer == "plink" and bed_stage:
+                replace_prefix(tmp_path(files["chr_bed"]), files["chr_bed"])
+            for stage in (chr_stage, bed_stage):
+                if stage:
+                    cache.done(stage)
+        if failed:
+            raise RuntimeError("Part 4-6 failed on " + ", ".join(r["name"] + " (" + r["error"] + ")" for r in failed))
 
     # Part 6
-    # Generate binary files with plink and write to mergefiles.txt
-    merge_files_txt = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_mergefiles.txt")
-    def make_bed():
+    # LD pruning of the bed files of every chr, chromosomes run at the same time under the memory limit
+    prune_files = {}
+    def prune_parts():
+        options = {"ld_memory": 256}
+        jobs = []
+        pending = []
         for chr in selected_chr:
-            chr_map_file = PurePath(snp_folder, "map", patient_data_file_prefix + r"_chr" + str(chr) + r".map")
-            chr_ped_file = PurePath(snp_folder, "ped", patient_data_file_prefix + r"_chr" + str(chr) + r".ped")
-            chr_bed = PurePath(snp_folder, "bed", phenotype[0], patient_data_file_prefix + r"_" + phenotype[0] + r"_chr" + str(chr))
-            
-            if os.path.exists(chr_ped_file):
-                if not os.path.exists(PurePath(str(chr_bed) + r".bed")):
-                    print("Part 6: Generate bed files, combine phenotyp file, now on chr: "+ str(chr))
-                    Path(Path(chr_bed).parent.absolute()).mkdir(parents=True, exist_ok=True)
-                    plink_makebed = r".\\plink --silent --map .\\" + str(chr_map_file) + r" --ped .\\" + str(chr_ped_file) + r" --pheno .\\" + str(ID_phenotype_file) + r" --make-bed --out .\\" + str(chr_bed)
-                    os.system(plink_makebed)
-
-                    print("Part 6: Write bed path to mergefiles.txt")
-                    with open(merge_files_txt, 'a+') as f:
-                        f.write(f'{chr_bed}\n')
-            else:
-                raise FileNotFoundError(chr_ped_file)
+            files = chr_files(snp_folder, patient_data_file_prefix, chr)
+            prune_files[chr] = prefix_files(files["chr_bed"], ["prune.in", "prune.out"])
+            if not cache.needs_run("prune chr " + str(chr), prefix_files(files["chr_bed"], ["bed", "bim", "fam"]), {"indep_pairwise": [50, 5, 0.2]}, prune_files[chr]):
+                continue
+            with open(PurePath(str(files["chr_bed"]) + r".bim")) as f:
+                snps = sum(1 for _ in f)
+            jobs.append({"name": "prune chr " + str(chr), "memory_mb": estimate_prune_memory_mb(snps, options["ld_memory"]), "func": prune_job, "args": (chr, files, options)})
+            pending.append(chr)
+        if not jobs:
+            return
+        print("Part 6: Run " + str(len(jobs)) + " LD prune jobs with " + str(args.workers) + " workers, memory limit " + str(memory_limit) + " MB.")
+        results = run_jobs(jobs, args.workers, memory_limit)
+        for chr, result in zip(pending, results):
+            if not result["error"]:
+                cache.done("prune chr " + str(chr))
+        failed = [r for r in results if r["error"]]
+        if failed:
+            raise RuntimeError("Part 6 failed on " + ", ".join(r["name"] + " (" + r["error"] + ")" for r in failed))
+
+    # Write the bed path of every chr to mergefiles.txt, in chr order
+    def write_merge_list():
+        print("Part 6: Write bed paths to mergefiles.txt")
+        Path(Path(merge_files_txt).parent.absolute()).mkdir(parents=True, exist_ok=True)
+        with open(merge_files_txt, 'w') as f:
+            for chr in selected_chr:
+                if not os.path.exists(PurePath(str(chr_beds[chr]) + r".bed")):
+                    raise FileNotFoundError(PurePath(str(chr_beds[chr]) + r".bed"))
+                f.write(f'{chr_beds[chr]}\n')
 
     # Part 7
-    # Merge all plink binary files in mergefiles.txt and generate merged plink file
-    merged_final_name = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_merged")
+    # Merge all plink binary files in mergefiles.txt and generate merged plink file (without phenotype),
+    # it is built once and shared by all phenotypes
+    merged_final_name = PurePath(dataset_folder, patient_data_file_prefix + r"_merged")
     merged_final_file = PurePath(str(merged_final_name) + r".bed")
     def merge_binary_files():
-        if os.path.exists(merge_files_txt):
-            # merge binary files + freqx + missing
-            if not os.path.exists(merged_final_file):
-                print("Part 7: Merge binary files, calculate frequency and missing of phenotype and SNPs.")
-                plink_merge = r".\\plink --silent --merge-list .\\" + str(merge_files_txt) + r" --make-bed --freqx --missing --out .\\" + str(merged_final_name)
-                os.system(plink_merge)
-        else:
-            raise FileNotFoundError(merge_files_txt)
-        
-    # Part 8
-    # Prune merged binary file + clump snps
-    merged_final_QC_name = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_merged_QC_prune")
-    merged_final_QC_file = PurePath(str(merged_final_QC_name) + r".assoc." + assoc_analysis)
-    clump_snp_name = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_clump")
-    clump_snp_file = PurePath(str(clump_snp_name) + r".clumped")
-    final_clump_file = PurePath(str(clump_snp_name) + r".csv")
-    def prune_QC_clump():
-        if os.path.exists(merged_final_file):
-            # QC + prune
-            if not os.path.exists(merged_final_QC_file):
-                print("Part 8: Prune merged binary file.")
-                plink_prune = r".\\plink --silent --bfile .\\" + str(merged_final_name) + r" --not-chr 0 x y xy --maf 0.05 --hwe 0.000001 --geno 0.05 --mind 0.05 --indep-pairwise 50 5 0.2 --" + assoc_analysis + r" --ci 0.95 --out .\\" + str(merged_final_QC_name)
-                os.system(plink_prune)
-            # clump
-            if not os.path.exists(clump_snp_file):
-                print("Part 8: Clump snps.")
-                plink_clump = r".\\plink --silent --bfile .\\" + str(merged_final_name) + r" --clump " + str(merged_final_QC_file) + r" --clump-allow-overlap --clump-best --clump-kb 1000 --clump-p1 5e-8 --clump-r2 0.2 --out .\\" + str(clump_snp_name)
-                os.system(plink_clump)
-        else:
-            raise FileNotFoundError(merged_final_file)
-        
-        if os.path.exists(clump_snp_file):
-            # final-clump
-            if not os.path.exists(final_clump_file):
-                print("Part 8: Re-clump of snps.")
-                select_clump_snp(clump_snp_file, args.clump_kb, final_clump_file)
-
-    # Part 9
-    # Use R to make plots
-    # change rscript path if different version or path to folder
-    top_snp_file = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_Top_SNPs.csv")
-    def R_plot():
-        if os.path.exists(merged_final_QC_file):
-            if not os.path.exists(top_snp_file):
-                print("Part 9: Use R to make plots.")
-                r_bat = [args.rscript, r"--vanilla", args.rfile, r"--dataset=" + patient_data_file_prefix, r"--phenotype=" + phenotype[0], r"--type=" + phenotype[1]]
-                subprocess.call(r_bat, shell=True)
-        else:
-            raise FileNotFoundError(merged_final_QC_file)
-        
-    # Part 10
-    # Additional functions
-    # Select specific snps and extract genotype
-    extract_snp_name = PurePath(final_folder, patient_data_file_prefix + r"_" + phenotype[0] + r"_extract")
-    def extract_snp():
-        if os.path.exists(merged_final_file):
-            if args.snp:
-                extract_snp_list = args.snp
-            else:
-                try:
-                    extract_snp_list = select_top_list(final_clump_file)
-                except:
-                    extract_snp_list = select_top_list(top_snp_file)
-            
-            if len(extract_snp_list) != 0:
-                print("Part 10: Extract genotype of specific snps.")
-                plink_extract = r".\\plink --silent --bfile .\\" + str(merged_final_name) + r" --recodeA include-alt --d ? --snps " + extract_snp_list + r" --out .\\" + str(extract_snp_name)
-                os.system(plink_extract)
-
-                print("Part 10: Convert raw file to csv file.")
-                extract_raw_to_csv(PurePath(str(extract_snp_name) + r".raw"), patient_data_id, phenotype[0], PurePath(str(extract_snp_name) + r".csv"))
-            else:
-                print('Part 10: No designated snp or significant snp found in the top snps file!')
-        else:
+        chr_bed_files = [f for chr in selected_chr for f in prefix_files(chr_beds[chr], ["bed", "bim", "fam"])]
+        # merge binary files + freqx + missing (the genotype QC reports replace freqx and missing with --qc native)
+        reports = ["frqx", "lmiss", "imiss"] if args.qc == "plink" else []
+        if cache.needs_run("merged bed", chr_bed_files, {"qc": args.qc}, prefix_files(merged_final_name, ["bed", "bim", "fam"] + reports)):
+            write_merge_list()
+            print("Part 7: Merge binary files" + (", calculate frequency and missing of SNPs." if reports else "."))
+            plink_merge = r".\\plink --silent --merge-list .\\" + str(merge_files_txt) + r" --make-bed" + (r" --freqx --missing" if reports else "") + r" --out .\\" + str(tmp_path(merged_final_name))
+            run_command(plink_merge)
+            replace_prefix(tmp_path(merged_final_name), merged_final_name)
+            cache.done("merged bed")
+
+        # dataset-level prune lists of the native LD pruning, in chr order
+        merged_prune_files = prefix_files(merged_final_name, ["prune.in", "prune.out"])
+        if args.prune_engine == "native" and cache.needs_run("merged prune", [f for chr in selected_chr for f in prune_files[chr]], {}, merged_prune_files):
+            print("Part 7: Merge prune lists of every chr.")
+            for i, merged_prune_file in enumerate(merged_prune_files):
+                with open(tmp_path(merged_prune_file), 'w', newline='\n') as out:
+                    for chr in selected_chr:
+                        with open(prune_files[chr][i]) as f:
+                            shutil.copyfileobj(f, out)
+                replace_output(tmp_path(merged_prune_file), merged_prune_file)
+            cache.done("merged prune")
+
+    # Part 8-10
+    # QC + association, clump, plots and genotype extraction of every phenotype,
+    # phenotypes run at the same time as jobs (plink --pheno on the merged bed files) under the memory limit
+    def phenotype_parts():
+        if not os.path.exists(merged_final_file) and not args.dry_run:
             raise FileNotFoundError(merged_final_file)
+        options = {"merged_name": merged_final_name, "store_folder": store_folder, "prune": args.prune, "make_plot": args.make_plot, "clump_kb": args.clump_kb,
+                   "rscript": args.rscript, "rfile": args.rfile, "snp": args.snp, "id_name": patient_data_id, "dataset": patient_data_file_prefix,
+                   "assoc_engine": args.assoc_engine, "plot_engine": args.plot_engine, "covar": args.covar, "covar_file": covar_file, "prune_engine": args.prune_engine,
+                   "qc_filters": r" --maf " + format(args.maf, "g") + r" --hwe " + format(args.hwe, "g") + r" --geno " + format(args.geno, "g") + r" --mind " + format(args.mind, "g") if args.qc == "plink" else ""}
+        stages = []
+        for phenotype, files in zip(phenotypes, pheno_files):
+            run = [stage[0] for stage in phenotype_stages(phenotype, files, options) if cache.needs_run(*stage)]
+            if run:
+                stages.append((phenotype, files, run))
+        if not stages:
+            return
+
+        with open(PurePath(str(merged_final_name) + r".bim")) as f:
+            snps = sum(1 for _ in f)
+        with open(PurePath(str(merged_final_name) + r".fam")) as f:
+            samples = sum(1 for _ in f)
+        plink_memory = estimate_plink_memory_mb(snps, samples)
+        options["plink_memory"] = plink_memory
+        options["assoc_memory"] = plink_memory
+        options["plink_threads"] = max(1, (os.cpu_count() or 1) // max(args.workers, 1))
+        # Part 9 in process holds the association table of all SNPs
+        job_memory = max(plink_memory + 300, estimate_plot_memory_mb(snps) if args.plot_engine == "python" else 0)
+        jobs = [{"name": "phenotype " + phenotype[0], "memory_mb": job_memory, "func": phenotype_job,
+                 "args": (phenotype, files, dict(options, run=run))} for phenotype, files, run in stages]
+        print("Part 8-10: Run " + str(len(jobs)) + " phenotype jobs with " + str(args.workers) + " workers, memory limit " + str(memory_limit) + " MB.")
+        results = run_jobs(jobs, args.workers, memory_limit)
+        # Record the stages of the phenotype jobs that finished
+        for (phenotype, files, run), result in zip(stages, results):
+            if result["error"]:
+                continue
+            for stage in run:
+                if stage.startswith("clump ") and not os.path.exists(files["clump_file"]):
+                    cache.done(stage, [files["clump_log_file"]])
+                elif stage.startswith("re-clump ") and not os.path.exists(files["clump_file"]):
+                    cache.done(stage, [])
+                elif stage.startswith("extract ") and not os.path.exists(files["extract_file"]):
+                    cache.done(stage, [])
+                else:
+                    cache.done(stage)
+        failed = [r for r in results if r["error"]]
+        if failed:
+            raise RuntimeError("Part 8-10 failed on " + ", ".join(r["name"] + " (" + r["error"] + ")" for r in failed))
     
     # Main workflow
     if args.chr:
         print("Progress selected chr: " + str(args.chr))
     else:
         print("Loop over all chr.")
+    print("Phenotypes: " + ", ".join(phenotype[0] + " (" + phenotype[1] + ")" for phenotype in phenotypes))
+    if args.dry_run:
+        print("Dry run: list the stages that would run, nothing is written.")
+    if args.trace:
+        start_trace(args.trace, args.profile)
     
-    make_dataset_folder()
-    make_id_files()
-    merge_reduce_snp_files()
-    chr_split_merge()
-    chr_map_ped()
-
-    if args.make_bed:
-        make_bed()
-        merge_binary_files()
-    if args.prune:
-        prune_QC_clump()
-    if args.make_plot:
-        R_plot()
-        extract_snp()
+    try:
+        make_dataset_folder()
+        with span("Part 2: ID files", profile=True):
+            make_id_files()
+        with span("Part 3: merge reduced files", profile=True):
+            merge_reduce_snp_files()
+        with span("Part 4-6: chr jobs", profile=True):
+            chr_parts()
+
+        if args.make_bed:
+            if args.prune_engine == "native":
+                with span("Part 6: LD prune jobs", profile=True):
+                    prune_parts()
+            with span("Part 7: merge bed files", profile=True):
+                merge_binary_files()
+        if args.prune or args.make_plot:
+            with span("Part 8-10: phenotype jobs", profile=True):
+                phenotype_parts()
+    finally:
+        if args.trace:
+            trace_summary()
 
 if __name__ == "__main__":
     try:
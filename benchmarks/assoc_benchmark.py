@@ -0,0 +1,94 @@
+import argparse
+from timeit import default_timer as timer
+from pathlib import Path
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from lib.genotype import pack_2bit
+from lib.assoc import run_assoc
+
+# Benchmark of the NumPy association engine (lib/assoc.py) against plink --linear / --logistic
+# on a synthetic PLINK binary file set, eg:
+#   python benchmarks/assoc_benchmark.py --samples 5000 --snps 20000 --covars 4 --plink .\plink
+
+def make_dataset(folder: Path, samples: int, snps: int, covars: int, seed: int):
+    # Random genotypes (with 1% missing), a continuous and a case/control phenotype with a few causal SNPs, covariates
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    prefix = folder / "bench"
+    maf = rng.uniform(0.05, 0.5, snps)
+    values = np.empty((snps, samples), dtype=np.uint8)
+    dosage = np.empty((samples, snps))
+    for start in range(0, snps, 10000):
+        stop = min(start + 10000, snps)
+        block = rng.binomial(2, maf[start:stop, None], (stop - start, samples))
+        dosage[:, start:stop] = block.T
+        # .bed 2-bit values: 2 copies of A1 -> 0, het -> 2, 0 copies -> 3, missing -> 1
+        v = np.choose(block, [3, 2, 0]).astype(np.uint8)
+        v[rng.random(v.shape) < 0.01] = 1
+        values[start:stop] = v
+    with open(str(prefix) + ".bed", 'wb') as f:
+        f.write(bytes([0x6c, 0x1b, 0x01]))
+        f.write(np.ascontiguousarray(pack_2bit(values)).tobytes())
+    pd.DataFrame({'CHR': 1, 'SNP': ["rs" + str(i) for i in range(snps)], 'CM': 0, 'BP': np.arange(snps) * 100 + 1, 'A1': 'A', 'A2': 'G'}).to_csv(str(prefix) + ".bim", sep="\t", header=False, index=False)
+    ids = ["S" + str(i) for i in range(samples)]
+    pd.DataFrame({'FID': 0, 'IID': ids, 'PAT': 0, 'MAT': 0, 'SEX': rng.integers(1, 3, samples), 'P': -9}).to_csv(str(prefix) + ".fam", sep=" ", header=False, index=False)
+    covar = rng.normal(size=(samples, covars))
+    causal = rng.choice(snps, 5, replace=False)
+    signal = dosage[:, causal].sum(axis=1) * 0.1 + covar.sum(axis=1) * 0.2
+    linear = signal + rng.normal(size=samples)
+    case = rng.random(samples) < 1 / (1 + np.exp(-(signal - signal.mean())))
+    pd.DataFrame({'FID': 0, 'IID': ids, 'P': np.round(linear, 6)}).to_csv(folder / "linear.txt", sep="\t", header=False, index=False)
+    pd.DataFrame({'FID': 0, 'IID': ids, 'P': np.where(case, 2, 1)}).to_csv(folder / "logistic.txt", sep="\t", header=False, index=False)
+    covar_df = pd.DataFrame(np.round(covar, 6), columns=["C" + str(i + 1) for i in range(covars)])
+    covar_df.insert(0, 'IID', ids)
+    covar_df.insert(0, 'FID', 0)
+    covar_df.to_csv(folder / "covar.txt", sep=" ", index=False)
+    return prefix, [c for c in covar_df.columns[2:]]
+
+def compare(numpy_file: str, plink_file: str, effect: str):
+    ours = pd.read_csv(numpy_file, sep=r"\s+")
+    theirs = pd.read_csv(plink_file, sep=r"\s+")
+    theirs = theirs[theirs['TEST'] == 'ADD']
+    df = ours.merge(theirs, on='SNP', suffixes=('', '_plink')).dropna(subset=[effect, effect + '_plink', 'P', 'P_plink'])
+    return {"SNPs": len(df),
+            "max_abs_diff_" + effect: float((df[effect] - df[effect + '_plink']).abs().max()),
+            "max_rel_diff_SE": float(((df['SE'] - df['SE_plink']).abs() / df['SE_plink']).max()),
+            "max_abs_diff_log10P": float((np.log10(df['P']) - np.log10(df['P_plink'])).abs().max())}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy association engine against plink")
+    parser.add_argument("--samples", type=int, default=2000, help="Number of samples (default: 2000)")
+    parser.add_argument("--snps", type=int, default=10000, help="Number of SNPs (default: 10000)")
+    parser.add_argument("--covars", type=int, default=3, help="Number of covariates (default: 3)")
+    parser.add_argument("--memory", type=int, default=512, help="Memory budget (MB) of the NumPy engine (default: 512)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--folder", type=Path, default=Path("assoc_benchmark"), help="Working folder (default: assoc_benchmark)")
+    parser.add_argument("--plink", type=str, help="Path to plink 1.9, runs and compares the plink path if given")
+    args = parser.parse_args()
+
+    prefix, covar_names = make_dataset(args.folder, args.samples, args.snps, args.covars, args.seed)
+    print("Dataset: " + str(args.samples) + " samples, " + str(args.snps) + " SNPs, " + str(args.covars) + " covariates.")
+    for kind, effect in (("linear", "BETA"), ("logistic", "OR")):
+        start = timer()
+        run_assoc(prefix, args.folder / (kind + ".txt"), kind, args.folder / ("numpy_" + kind), args.folder / "covar.txt", covar_names, memory_mb=args.memory)
+        seconds = timer() - start
+        print("numpy " + kind + ": " + format(seconds, ".2f") + " s, " + format(args.snps / seconds, ".0f") + " SNPs/s")
+        if args.plink:
+            out = args.folder / ("plink_" + kind)
+            command = [args.plink, "--silent", "--bfile", str(prefix), "--pheno", str(args.folder / (kind + ".txt")), "--covar", str(args.folder / "covar.txt"),
+                       "--covar-name", ",".join(covar_names), "--hide-covar", "--" + kind, "--ci", "0.95", "--allow-no-sex", "--out", str(out)]
+            start = timer()
+            subprocess.call(command)
+            seconds = timer() - start
+            print("plink " + kind + ": " + format(seconds, ".2f") + " s, " + format(args.snps / seconds, ".0f") + " SNPs/s")
+            plink_file = str(out) + ".assoc." + kind
+            if os.path.exists(plink_file):
+                print("numpy vs plink " + kind + ": " + str(compare(str(args.folder / ("numpy_" + kind)) + ".assoc." + kind, plink_file, effect)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+from timeit import default_timer as timer
+from pathlib import Path
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from lib.genotype import pack_2bit
+from lib.ld import ld_prune
+
+# Benchmark of the native LD pruning (lib/ld.py) against plink --indep-pairwise 50 5 0.2
+# on a synthetic PLINK binary file set with LD blocks, eg:
+#   python benchmarks/ld_benchmark.py --samples 5000 --snps 100000 --chrs 2 --plink .\plink
+
+def make_dataset(folder: Path, samples: int, snps: int, chrs: int, seed: int):
+    # SNPs copy the haplotypes of their LD block with random mutations (1% missing calls),
+    # a new block starts with probability 0.1
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    prefix = folder / "bench"
+    with open(str(prefix) + ".bed", 'wb') as f:
+        f.write(bytes([0x6c, 0x1b, 0x01]))
+        haplotypes = rng.random((2, samples)) < 0.3
+        for start in range(0, snps, 10000):
+            stop = min(start + 10000, snps)
+            values = np.empty((stop - start, samples), dtype=np.uint8)
+            for k in range(stop - start):
+                if rng.random() < 0.1:
+                    haplotypes = rng.random((2, samples)) < rng.uniform(0.05, 0.5)
+                dosage = (haplotypes ^ (rng.random((2, samples)) < rng.uniform(0, 0.3))).sum(axis=0)
+                # .bed 2-bit values: 2 copies of A1 -> 0, het -> 2, 0 copies -> 3, missing -> 1
+                values[k] = np.choose(dosage, [3, 2, 0])
+            values[rng.random(values.shape) < 0.01] = 1
+            f.write(np.ascontiguousarray(pack_2bit(values)).tobytes())
+    chr = np.repeat(np.arange(1, chrs + 1), -(-snps // chrs))[:snps]
+    pd.DataFrame({'CHR': chr, 'SNP': ["rs" + str(i) for i in range(snps)], 'CM': 0, 'BP': np.arange(snps) * 100 + 1, 'A1': 'A', 'A2': 'G'}).to_csv(str(prefix) + ".bim", sep="\t", header=False, index=False)
+    pd.DataFrame({'FID': 0, 'IID': ["S" + str(i) for i in range(samples)], 'PAT': 0, 'MAT': 0, 'SEX': rng.integers(1, 3, samples), 'P': -9}).to_csv(str(prefix) + ".fam", sep=" ", header=False, index=False)
+    return prefix
+
+def compare(native_file: str, plink_file: str):
+    with open(native_file) as f:
+        ours = set(f.read().split())
+    with open(plink_file) as f:
+        theirs = set(f.read().split())
+    return {"native_prune_in": len(ours), "plink_prune_in": len(theirs), "only_native": len(ours - theirs), "only_plink": len(theirs - ours), "equal": ours == theirs}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the native LD pruning against plink --indep-pairwise")
+    parser.add_argument("--samples", type=int, default=2000, help="Number of samples (default: 2000)")
+    parser.add_argument("--snps", type=int, default=20000, help="Number of SNPs (default: 20000)")
+    parser.add_argument("--chrs", type=int, default=1, help="Number of chromosomes (default: 1)")
+    parser.add_argument("--memory", type=int, default=256, help="Memory budget (MB) of the native pruning (default: 256)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--folder", type=Path, default=Path("ld_benchmark"), help="Working folder (default: ld_benchmark)")
+    parser.add_argument("--plink", type=str, help="Path to plink 1.9, runs and compares the plink path if given")
+    args = parser.parse_args()
+
+    prefix = make_dataset(args.folder, args.samples, args.snps, args.chrs, args.seed)
+    print("Dataset: " + str(args.samples) + " samples, " + str(args.snps) + " SNPs on " + str(args.chrs) + " chr.")
+    start = timer()
+    ld_prune(prefix, args.folder / "native", memory_mb=args.memory)
+    seconds = timer() - start
+    print("native: " + format(seconds, ".2f") + " s, " + format(args.snps / seconds, ".0f") + " SNPs/s")
+    if args.plink:
+        out = args.folder / "plink"
+        command = [args.plink, "--silent", "--bfile", str(prefix), "--indep-pairwise", "50", "5", "0.2", "--allow-no-sex", "--out", str(out)]
+        start = timer()
+        subprocess.call(command)
+        seconds = timer() - start
+        print("plink: " + format(seconds, ".2f") + " s, " + format(args.snps / seconds, ".0f") + " SNPs/s")
+        if os.path.exists(str(out) + ".prune.in"):
+            print("native vs plink: " + str(compare(str(args.folder / "native") + ".prune.in", str(out) + ".prune.in")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import argparse
+from timeit import default_timer as timer
+from datetime import datetime
+from pathlib import Path
+import ctypes
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from synthetic import make_dataset
+from lib.transform import make_reduce_file, make_map_file, make_ped_file, make_bed_file
+from lib.catalog import update_catalog, catalog_path
+from lib.filter import dataset_ID_filter, pheno_ID_filters, snp_map_filter
+from lib.select import select_reduce_by_id, selected_chr_SNP_map
+from lib.merge import merge_temp_file
+from lib.snpmap import snp_map_ranges
+from lib.store import build_genotype_store
+from lib.qc import genotype_qc
+from lib.ld import ld_prune
+from lib.assoc import run_assoc
+from lib.plot import plot_assoc
+
+# Benchmark of every stage of the pipeline on a seeded synthetic dataset (benchmarks/synthetic.py):
+# each lib/ function runs on its own in a new process (time and peak memory), then the two scripts end to end
+# with local stand-ins of plink and Rscript (benchmarks/standin_plink.py, standin_rscript.py).
+# The results are written to a JSON file, --compare lists the changes against the JSON of another commit, eg:
+#   python benchmarks/pipeline_benchmark.py --snps 100000 --samples 500 --files 4
+#   python benchmarks/pipeline_benchmark.py --snps 100000 --samples 500 --files 4 --compare pipeline_benchmark/benchmark_1a2b3c4.json
+# Stages run in order on the files of the stages before them, --stages runs some of them again on the files
+# of an earlier run in the same folder.
+
+def work_files(folder: Path, chr: str):
+    # Inputs and outputs of the stages, as the pipeline names them
+    data = folder / "data"
+    work = folder / "work"
+    return {
+        "matrix_folder": data / "Matrix", "SNP_map_file": data / "SNP_map.csv", "patient_file": data / "patient.csv",
+        "reduce_folder": work / "reduce", "catalog_file": catalog_path(work / "reduce"),
+        "patient_cache_folder": work / "patient_cache", "ID_file": work / "patient_ID_list.csv", "BMI_file": work / "patient_BMI_list.csv", "DM_file": work / "patient_DM_list.csv",
+        "sorted_map_file": work / "SNP_map_sorted.parquet",
+        "temp_folder": work / "temp", "merged_folder": work / "merged", "store_folder": work / "store",
+        "snp_qc_file": work / "patient_snp_qc.parquet", "sample_qc_file": work / "patient_sample_qc.parquet",
+        "chr_map_file": work / ("chr" + chr + "_SNP_map.csv"),
+        "map_file": work / ("chr" + chr + ".map"), "ped_file": work / ("chr" + chr + ".ped"), "bed_prefix": work / ("chr" + chr),
+        "assoc_prefix": work / ("chr" + chr + "_BMI"), "plot_folder": work / "plot",
+        "e2e_folder": folder / "e2e"}
+
+def stage_list(files: dict, args):
+    # name, benchmarked function, outputs removed before the run, the call
+    chr = args.chr
+    ranges = lambda: snp_map_ranges(files["sorted_map_file"])
+    return [
+        ("reduce", "make_reduce_file", [files["reduce_folder"]],
+         lambda: (Path(files["reduce_folder"]).mkdir(parents=True),
+                  make_reduce_file(files["matrix_folder"], 9, args.reduce_chunk_size, files["reduce_folder"]))),
+        ("catalog", "update_catalog", [files["catalog_file"]], lambda: update_catalog(files["reduce_folder"])),
+        # the dataset ID filter parses the patient file into its parquet copy, the phenotype ID filters read from it
+        ("dataset ID", "dataset_ID_filter", [files["ID_file"], files["patient_cache_folder"]],
+         lambda: dataset_ID_filter(files["patient_file"], "ID", files["ID_file"], files["patient_cache_folder"])),
+        ("phenotype ID", "pheno_ID_filters", [files["BMI_file"], files["DM_file"]],
+         lambda: pheno_ID_filters(files["patient_file"], "ID", [["BMI", "continuous"], ["DM", "category"]], [files["BMI_file"], files["DM_file"]],
+                                  files["patient_cache_folder"])),
+        ("sorted SNP map", "snp_map_filter", [files["sorted_map_file"]],
+         lambda: snp_map_filter(files["SNP_map_file"], files["sorted_map_file"])),
+        ("select", "select_reduce_by_id", [files["temp_folder"]],
+         lambda: (Path(files["temp_folder"]).mkdir(parents=True), select_reduce_by_id(files["reduce_folder"], files["ID_file"], files["temp_folder"]))),
+        ("merge", "merge_temp_file", [files["merged_folder"]],
+         lambda: (Path(files["merged_folder"]).mkdir(parents=True),
+                  merge_temp_file(files["temp_folder"], files["merged_folder"], files["sorted_map_file"], args.merge_size))),
+        ("genotype store", "build_genotype_store", [files["store_folder"]],
+         lambda: build_genotype_store(files["merged_folder"], files["sorted_map_file"], files["store_folder"])),
+        ("genotype QC", "genotype_qc", [files["snp_qc_file"], files["sample_qc_file"]],
+         lambda: genotype_qc(files["store_folder"], files["sorted_map_file"], ranges(), list(ranges()), args.chunk_size,
+                             0.05, 0.05, 0.05, 0.000001, files["snp_qc_file"], files["sample_qc_file"])),
+        ("chr SNP map", "selected_chr_SNP_map", [files["chr_map_file"]],
+         lambda: selected_chr_SNP_map(chr, files["sorted_map_file"], files["chr_map_file"])),
+        ("map", "make_map_file", [files["map_file"]], lambda: make_map_file(files["chr_map_file"], files["map_file"])),
+        ("ped", "make_ped_file", [files["ped_file"]],
+         lambda: make_ped_file(files["store_folder"], chr, files["chr_map_file"], files["ID_file"], files["ped_file"])),
+        ("bed", "make_bed_file", [Path(str(files["bed_prefix"]) + ext) for ext in [".bed", ".bim", ".fam"]],
+         lambda: make_bed_file(files["store_folder"], chr, files["chr_map_file"], files["ID_file"], None, args.chunk_size, files["bed_prefix"])),
+        ("LD prune", "ld_prune", [Path(str(files["bed_prefix"]) + ext) for ext in [".prune.in", ".prune.out"]],
+         lambda: ld_prune(files["bed_prefix"], files["bed_prefix"])),
+        ("association", "run_assoc", [Path(str(files["assoc_prefix"]) + ext) for ext in [".assoc.linear", ".assoc.linear.parquet"]],
+         lambda: run_assoc(files["bed_prefix"], files["BMI_file"], "linear", files["assoc_prefix"])),
+        ("plots", "plot_assoc", [files["plot_folder"]],
+         lambda: (Path(files["plot_folder"]).mkdir(parents=True),
+                  plot_assoc(str(files["assoc_prefix"]) + r".assoc.linear", "BMI", files["plot_folder"] / "BMI_plot_manhattan.tiff",
+                             files["plot_folder"] / "BMI_plot_qq.tiff", files["plot_folder"] / "BMI_Top_SNPs.csv"))),
+        ("end to end: reduce", "SNP_matrix_to_reduce.py", [files["e2e_folder"] / "reduce"], lambda: run_script(files, args, "reduce")),
+        ("end to end: plink", "SNP_reduce_to_plink.py", [files["e2e_folder"] / "patient"], lambda: run_script(files, args, "plink"))]
+
+def standins(folder: Path):
+    # plink and Rscript stand-ins: the pipeline runs .\plink through the shell (found in cwd on Windows, on PATH
+    # as a file named .\plink elsewhere) and the Rscript of --rscript
+    bin_folder = folder / "bin"
+    bin_folder.mkdir(parents=True, exist_ok=True)
+    here = Path(__file__).resolve().parent
+    launchers = {}
+    for name, script, target in [("plink", "standin_plink.py", folder / "plink.bat" if sys.platform == "win32" else bin_folder / ".\\plink"),
+                                 ("Rscript", "standin_rscript.py", bin_folder / ("Rscript.bat" if sys.platform == "win32" else "Rscript"))]:
+        with open(target, 'w') as f:
+            if sys.platform == "win32":
+                f.write('@"' + sys.executable + '" "' + str(here / script) + '" %*\n')
+            else:
+                f.write('#!/bin/sh\nexec "' + sys.executable + '" "' + str(here / script) + '" "$@"\n')
+        os.chmod(target, 0o755)
+        launchers[name] = target
+    return bin_folder, launchers
+
+def run_script(files: dict, args, part: str):
+    # One script of the pipeline in e2e_folder, it prints its errors and exits 0: a run is finished only if it
+    # printed its last message
+    folder = Path(files["e2e_folder"]).resolve()
+    bin_folder, launchers = standins(folder)
+    if part == "reduce":
+        command = [sys.executable, str(ROOT / "SNP_matrix_to_reduce.py"), "--matrix_folder", str(Path(files["matrix_folder"]).resolve()),
+                   "--SNP_folder", str(folder / "reduce")]
+    else:
+        plot_engine = "python" if importlib.util.find_spec("matplotlib") is not None else "R"
+        command = [sys.executable, str(ROOT / "SNP_reduce_to_plink.py"), "--SNP_folder", str(folder / "reduce"),
+                   "--SNP_map", str(Path(files["SNP_map_file"]).resolve()), "--patient_file", str(Path(files["patient_file"]).resolve()),
+                   "--id_name", "ID", "--phenotype", "BMI,DM", "--type", "continuous,category", "--chunk_size", str(args.chunk_size),
+                   "--merge_size", str(args.merge_size), "--workers", str(args.workers), "--qc", "native", "--prune_engine", "native",
+                   "--assoc_engine", "numpy", "--plot_engine", plot_engine, "--rscript", str(launchers["Rscript"]),
+                   "--rfile", str(ROOT / "SNP_manhattan_top.R")] + shlex.split(args.e2e_args)
+    env = dict(os.environ, PATH=str(bin_folder) + os.pathsep + os.environ.get("PATH", ""))
+    output = subprocess.run(command, cwd=folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout
+    print(output)
+    if "All tasks were done!" not in output:
+        raise RuntimeError(output.strip().splitlines()[-1] if output.strip() else "no output")
+
+def peak_memory_mb():
+    # Peak resident memory (MB) of this process and of its finished child processes (POSIX only),
+    # pages of memory-mapped files read by the stage are counted too; None if it cannot be read
+    try:
+        if sys.platform == "win32":
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+            ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+            return counters.PeakWorkingSetSize / (1024 * 1024)
+        import resource
+        # ru_maxrss is in KB (bytes on macOS)
+        unit = 1 if sys.platform == "darwin" else 1024
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * unit / (1024 * 1024)
+    except (AttributeError, ImportError, OSError):
+        return None
+
+def remove(path: Path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def run_stage(name: str, files: dict, args, log_file: Path, results):
+    # Runs in a new process: the outputs of the stage are removed, then only its call is timed,
+    # the output of the stage goes to its log file
+    with open(log_file, 'w') as log:
+        sys.stdout.flush()
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = sys.stderr = log
+        stage = [s for s in stage_list(files, args) if s[0] == name][0]
+        for path in stage[2]:
+            remove(path)
+        base_mb = peak_memory_mb()
+        error = ""
+        start = timer()
+        try:
+            stage[3]()
+        except Exception as e:
+            error = type(e).__name__ + ": " + str(e)
+            print(error)
+        seconds = timer() - start
+        log.flush()
+    results.put({"seconds": seconds, "peak_mb": peak_memory_mb(), "base_mb": base_mb,
+                 "arrow_peak_mb": pa.default_memory_pool().max_memory() / (1024 * 1024), "error": error})
+
+def measure_stage(name: str, files: dict, args, log_file: Path):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(name, files, args, log_file, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {"seconds": None, "peak_mb": None, "base_mb": None, "arrow_peak_mb": None, "error": "exit code " + str(process.exitcode)}
+    return results.get()
+
+def dataset(folder: Path, args):
+    # The synthetic dataset is written again only if its parameters or the generator changed
+    with open(Path(__file__).resolve().parent / "synthetic.py", 'rb') as f:
+        generator = hashlib.sha256(f.read().replace(b"\r\n", b"\n")).hexdigest()[:16]
+    params = {"snps": args.snps, "samples": args.samples, "files": args.files, "seed": args.seed, "missing": args.missing, "generator": generator}
+    params_file = folder / "data" / "params.json"
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            if json.load(f) == params:
+                print("Synthetic dataset: reuse " + str(folder / "data"))
+                return params
+        shutil.rmtree(folder / "data")
+    start = timer()
+    make_dataset(folder / "data", args.snps, args.samples, args.files, args.seed, args.missing)
+    with open(params_file, 'w') as f:
+        json.dump(params, f)
+    print("Synthetic dataset: " + format(timer() - start, ".2f") + " s")
+    return params
+
+def git_commit():
+    # Commit of the benchmarked code and whether it has changes not committed, None outside a git repo
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        changed = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        return commit, bool(changed)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def value(number, digits: str = ".2f"):
+    return "-" if number is None else format(number, digits)
+
+def compare(old_file: Path, result: dict, tolerance: float):
+    # Stage by stage change of time and peak memory against an older result, returns the stages slower than tolerance
+    with open(old_file) as f:
+        old = json.load(f)
+    if old["params"] != result["params"]:
+        print("Warning: the results were run with other parameters: " + json.dumps(old["params"]))
+    old_stages = {stage["name"]: stage for stage in old["stages"]}
+    print("Compare with " + str(old_file) + " (commit " + str(old.get("commit")) + "):")
+    slower = []
+    for stage in result["stages"]:
+        before = old_stages.get(stage["name"])
+        if before is None or before["seconds"] is None or stage["seconds"] is None:
+            print("  " + stage["name"].ljust(24) + " not comparable")
+            continue
+        ratio = stage["seconds"] / max(before["seconds"], 1e-9)
+        flag = ""
+        if ratio > 1 + tolerance and stage["seconds"] - before["seconds"] > 0.05:
+            flag = "  SLOWER"
+            slower.append(stage["name"])
+        elif ratio < 1 - tolerance:
+            flag = "  faster"
+        print("  " + stage["name"].ljust(24) + value(before["seconds"]).rjust(9) + " s -> " + value(stage["seconds"]).rjust(9) + " s (x" + format(ratio, ".2f") + "), "
+              + value(before["peak_mb"], ".0f").rjust(6) + " MB -> " + value(stage["peak_mb"], ".0f").rjust(6) + " MB" + flag)
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline on a synthetic dataset")
+    parser.add_argument("--snps", type=int, default=100000, help="Number of SNPs (default: 100000)")
+    parser.add_argument("--samples", type=int, default=500, help="Samples per matrix file (default: 500)")
+    parser.add_argument("--files", type=int, default=2, help="Number of matrix files (default: 2)")
+    parser.add_argument("--missing", type=float, default=0.01, help="Rate of missing calls (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--chr", type=str, default="1", help="Chr of the chr-level stages (default: 1)")
+    parser.add_argument("--reduce_chunk_size", type=int, default=100000, help="--chunk_size of SNP_matrix_to_reduce.py (default: 100000)")
+    parser.add_argument("--chunk_size", type=int, default=50000, help="--chunk_size of SNP_reduce_to_plink.py (default: 50000)")
+    parser.add_argument("--merge_size", type=int, default=800, help="--merge_size of SNP_reduce_to_plink.py (default: 800)")
+    parser.add_argument("--workers", type=int, default=1, help="--workers of the end-to-end run (default: 1)")
+    parser.add_argument("--e2e_args", type=str, default="", help="More arguments of SNP_reduce_to_plink.py in the end-to-end run, eg \"--bed_writer plink\"")
+    parser.add_argument("--stages", type=str, help="Comma-delimited stages to run (default: all), eg \"merge,genotype store\"")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every stage, the fastest run is kept (default: 1)")
+    parser.add_argument("--folder", type=Path, default=Path("pipeline_benchmark"), help="Working folder (default: pipeline_benchmark)")
+    parser.add_argument("--output", type=Path, help="Results JSON file (default: <folder>/benchmark_<commit>.json)")
+    parser.add_argument("--compare", type=Path, help="Results JSON file of another commit to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Stages slower than the compared result by more than this ratio fail the run (default: 0.1)")
+    args = parser.parse_args()
+
+    folder = args.folder.resolve()
+    (folder / "work").mkdir(parents=True, exist_ok=True)
+    (folder / "logs").mkdir(parents=True, exist_ok=True)
+    files = work_files(folder, args.chr)
+    names = [stage[0] for stage in stage_list(files, args)]
+    selected = names if not args.stages else [name.strip() for name in args.stages.split(",")]
+    unknown = [name for name in selected if name not in names]
+    if unknown:
+        parser.error("unknown stages: " + ", ".join(unknown) + " (stages: " + ", ".join(names) + ")")
+    params = dataset(folder, args)
+
+    commit, changed = git_commit()
+    result = {"commit": commit, "changed": changed, "date": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+              "versions": {"numpy": np.__version__, "pandas": pd.__version__, "pyarrow": pa.__version__},
+              "params": dict(params, chr=args.chr, reduce_chunk_size=args.reduce_chunk_size, chunk_size=args.chunk_size,
+                             merge_size=args.merge_size, workers=args.workers, e2e_args=args.e2e_args),
+              "matrix_mb": sum(os.path.getsize(f) for f in files["matrix_folder"].iterdir()) / (1024 * 1024),
+              "stages": []}
+    for name in [name for name in names if name in selected]:
+        function = [stage[1] for stage in stage_list(files, args) if stage[0] == name][0]
+        if name == "plots" and importlib.util.find_spec("matplotlib") is None:
+            print(name.ljust(24) + " skipped (needs matplotlib)")
+            continue
+        log_file = folder / "logs" / (name.replace(" ", "_").replace(":", "") + r".log")
+        runs = [measure_stage(name, files, args, log_file) for _ in range(max(args.repeat, 1))]
+        best = min(runs, key=lambda run: float("inf") if run["seconds"] is None else run["seconds"])
+        stage = dict(best, name=name, function=function, runs=[run["seconds"] for run in runs])
+        result["stages"].append(stage)
+        added = None if stage["peak_mb"] is None or stage["base_mb"] is None else stage["peak_mb"] - stage["base_mb"]
+        print(name.ljust(24) + value(stage["seconds"]).rjust(9) + " s, peak " + value(stage["peak_mb"], ".0f").rjust(6) + " MB (+" + value(added, ".0f") + " MB)"
+              + (" FAILED: " + stage["error"] + " (see " + str(log_file) + ")" if stage["error"] else ""))
+
+    output = args.output or folder / ("benchmark_" + (commit[:7] if commit else "nogit") + r".json")
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print("Results: " + str(output))
+    if args.compare:
+        slower = compare(args.compare, result, args.tolerance)
+        if slower:
+            print("Slower stages: " + ", ".join(slower))
+            sys.exit(1)
+    if any(stage["error"] for stage in result["stages"]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import argparse
+from timeit import default_timer as timer
+from pathlib import Path
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from lib.plot import plot_assoc
+
+# Benchmark of the plots and top SNPs of Part 9 in process (lib/plot.py) on a synthetic association result
+# (uniform p-values plus a few hits), eg:
+#   python benchmarks/plot_benchmark.py --snps 10000000
+
+def make_assoc(folder: Path, snps: int, seed: int, text: bool):
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    assoc_file = folder / "bench.assoc.linear"
+    chr = np.repeat(np.arange(1, 23), -(-snps // 22))[:snps]
+    p = rng.random(snps)
+    hits = rng.choice(snps, min(snps, 100), replace=False)
+    p[hits] = 10 ** -rng.uniform(5, 20, len(hits))
+    assoc_df = pd.DataFrame({'CHR': chr, 'SNP': ["rs" + str(i) for i in range(snps)], 'BP': np.arange(snps) * 300 + 1, 'A1': 'A', 'TEST': 'ADD',
+                             'NMISS': 5000, 'BETA': rng.normal(0, 0.1, snps), 'SE': 0.1, 'L95': 0.0, 'U95': 0.0, 'STAT': 0.0, 'P': p})
+    assoc_df.to_csv(assoc_file, sep=" ", index=False)
+    if not text:
+        assoc_df.to_parquet(str(assoc_file) + r".parquet", index=False)
+    return assoc_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plots and top SNPs of Part 9 in process")
+    parser.add_argument("--snps", type=int, default=1000000, help="Number of SNPs (default: 1000000)")
+    parser.add_argument("--text", action="store_true", help="Read the plink text file instead of the parquet of the NumPy engine")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--folder", type=Path, default=Path("plot_benchmark"), help="Working folder (default: plot_benchmark)")
+    args = parser.parse_args()
+
+    assoc_file = make_assoc(args.folder, args.snps, args.seed, args.text)
+    print("Association result: " + str(args.snps) + " SNPs (" + ("text" if args.text else "parquet") + ").")
+    start = timer()
+    plot_assoc(assoc_file, "bench", args.folder / "bench_plot_manhattan.tiff", args.folder / "bench_plot_qq.tiff", args.folder / "bench_Top_SNPs.csv")
+    seconds = timer() - start
+    print("plots: " + format(seconds, ".2f") + " s, " + format(args.snps / seconds, ".0f") + " SNPs/s")
+
+if __name__ == "__main__":
+    main()
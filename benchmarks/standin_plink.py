@@ -0,0 +1,125 @@
+import sys
+from pathlib import Path
+import shutil
+import numpy as np
+import pandas as pd
+
+# Local stand-in of plink 1.9 for the end-to-end benchmark (the pipeline calls .\plink), it only knows the commands
+# of SNP_reduce_to_plink.py and writes files of the same format quickly, the results are not those of plink:
+#   --merge-list --make-bed:            .bed/.bim/.fam of the chr files (same samples) one after the other
+#   --indep-pairwise:                   every SNP is kept
+#   --linear / --logistic:              seeded uniform p-values of the SNPs
+#   --write-snplist --make-just-fam:    all SNPs (without --not-chr) and samples
+#   --clump:                            SNPs of the association file with P <= --clump-p1, one clump each
+#   --ped --map --make-bed:             the PED/MAP files as .bed/.bim/.fam
+# reports (--freqx, --missing) are written as empty files
+PRUNE_SKIP_CHR = ["0", "X", "Y", "XY", "23", "24", "25"]
+
+def option(args: list, name: str):
+    return args[args.index(name) + 1] if name in args else None
+
+def read_bim(prefix: str):
+    return pd.read_csv(prefix + r".bim", sep=r"\s+", header=None, names=['CHR', 'SNP', 'CM', 'BP', 'A1', 'A2'], dtype=str)
+
+def merge_list(args: list, out: str):
+    prefixes = [line.split()[0] for line in open(option(args, "--merge-list")) if line.strip()]
+    shutil.copy(prefixes[0] + r".fam", out + r".fam")
+    with open(out + r".bed", 'wb') as bed, open(out + r".bim", 'wb') as bim:
+        bed.write(bytes([0x6c, 0x1b, 0x01]))
+        for prefix in prefixes:
+            with open(prefix + r".bed", 'rb') as f:
+                f.seek(3)
+                shutil.copyfileobj(f, bed)
+            with open(prefix + r".bim", 'rb') as f:
+                shutil.copyfileobj(f, bim)
+
+def kept_snps(args: list, bfile: str):
+    bim = read_bim(bfile)
+    if "--not-chr" in args:
+        bim = bim[~bim['CHR'].str.upper().isin(PRUNE_SKIP_CHR)]
+    return bim
+
+def assoc(args: list, bfile: str, out: str):
+    kind = "linear" if "--linear" in args else "logistic"
+    bim = kept_snps(args, bfile)
+    rng = np.random.default_rng(len(bim))
+    n = len(open(bfile + r".fam").readlines())
+    p = rng.random(len(bim))
+    assoc_df = pd.DataFrame({'CHR': bim['CHR'], 'SNP': bim['SNP'], 'BP': bim['BP'], 'A1': bim['A1'], 'TEST': "ADD", 'NMISS': n,
+                             'BETA' if kind == "linear" else 'OR': 1.0, 'SE': 0.1, 'L95': 0.9, 'U95': 1.1, 'STAT': 0.0, 'P': p})
+    assoc_df.to_csv(out + r".assoc." + kind, sep=" ", index=False)
+
+def clump(args: list, out: str):
+    p1 = float(option(args, "--clump-p1") or 1e-4)
+    assoc_df = pd.read_csv(option(args, "--clump"), sep=r"\s+", na_values=["NA"])
+    top_df = assoc_df[assoc_df['P'] <= p1].sort_values(by="P")
+    if len(top_df) == 0:
+        return
+    with open(out + r".clumped", 'w') as f:
+        f.write(" CHR    F           SNP         BP        P    TOTAL   NSIG    S05    S01   S001  S0001    SP2\n")
+        for chr, snp, bp, p in zip(top_df['CHR'], top_df['SNP'], top_df['BP'], top_df['P']):
+            f.write(" ".join([str(chr), "1", str(snp), str(bp), format(p, "g"), "0", "0", "0", "0", "0", "0", "NONE"]) + "\n")
+        f.write("\n\n")
+
+def make_bed_from_ped(args: list, out: str):
+    map_df = pd.read_csv(option(args, "--map"), sep="\t", header=None, names=['CHR', 'SNP', 'CM', 'BP'], dtype=str)
+    families = []
+    calls = []
+    with open(option(args, "--ped")) as f:
+        for line in f:
+            fields = line.split()
+            families.append(fields[:6])
+            calls.append(fields[6:])
+    # samples x SNPs x 2 alleles, A1 = first allele seen, A2 = the other one
+    calls = np.array(calls, dtype="U1").reshape(len(families), len(map_df), 2)
+    called = calls != "0"
+    a1 = calls[np.argmax(called[:, :, 0], axis=0), np.arange(len(map_df)), 0]
+    other = (called & (calls != a1[None, :, None])).transpose(1, 0, 2).reshape(len(map_df), -1)
+    alleles = calls.transpose(1, 0, 2).reshape(len(map_df), -1)
+    a2 = np.where(other.any(axis=1), alleles[np.arange(len(map_df)), np.argmax(other, axis=1)], "0")
+    copies = (calls == a1[None, :, None]).sum(axis=2).T
+    # 2-bit values: 0 = 2 copies of A1, 2 = het, 3 = no copy, 1 = missing
+    values = np.choose(copies, [3, 2, 0]).astype(np.uint8)
+    values[~called[:, :, 0].T] = 1
+    width = (len(families) + 3) // 4
+    padded = np.zeros((len(map_df), width * 4), dtype=np.uint8)
+    padded[:, :len(families)] = values
+    padded = padded.reshape(len(map_df), width, 4)
+    packed = padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+    with open(out + r".bed", 'wb') as f:
+        f.write(bytes([0x6c, 0x1b, 0x01]))
+        f.write(packed.astype(np.uint8).tobytes())
+    pd.DataFrame({'CHR': map_df['CHR'], 'SNP': map_df['SNP'], 'CM': 0, 'BP': map_df['BP'], 'A1': a1, 'A2': a2}).to_csv(out + r".bim", sep="\t", header=False, index=False)
+    with open(out + r".fam", 'w') as f:
+        for fields in families:
+            f.write(" ".join(fields) + "\n")
+
+def main():
+    # paths are given as .\<path> (.\\<path> through cmd)
+    args = [arg[2:].lstrip("\\") if arg.startswith(".\\") else arg for arg in sys.argv[1:]]
+    out = option(args, "--out")
+    bfile = option(args, "--bfile")
+    Path(out).parent.mkdir(parents=True, exist_ok=True)
+    with open(out + r".log", 'w') as f:
+        f.write("plink stand-in " + " ".join(sys.argv[1:]) + "\n")
+    if "--merge-list" in args:
+        merge_list(args, out)
+    if "--ped" in args and "--make-bed" in args:
+        make_bed_from_ped(args, out)
+    for name, ext in [("--freqx", "frqx"), ("--missing", "lmiss"), ("--missing", "imiss")]:
+        if name in args:
+            open(out + r"." + ext, 'w').close()
+    if "--indep-pairwise" in args:
+        kept_snps(args, bfile)['SNP'].to_csv(out + r".prune.in", header=False, index=False)
+        open(out + r".prune.out", 'w').close()
+    if "--linear" in args or "--logistic" in args:
+        assoc(args, bfile, out)
+    if "--write-snplist" in args:
+        kept_snps(args, bfile)['SNP'].to_csv(out + r".snplist", header=False, index=False)
+    if "--make-just-fam" in args:
+        shutil.copy(bfile + r".fam", out + r".fam")
+    if "--clump" in args:
+        clump(args, out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+import pandas as pd
+
+# Local stand-in of Rscript SNP_manhattan_top.R for the end-to-end benchmark: writes the top SNPs file
+# (P <= 1e-5 sorted by P) of the association file in <dataset>/<phenotype>, the plots are empty files
+
+def main():
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    dataset, phenotype = options["dataset"], options["phenotype"]
+    assoc_analysis = "logistic" if options.get("type") == "category" else "linear"
+    folder = Path(dataset) / phenotype
+    name = dataset + "_" + phenotype
+    assoc_df = pd.read_csv(folder / (name + "_merged_QC_prune.assoc." + assoc_analysis), sep=r"\s+", na_values=["NA"]).dropna()
+    assoc_df[assoc_df['P'] <= 0.00001].sort_values(by="P").to_csv(folder / (name + "_Top_SNPs.csv"), index=False)
+    for plot in ["manhattan", "qq"]:
+        open(folder / (name + "_plot_" + plot + ".tiff"), 'wb').close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+from pathlib import Path
+import os
+import numpy as np
+import pandas as pd
+
+# Seeded synthetic dataset in the input formats of the pipeline, the same seed and scale always give the same files:
+#   Matrix/batch_<n>.txt: Illumina GenomeStudio matrix (9 header lines, tab-delimited sample IDs, one SNP per line,
+#                         calls as 'AG|0.8731', '--' for missing calls), rows in SNP name order
+#   SNP_map.csv:          chr,SNP_id,BP sorted by chr and BP
+#   patient.csv:          ID, Sex, Age, BMI (continuous) and DM (0/1) with a few causal SNPs, some missing values
+# eg python benchmarks/synthetic.py --snps 100000 --samples 500 --files 4 --folder synthetic
+HEADER_ROWS = 9
+# chr and its share of the SNPs (about the share of an Illumina array)
+CHR_WEIGHTS = {str(chr): weight for chr, weight in zip(range(1, 23), [8.0, 8.0, 6.6, 6.2, 6.0, 5.8, 5.2, 4.8, 4.2, 4.6, 4.6, 4.4, 3.4, 3.0, 2.8,
+                                                                        3.0, 2.6, 2.6, 2.0, 2.2, 1.2, 1.2])}
+CHR_WEIGHTS.update({"X": 3.0, "Y": 0.2, "XY": 0.1, "MT": 0.05})
+# allele pairs of the SNPs, indels are called I/D
+ALLELE_PAIRS = [("A", "G"), ("C", "T"), ("A", "C"), ("G", "T"), ("A", "T"), ("C", "G"), ("I", "D")]
+CAUSAL_SNPS = 10
+
+def make_snp_map(snps: int, seed: int):
+    # SNP_id, chr, BP of every SNP sorted by chr and BP, and its allele pair
+    rng = np.random.default_rng(seed)
+    chrs = list(CHR_WEIGHTS)
+    weights = np.array(list(CHR_WEIGHTS.values()))
+    chr = rng.choice(len(chrs), snps, p=weights / weights.sum())
+    bp = rng.integers(1, 250000000, snps)
+    order = np.lexsort((bp, chr))
+    snp_ids = rng.choice(np.arange(1, max(snps * 20, 1000000)), snps, replace=False)
+    return pd.DataFrame({'chr': np.array(chrs, dtype=object)[chr[order]], 'SNP_id': ["rs" + str(i) for i in snp_ids], 'BP': bp[order],
+                         'pair': rng.integers(0, len(ALLELE_PAIRS), snps)})
+
+def call_cells(pairs):
+    # Call of every (SNP, 0/1/2 copies of the 2nd allele, missing) as 2 bytes, SNPs x 4 x 2
+    cells = np.empty((len(pairs), 4, 2), dtype=np.uint8)
+    for i, (a, b) in enumerate(ALLELE_PAIRS):
+        at = pairs == i
+        for j, call in enumerate([a + a, a + b, b + b, "--"]):
+            cells[at, j] = np.frombuffer(call.encode(), dtype=np.uint8)
+    return cells
+
+def write_matrix_file(matrix_file: Path, snp_df: pd.DataFrame, samples: list, rng, missing: float, chunksize: int = 20000):
+    # One matrix file, returns the copies of the 2nd allele of the causal SNPs (causal SNPs x samples, -1 if missing)
+    n = len(samples)
+    maf = snp_df['maf'].to_numpy()
+    causal = snp_df['causal'].to_numpy()
+    dosage = np.full((causal.max() + 1, n), -1, dtype=np.int64)
+    with open(matrix_file, 'wb') as f:
+        for i in range(HEADER_ROWS):
+            f.write(("[Header] synthetic matrix, line " + str(i + 1) + "\r\n").encode())
+        f.write(("\t" + "\t".join(samples) + "\r\n").encode())
+        for start in range(0, len(snp_df), chunksize):
+            stop = min(start + chunksize, len(snp_df))
+            copies = rng.binomial(2, maf[start:stop, None], (stop - start, n))
+            copies[rng.random(copies.shape) < missing] = 3
+            rows = np.flatnonzero(causal[start:stop] >= 0)
+            dosage[causal[start:stop][rows]] = np.where(copies[rows] == 3, -1, copies[rows])
+            # fixed width cells: 2 bytes of the call, '|0.' and 4 digits of the GenCall score, then a tab (dropped at the line end)
+            block = np.empty((stop - start, n, 10), dtype=np.uint8)
+            block[:, :, 0:2] = call_cells(snp_df['pair'].to_numpy()[start:stop])[np.arange(stop - start)[:, None], copies]
+            block[:, :, 2:5] = np.frombuffer(b"|0.", dtype=np.uint8)
+            block[:, :, 5:9] = rng.integers(ord("0"), ord("9") + 1, (stop - start, n, 4), dtype=np.uint8)
+            block[:, :, 9] = ord("\t")
+            block = block.reshape(stop - start, n * 10)
+            names = snp_df['SNP_id'].iloc[start:stop]
+            for name, row in zip(names, block):
+                f.write(name.encode() + b"\t")
+                f.write(row[:-1].tobytes() + b"\r\n")
+            del copies, block
+    return dosage
+
+def make_dataset(folder: Path, snps: int, samples: int, files: int, seed: int = 1, missing: float = 0.01):
+    # Write the matrix files, SNP map and patient file to folder, returns their paths
+    folder = Path(folder)
+    matrix_folder = folder / "Matrix"
+    matrix_folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    snp_df = make_snp_map(snps, seed)
+    snp_df[['chr', 'SNP_id', 'BP']].to_csv(folder / "SNP_map.csv", index=False)
+
+    # the matrix lists the SNPs in name order as GenomeStudio, with an allele frequency and the causal SNPs
+    matrix_df = snp_df.sort_values(by="SNP_id", kind='stable').reset_index(drop=True)
+    matrix_df['maf'] = rng.uniform(0.05, 0.5, snps)
+    matrix_df['causal'] = -1
+    autosomal = np.flatnonzero(~matrix_df['chr'].isin(["X", "Y", "XY", "MT"]).to_numpy())
+    matrix_df.loc[rng.choice(autosomal, min(CAUSAL_SNPS, len(autosomal)), replace=False), 'causal'] = np.arange(min(CAUSAL_SNPS, len(autosomal)))
+
+    ids = []
+    dosage = []
+    for i in range(files):
+        names = ["S" + str(i * samples + j + 1).zfill(len(str(files * samples))) for j in range(samples)]
+        print("Writing matrix file " + str(i + 1) + " of " + str(files) + ": " + str(snps) + " SNPs x " + str(samples) + " samples")
+        dosage.append(write_matrix_file(matrix_folder / ("batch_" + str(i + 1).zfill(2) + r".txt"), matrix_df, names, rng, missing))
+        ids += names
+    dosage = np.concatenate(dosage, axis=1).astype(np.float64)
+    dosage[dosage < 0] = np.nan
+
+    # phenotypes with effects of the causal SNPs (large for the first ones so that a few SNPs pass 5e-8 even with
+    # small scales, missing calls count as the mean), a few missing values
+    n = len(ids)
+    effects = 3 * 0.7 ** np.arange(len(dosage))
+    score = np.nansum((dosage - np.nanmean(dosage, axis=1, keepdims=True)) * effects[:, None], axis=0)
+    sex = rng.integers(0, 2, n)
+    age = rng.integers(20, 80, n)
+    bmi = 24 + score + 0.02 * (age - 50) + rng.normal(0, 2, n)
+    dm = (rng.random(n) < 1 / (1 + np.exp(-(-1.0 + score)))).astype(float)
+    bmi[rng.random(n) < 0.02] = np.nan
+    dm[rng.random(n) < 0.02] = np.nan
+    patient_df = pd.DataFrame({'ID': ids, 'Sex': np.where(sex == 1, "M", "F"), 'Age': age, 'BMI': np.round(bmi, 2), 'DM': dm})
+    patient_df['DM'] = patient_df['DM'].astype("Int64")
+    patient_df.to_csv(folder / "patient.csv", index=False)
+    return {"matrix_folder": matrix_folder, "snp_map_file": folder / "SNP_map.csv", "patient_file": folder / "patient.csv",
+            "matrix_bytes": sum(os.path.getsize(f) for f in matrix_folder.iterdir())}
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic dataset (matrix files, SNP map, patient file)")
+    parser.add_argument("--snps", type=int, default=100000, help="Number of SNPs (default: 100000)")
+    parser.add_argument("--samples", type=int, default=500, help="Samples per matrix file (default: 500)")
+    parser.add_argument("--files", type=int, default=2, help="Number of matrix files (default: 2)")
+    parser.add_argument("--missing", type=float, default=0.01, help="Rate of missing calls (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--folder", type=Path, default=Path("synthetic"), help="Output folder (default: synthetic)")
+    args = parser.parse_args()
+    make_dataset(args.folder, args.snps, args.samples, args.files, args.seed, args.missing)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+from pathlib import Path
+from statistics import NormalDist
+import gc
+import math
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lib.trace import span
+
+# In-process association tests on PLINK binary files (same tests as plink --linear / --logistic --ci --hide-covar):
+# genotypes are read from the .bed in SNP blocks as A1 dosages, every SNP of a block is fitted at once
+
+# .bed byte -> A1 dosage (0 if missing) and observed flag of its 4 samples
+# (2-bit values: 0 = hom A1, 1 = missing, 2 = het, 3 = hom A2, first sample in the lowest bits)
+BYTE_VALUES = (np.arange(256)[:, None] >> np.array([0, 2, 4, 6])) & 3
+BYTE_DOSAGE = np.array([2.0, 0.0, 1.0, 0.0])[BYTE_VALUES]
+BYTE_OBSERVED = np.array([1.0, 0.0, 1.0, 1.0])[BYTE_VALUES]
+ASSOC_COLUMNS = ['CHR', 'SNP', 'BP', 'A1', 'TEST', 'NMISS', 'BETA', 'SE', 'L95', 'U95', 'STAT', 'P']
+# column widths of the plink text output
+ASSOC_WIDTHS = [4, 10, 10, 4, 10, 8, 10, 10, 10, 10, 12, 12]
+LGAMMA = np.vectorize(math.lgamma, otypes=[float])
+ERFC = np.vectorize(math.erfc, otypes=[float])
+
+def read_bim(bed_prefix: Path):
+    return pd.read_csv(str(bed_prefix) + r".bim", sep=r"\s+", header=None, names=['CHR', 'SNP', 'CM', 'BP', 'A1', 'A2'],
+                       dtype={'CHR': str, 'SNP': str, 'CM': str, 'BP': np.int64, 'A1': str, 'A2': str})
+
+def read_fam(fam_file: Path):
+    return pd.read_csv(fam_file, sep=r"\s+", header=None, names=['FID', 'IID', 'PAT', 'MAT', 'SEX', 'PHENOTYPE'], dtype=str)
+
+def read_bed_dosage(bed, snps, samples: int, sample_index):
+    # A1 dosage (0 if missing) and observed flag (SNPs x samples) of a SNP block of a memory-mapped .bed,
+    # sample_index None keeps all samples
+    packed = np.asarray(bed[snps])
+    g = np.take(BYTE_DOSAGE, packed, axis=0).reshape(len(packed), -1)[:, :samples]
+    w = np.take(BYTE_OBSERVED, packed, axis=0).reshape(len(packed), -1)[:, :samples]
+    if sample_index is not None:
+        g = g[:, sample_index]
+        w = w[:, sample_index]
+    return g, w
+
+def betainc(a, b, x):
+    # Regularized incomplete beta function I_x(a, b), element-wise, by its continued fraction (modified Lentz)
+    a, b, x = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float), np.asarray(x, dtype=float))
+    flip = x > (a + 1) / (a + b + 2)
+    a, b, x = np.where(flip, b, a), np.where(flip, a, b), np.where(flip, 1 - x, x)
+    tiny = 1e-300
+    with np.errstate(divide='ignore', invalid='ignore'):
+        front = np.exp(a * np.log(x) + b * np.log1p(-x) - np.log(a) - (LGAMMA(a) + LGAMMA(b) - LGAMMA(a + b)))
+        c = np.ones(x.shape)
+        d = 1 - (a + b) * x / (a + 1)
+        d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+        h = d.copy()
+        done = (x <= 0)
+        for m in range(1, 100000):
+            for aa in (m * (b - m) * x / ((a - 1 + 2 * m) * (a + 2 * m)), -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 1 + 2 * m))):
+                d = 1 + aa * d
+                d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+                c = 1 + aa / c
+                c = np.where(np.abs(c) < tiny, tiny, c)
+                delta = d * c
+                h = np.where(done, h, h * delta)
+            done |= np.abs(delta - 1) < 1e-15
+            if done.all():
+                break
+        value = np.where(x <= 0, 0.0, front * h)
+    return np.where(flip, 1 - value, value)
+
+def t_two_sided_p(t, df):
+    # P(|T| >= |t|) of Student's t distribution with df degrees of freedom
+    t = np.asarray(t, dtype=float)
+    df = np.broadcast_to(np.asarray(df, dtype=float), t.shape)
+    p = np.full(t.shape, np.nan)
+    valid = np.isfinite(t) & (df > 0)
+    p[valid] = betainc(df[valid] / 2, 0.5, df[valid] / (df[valid] + t[valid] ** 2))
+    return p
+
+def z_two_sided_p(z):
+    z = np.asarray(z, dtype=float)
+    p = np.full(z.shape, np.nan)
+    valid = np.isfinite(z)
+    p[valid] = ERFC(np.abs(z[valid]) / math.sqrt(2))
+    return p
+
+def pairwise_columns(covars):
+    # (samples, k*(k+1)/2) products of the covariate column pairs i <= j, C' diag(w) C of many weights w is one matmul
+    i, j = np.triu_indices(covars.shape[1])
+    return covars[:, i] * covars[:, j]
+
+def symmetric_matrices(upper, k: int):
+    # (m, k*(k+1)/2) upper triangles -> (m, k, k) symmetric matrices
+    i, j = np.triu_indices(k)
+    matrices = np.empty((upper.shape[0], k, k))
+    matrices[:, i, j] = upper
+    matrices[:, j, i] = upper
+    return matrices
+
+def solve_batch(A, B):
+    # Solve many small systems, pseudo-inverse for the singular ones
+    try:
+        return np.linalg.solve(A, B)
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(A) @ B
+
+def linear_assoc(y, covars, g, w):
+    # Least squares of y ~ covars + dosage for every SNP (row of g, w = observed), samples missing a genotype are left
+    # out of that SNP only; the covariates are projected out of each SNP by its own normal equations (Frisch-Waugh-Lovell)
+    n, k = covars.shape
+    m = g.shape[0]
+    # sums over the observed samples of each SNP = sums over all samples - sums over its missing samples (few)
+    rows, cols = np.nonzero(w == 0)
+    def observed_sums(values):
+        missing = np.stack([np.bincount(rows, weights=values[cols, q], minlength=m) for q in range(values.shape[1])], axis=1)
+        return values.sum(axis=0) - missing
+    CC = symmetric_matrices(observed_sums(pairwise_columns(covars)), k)
+    Cg = g @ covars
+    Cy = observed_sums(covars * y[:, None])
+    sol = solve_batch(CC, np.stack([Cg, Cy], axis=2))
+    gg = np.einsum('ij,ij->i', g, g)
+    s_gg = gg - (Cg * sol[:, :, 0]).sum(axis=1)
+    s_gy = (g @ y) - (Cg * sol[:, :, 1]).sum(axis=1)
+    s_yy = observed_sums((y * y)[:, None])[:, 0] - (Cy * sol[:, :, 1]).sum(axis=1)
+    nmiss = n - np.bincount(rows, minlength=m)
+    df = nmiss - k - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # monomorphic SNPs (or collinear with the covariates) are NA
+        valid = (s_gg > 1e-8 * np.maximum(gg, 1)) & (df > 0)
+        beta = np.where(valid, s_gy / s_gg, np.nan)
+        rss = np.maximum(s_yy - beta * s_gy, 0)
+        se = np.where(valid, np.sqrt(rss / df / s_gg), np.nan)
+        stat = beta / se
+    return nmiss.astype(np.int64), beta, se, stat, t_two_sided_p(stat, df)
+
+def logistic_fit(y, covars, g, w, start, max_iter: int = 25, tol: float = 1e-6):
+    # Newton-Raphson (IRLS) of y ~ covars + g for every SNP (row of g) at once, returns coefficients, their covariance
+    # (inverse Hessian of the last iteration) and whether the fit converged; SNPs drop out once their step is below tol
+    n, k = covars.shape
+    m = g.shape[0]
+    CC = pairwise_columns(covars)
+    beta = np.tile(start, (m, 1))
+    H = np.zeros((m, k + 1, k + 1))
+    converged = np.zeros(m, dtype=bool)
+    idx = np.arange(m)
+    ga, wa = g, w
+    for _ in range(max_iter):
+        active = ~converged[idx]
+        if not active.any():
+            break
+        if not active.all():
+            # only gather the rows of the SNPs still iterating
+            idx, ga, wa = idx[active], ga[active], wa[active]
+        # p = 1 / (1 + exp(-eta)), in place
+        p = beta[idx, :k] @ covars.T
+        p += ga * beta[idx, k:]
+        np.clip(p, -30, 30, out=p)
+        np.negative(p, out=p)
+        np.exp(p, out=p)
+        p += 1
+        np.reciprocal(p, out=p)
+        r = y - p
+        r *= wa
+        grad = np.concatenate([r @ covars, np.einsum('ij,ij->i', r, ga)[:, None]], axis=1)
+        # IRLS weights p (1 - p) of the observed samples
+        r = 1 - p
+        r *= p
+        r *= wa
+        Hi = np.empty((len(idx), k + 1, k + 1))
+        Hi[:, :k, :k] = symmetric_matrices(r @ CC, k)
+        r *= ga
+        Hi[:, :k, k] = Hi[:, k, :k] = r @ covars
+        Hi[:, k, k] = np.einsum('ij,ij->i', r, ga)
+        H[idx] = Hi
+        step = solve_batch(Hi, grad[:, :, None])[:, :, 0]
+        beta[idx] += step
+        converged[idx] = np.abs(step).max(axis=1) < tol
+    return beta, np.linalg.pinv(H), converged
+
+def logistic_null(y, covars, max_iter: int = 25, tol: float = 1e-6):
+    # Logistic regression of y on the covariates only, the start of every SNP fit
+    beta = np.zeros(covars.shape[1])
+    for _ in range(max_iter):
+        p = 1 / (1 + np.exp(-np.clip(covars @ beta, -30, 30)))
+        step = np.linalg.lstsq(covars.T @ (covars * (p * (1 - p))[:, None]), covars.T @ (y - p), rcond=None)[0]
+        beta += step
+        if np.abs(step).max() < tol:
+            break
+    return beta
+
+def logistic_assoc(y, covars, g, w, null_beta):
+    # Logistic regression of y (0/1) ~ covars + dosage for every SNP (row of g, w = observed), Wald test of the dosage
+    n, k = covars.shape
+    nmiss = w.sum(axis=1)
+    beta, cov, converged = logistic_fit(y, covars, g, w, np.append(null_beta, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # genotype variance of the observed samples, monomorphic SNPs are NA
+        mean = g.sum(axis=1) / nmiss
+        variance = np.einsum('ij,ij->i', g, g) / nmiss - mean * mean
+        se = np.sqrt(cov[:, k, k])
+        valid = converged & np.isfinite(beta[:, k]) & (se > 0) & (nmiss > k + 1) & (variance > 1e-8)
+        b = np.where(valid, beta[:, k], np.nan)
+        se = np.where(valid, se, np.nan)
+        stat = b / se
+    return nmiss.astype(np.int64), b, se, stat, z_two_sided_p(stat)
+
+def read_assoc_samples(bed_prefix: Path, pheno_file: Path, kind: str, covar_file: Path = None, covar_names: list = None, sample_file: Path = None):
+    # Samples of the .fam with a phenotype (and all covariates, and in sample_file if given), like plink:
+    # phenotype from pheno_file (FID ID P, -9 missing; 1/2 control/case for logistic), covariates -9 missing
+    fam = read_fam(str(bed_prefix) + r".fam")
+    pheno = pd.read_csv(pheno_file, sep=r"\s+", header=None, names=['FID', 'IID', 'P'], dtype={'IID': str})
+    pheno = pd.to_numeric(fam['IID'].map(dict(zip(pheno['IID'], pheno['P']))), errors='coerce').to_numpy(dtype=float)
+    keep = np.isfinite(pheno) & (pheno != -9)
+    if kind == "logistic":
+        keep &= np.isin(pheno, [1, 2])
+    covars = [np.ones(len(fam))]
+    if covar_file is not None and covar_names:
+        covar_df = pd.read_csv(covar_file, sep=r"\s+", dtype={'IID': str})
+        covar_df = covar_df.drop_duplicates(subset=['IID']).set_index('IID')
+        for name in covar_names:
+            values = pd.to_numeric(fam['IID'].map(covar_df[name]), errors='coerce').to_numpy(dtype=float)
+            keep &= np.isfinite(values) & (values != -9)
+            covars.append(values)
+    if sample_file is not None:
+        keep &= fam['IID'].isin(read_fam(sample_file)['IID']).to_numpy()
+    sample_index = np.flatnonzero(keep)
+    covars = np.column_stack(covars)[sample_index]
+    # center the covariates (not the intercept), only the SNP coefficient is reported
+    covars[:, 1:] -= covars[:, 1:].mean(axis=0)
+    y = pheno[sample_index]
+    if kind == "logistic":
+        y = (y == 2).astype(float)
+    return len(fam), sample_index, y, covars
+
+def assoc_column_names(kind: str):
+    return ["OR" if name == "BETA" and kind == "logistic" else name for name in ASSOC_COLUMNS]
+
+def assoc_text_header(kind: str, snp_width: int):
+    widths = ASSOC_WIDTHS[:1] + [max(ASSOC_WIDTHS[1], snp_width)] + ASSOC_WIDTHS[2:]
+    return " ".join(name.rjust(width) for name, width in zip(assoc_column_names(kind), widths))
+
+def assoc_text_lines(df: pd.DataFrame, kind: str, snp_width: int):
+    # Rows in the whitespace-aligned layout of plink .assoc.linear / .assoc.logistic (4 significant digits)
+    widths = ASSOC_WIDTHS[:1] + [max(ASSOC_WIDTHS[1], snp_width)] + ASSOC_WIDTHS[2:]
+    lines = None
+    for name, width in zip(assoc_column_names(kind), widths):
+        values = df[name]
+        if values.dtype.kind == 'f':
+            values = values.map(lambda v: 'NA' if not np.isfinite(v) else format(v, '.4g'))
+        values = values.astype(str).str.rjust(width)
+        lines = values if lines is None else lines + " " + values
+    return lines
+
+def run_assoc(bed_prefix: Path, pheno_file: Path, kind: str, output_prefix: Path, covar_file: Path = None, covar_names: list = None,
+              snp_list_file: Path = None, sample_file: Path = None, ci: float = 0.95, memory_mb: int = 512):
+    # Association of every SNP of the .bed (or of snp_list_file) with the phenotype, streamed block by block to
+    # <output_prefix>.assoc.<kind>.parquet and to the plink text file <output_prefix>.assoc.<kind>
+    bim = read_bim(bed_prefix)
+    samples, sample_index, y, covars = read_assoc_samples(bed_prefix, pheno_file, kind, covar_file, covar_names, sample_file)
+    snp_index = np.arange(len(bim))
+    if snp_list_file is not None:
+        snp_list = pd.read_csv(snp_list_file, header=None, names=['SNP'], dtype=str)['SNP']
+        snp_index = np.flatnonzero(bim['SNP'].isin(snp_list).to_numpy())
+    print("Association (" + kind + "): " + str(len(snp_index)) + " SNPs, " + str(len(sample_index)) + " samples, " + str(covars.shape[1] - 1) + " covariates.")
+
+    null_beta = logistic_null(y, covars) if kind == "logistic" else None
+    zt = NormalDist().inv_cdf(1 - (1 - ci) / 2)
+    # about 6 float arrays of block SNPs x samples are alive at the same time
+    block_size = max(1, int(memory_mb * 1024 * 1024 // (48 * max(len(sample_index), 1))))
+    bed = np.memmap(str(bed_prefix) + r".bed", dtype=np.uint8, mode='r', offset=3).reshape(len(bim), -1)
+    text_file = str(output_prefix) + r".assoc." + kind
+    parquet_file = text_file + r".parquet"
+    snp_width = int(bim['SNP'].str.len().max()) if len(bim) else 0
+    writer = None
+    with open(text_file, 'w', newline='\n') as text:
+        text.write(assoc_text_header(kind, snp_width) + '\n')
+        for start in range(0, len(snp_index), block_size):
+            block = snp_index[start:start + block_size]
+            with span("assoc block", kind=kind, rows=len(block), columns=len(sample_index), bytes_read=len(block) * bed.shape[1]) as record:
+                written = text.tell()
+                g, w = read_bed_dosage(bed, block, samples, None if len(sample_index) == samples else sample_index)
+                if kind == "logistic":
+                    nmiss, beta, se, stat, p = logistic_assoc(y, covars, g, w, null_beta)
+                    effect, low, high = np.exp(beta), np.exp(beta - zt * se), np.exp(beta + zt * se)
+                else:
+                    nmiss, beta, se, stat, p = linear_assoc(y, covars, g, w)
+                    effect, low, high = beta, beta - zt * se, beta + zt * se
+                df = pd.DataFrame({
+                    'CHR': bim['CHR'].to_numpy()[block], 'SNP': bim['SNP'].to_numpy()[block], 'BP': bim['BP'].to_numpy()[block],
+                    'A1': bim['A1'].to_numpy()[block], 'TEST': 'ADD', 'NMISS': nmiss,
+                    'OR' if kind == "logistic" else 'BETA': effect, 'SE': se, 'L95': low, 'U95': high, 'STAT': stat, 'P': p})
+                lines = assoc_text_lines(df, kind, snp_width)
+                text.write('\n'.join(lines) + '\n')
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(parquet_file, table.schema)
+                writer.write_table(table)
+                record["bytes_written"] = text.tell() - written + table.nbytes
+            del g, w, df, table
+            gc.collect()
+    if writer is not None:
+        writer.close()
+    del bed
+    print("Association results: " + text_file)
@@ -0,0 +1,112 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+
+# Stage cache of SNP_reduce_to_plink, saved in the dataset folder:
+#   stages: stage name -> key (hash of its input files and parameters) and its outputs
+#   files:  file path -> sha256 of its content, reused while mtime and size do not change
+# A stage runs again only if its key changed or one of the outputs it wrote is missing
+# (a stage may write fewer files than planned, eg no .clumped file if plink clumps no SNP).
+MANIFEST_NAME = "stage_manifest.json"
+
+def tmp_path(path: Path):
+    # Stages write to <output>.tmp and rename it when done, a half-written output is never reused
+    return Path(str(path) + r".tmp")
+
+def replace_output(temp: Path, path: Path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(temp, path)
+
+def replace_prefix(temp_prefix: Path, prefix: Path):
+    # Rename every <temp_prefix>.<ext> (eg plink --out <temp_prefix>) to <prefix>.<ext>
+    temp_prefix = Path(temp_prefix)
+    for f in sorted(temp_prefix.parent.glob(temp_prefix.name + r".*")):
+        os.replace(f, str(prefix) + f.name[len(temp_prefix.name):])
+
+def prefix_files(prefix: Path, extensions: list):
+    return [Path(str(prefix) + r"." + ext) for ext in extensions]
+
+class StageCache:
+    def __init__(self, manifest_file: Path, dry_run: bool = False):
+        self.manifest_file = Path(manifest_file)
+        self.dry_run = dry_run
+        self.manifest = {"stages": {}, "files": {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+        # stages to run in this round: name -> (inputs, params, outputs)
+        self.running = {}
+
+    def file_hash(self, file: Path):
+        stat = os.stat(file)
+        name = str(Path(file).resolve())
+        known = self.manifest["files"].get(name)
+        if known is not None and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+            return known["sha256"]
+        h = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                h.update(block)
+        self.manifest["files"][name] = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": h.hexdigest()}
+        return h.hexdigest()
+
+    def input_hash(self, path: Path):
+        # File: hash of its content; folder: hash of the names and contents of its files; None if missing
+        if os.path.isdir(path):
+            h = hashlib.sha256()
+            for f in sorted(p for p in Path(path).rglob("*") if p.is_file()):
+                h.update(f.relative_to(path).as_posix().encode())
+                h.update(self.file_hash(f).encode())
+            return h.hexdigest()
+        if os.path.exists(path):
+            return self.file_hash(path)
+        return None
+
+    def stage_key(self, inputs: list, params: dict):
+        key = {"inputs": [[str(p), self.input_hash(p)] for p in inputs], "params": params}
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def waiting(self, path: Path):
+        # Output of a stage that runs in this round (its content is not known yet)
+        path = Path(path).resolve()
+        for _, _, outputs in self.running.values():
+            for output in outputs:
+                output = Path(output).resolve()
+                if path == output or output in path.parents:
+                    return True
+        return False
+
+    def needs_run(self, stage: str, inputs: list, params: dict, outputs: list):
+        record = self.manifest["stages"].get(stage)
+        current = (record is not None
+                   and not any(self.waiting(p) for p in inputs)
+                   and all(os.path.exists(o) for o in record["outputs"])
+                   and record["key"] == self.stage_key(inputs, params))
+        if current:
+            print(("[dry-run] " if self.dry_run else "") + "Stage " + stage + " is up to date, skip.")
+            return False
+        self.running[stage] = (inputs, params, outputs)
+        if self.dry_run:
+            print("[dry-run] Stage " + stage + " would run.")
+            return False
+        return True
+
+    def done(self, stage: str, outputs: list = None):
+        # Record a finished stage, its key is taken from the inputs as they are now
+        inputs, params, planned = self.running.pop(stage)
+        outputs = planned if outputs is None else outputs
+        for output in outputs:
+            if not os.path.exists(output):
+                raise FileNotFoundError(output)
+        self.manifest["stages"][stage] = {"key": self.stage_key(inputs, params), "outputs": [str(o) for o in outputs]}
+        self.save()
+
+    def save(self):
+        Path(self.manifest_file.parent).mkdir(parents=True, exist_ok=True)
+        temp = tmp_path(self.manifest_file)
+        with open(temp, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(temp, self.manifest_file)
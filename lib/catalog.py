@@ -0,0 +1,70 @@
+from pathlib import Path
+import os
+import sqlite3
+from lib.genotype import reduce_file_format, reduce_file_samples
+
+# SQLite catalog of the reduced archive, saved in the reduce folder:
+#   files/samples: reduced file (mtime, size) and the sample ID -> file, column of it
+CATALOG_NAME = "catalog.sqlite"
+
+def catalog_path(reduce_folder: Path):
+    return Path(reduce_folder) / CATALOG_NAME
+
+def open_catalog(catalog_file: Path):
+    conn = sqlite3.connect(str(catalog_file))
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, format TEXT, samples INTEGER);
+        CREATE TABLE IF NOT EXISTS samples (sample_id TEXT, path TEXT, col INTEGER);
+        CREATE INDEX IF NOT EXISTS samples_id ON samples (sample_id);
+        CREATE INDEX IF NOT EXISTS samples_path ON samples (path);
+    ''')
+    # catalogs of earlier versions also kept a copy of the sorted SNP map, it is dropped once
+    old = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('snp_maps', 'snps', 'chr_ranges')")]
+    if old:
+        conn.executescript("".join("DROP TABLE " + name + ";" for name in old))
+        conn.execute("VACUUM")
+    return conn
+
+def file_stat(file: Path):
+    stat = os.stat(file)
+    return stat.st_mtime, stat.st_size
+
+def update_catalog(reduce_folder: Path):
+    # Add new or changed reduced files to the catalog and drop removed ones,
+    # a file is re-indexed only if its mtime or size changed
+    files = sorted(str(Path(f).resolve()) for f in Path(reduce_folder).iterdir() if f.match("*.parquet"))
+    conn = open_catalog(catalog_path(reduce_folder))
+    known = {path: (mtime, size) for path, mtime, size in conn.execute("SELECT path, mtime, size FROM files")}
+    updated = 0
+    with conn:
+        for path in set(known) - set(files):
+            conn.execute("DELETE FROM samples WHERE path = ?", (path,))
+            conn.execute("DELETE FROM files WHERE path = ?", (path,))
+        for path in files:
+            mtime, size = file_stat(path)
+            if known.get(path) == (mtime, size):
+                continue
+            samples = reduce_file_samples(path)
+            conn.execute("DELETE FROM samples WHERE path = ?", (path,))
+            conn.executemany("INSERT INTO samples VALUES (?, ?, ?)", [(str(sample), path, col) for col, sample in enumerate(samples)])
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (path, mtime, size, reduce_file_format(path), len(samples)))
+            updated += 1
+    removed = len(set(known) - set(files))
+    conn.close()
+    if updated or removed:
+        print("Catalog: indexed " + str(updated) + " new or changed files, removed " + str(removed) + " files.")
+    return updated
+
+def catalog_sample_index(reduce_folder: Path, ids: list = None):
+    # sample ID -> reduced file (first file by name if an ID is in several files),
+    # the catalog is refreshed first so stale entries are never used
+    update_catalog(reduce_folder)
+    conn = open_catalog(catalog_path(reduce_folder))
+    rows = conn.execute("SELECT sample_id, path FROM samples ORDER BY path, col").fetchall()
+    conn.close()
+    wanted = None if ids is None else set(ids)
+    sample_index = {}
+    for sample, path in rows:
+        if wanted is None or sample in wanted:
+            sample_index.setdefault(sample, path)
+    return sample_index
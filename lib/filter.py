@@ -1,131 +1,188 @@
-from pathlib import Path
+from pathlib import Path, PurePath
 import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
 import gc
+import hashlib
+from lib.snpmap import sort_snp_map, write_snp_map
 import os
 
-def snp_map_filter(SNP_map_file: Path, new_SNP_map_file: Path, new_SNP_map_range_file: Path):
+# The patient file (.xlsx / .sav / .csv) is parsed once and saved as <cache folder>/<name>_<sha256 of the file>.parquet,
+# the ID files read only the columns they need from it (default cache folder: <dataset folder>/patient_cache)
+PATIENT_CACHE_NAME = "patient_cache"
+patient_tables = {}
+
+def snp_map_filter(SNP_map_file: Path, new_SNP_map_file: Path):
+    # Sorted SNP map with its chr ranges as one parquet file (see lib/snpmap.py),
+    # the stage cache of SNP_reduce_to_plink only runs it again if the SNP map file changed
     print("Opening snp map file...")
-    snp_df = pd.read_csv(SNP_map_file)
-    snp_df['chr'] = snp_df['chr'].astype(object)
-    s = pd.to_numeric(snp_df['chr'],errors='coerce')
-    snp_df.loc[s.notna(),'chr'] = s.dropna().astype(int)
-    snp_df.sort_values(by=["chr","BP"], inplace=True, ascending=True)
-    snp_df.reset_index(drop=True, inplace=True)
+    snp_df = pd.read_csv(SNP_map_file, usecols=['chr', 'SNP_id', 'BP'], dtype={'chr': str, 'SNP_id': str})
+    snp_df, ranges = sort_snp_map(snp_df)
     print("Saving sorted snp map file...")
-    snp_df.to_csv(new_SNP_map_file, index=False)
-    result = (
-        snp_df.groupby("chr")
-        .apply(lambda group: pd.Series({"start": group.index[0], "end": group.index[-1]}))
-        .reset_index()
-    )
-    result.to_csv(new_SNP_map_range_file, index=False)
+    write_snp_map(snp_df, ranges, new_SNP_map_file)
 
-def dataset_ID_filter(patient_file: Path, patient_id: str, outputfilename: Path):
-    # function to return the file extension
-    print("Opening patient's file...")
+def read_patient_file(patient_file: Path):
     file_extension = Path(patient_file).suffix
     if file_extension == '.xlsx':
-        patient_df = pd.read_excel(patient_file)
+        return pd.read_excel(patient_file)
     elif file_extension == '.sav':
-        patient_df = pd.read_spss(patient_file, convert_categoricals=False)
+        return pd.read_spss(patient_file, convert_categoricals=False)
     elif file_extension == '.csv':
-        patient_df = pd.read_csv(patient_file)
-    
-    new_patient_df = pd.DataFrame()
-    new_patient_df['ID'] = patient_df[patient_id]
-    
+        return pd.read_csv(patient_file)
+    print("Wrong type of patient's file!! Must be xlsx, sav or csv!!")
+    os._exit(1)
+
+def patient_table_file(patient_file: Path, cache_folder: Path = None):
+    # Parquet copy of the patient file, made again only when the content of the file changes
+    stat = os.stat(patient_file)
+    known = (str(Path(patient_file).resolve()), stat.st_mtime, stat.st_size, str(cache_folder))
+    if known in patient_tables:
+        return patient_tables[known]
+    h = hashlib.sha256()
+    with open(patient_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            h.update(block)
+    if cache_folder is None:
+        cache_folder = PurePath(Path(patient_file).stem, PATIENT_CACHE_NAME)
+    name = Path(patient_file).stem
+    cache_file = Path(cache_folder) / (name + "_" + h.hexdigest()[:16] + r".parquet")
+    if not os.path.exists(cache_file):
+        print("Opening patient's file...")
+        patient_df = read_patient_file(patient_file)
+        patient_df.columns = [str(col) for col in patient_df.columns]
+        # parquet columns have one type, mixed columns (eg numbers and text in one Excel column) are saved as text
+        for col in patient_df.columns:
+            if patient_df[col].dtype == object and pd.api.types.infer_dtype(patient_df[col], skipna=True) in ["mixed", "mixed-integer"]:
+                patient_df[col] = patient_df[col].where(patient_df[col].isna(), patient_df[col].astype(str))
+        print("Saving patient's file as parquet: " + str(cache_file))
+        Path(cache_folder).mkdir(parents=True, exist_ok=True)
+        patient_df.to_parquet(str(cache_file) + r".tmp", index=False)
+        os.replace(str(cache_file) + r".tmp", cache_file)
+        # copies of older versions of the file
+        for old in Path(cache_folder).glob(name + "_" + "?" * 16 + r".parquet"):
+            if old != cache_file:
+                os.remove(old)
+        del patient_df
+        gc.collect()
+    patient_tables[known] = cache_file
+    return cache_file
+
+def patient_columns(patient_file: Path, cache_folder: Path = None):
+    return pq.read_schema(patient_table_file(patient_file, cache_folder)).names
+
+def load_patient_table(patient_file: Path, columns: list, cache_folder: Path = None):
+    # Only the given columns of the patient file (a column asked twice is read once)
+    return pd.read_parquet(patient_table_file(patient_file, cache_folder), columns=list(dict.fromkeys(columns)))
+
+def dataset_ID_filter(patient_file: Path, patient_id: str, outputfilename: Path, cache_folder: Path = None):
     # Create a mapping from uppercase column names to the original column names
-    uppercase_to_original_col = {col.upper(): col for col in patient_df.columns}
+    uppercase_to_original_col = {col.upper(): col for col in patient_columns(patient_file, cache_folder)}
     
     # Find matching columns using the mapping
     gender_verb_list = ['GENDER', 'SEX', 'S']
     male_verb_list = ['MALE', 'M']
-    matching_gender_column = [uppercase_to_original_col[uc_col] for uc_col in gender_verb_list if uc_col in uppercase_to_original_col][0]
+    matching_gender_column = [uppercase_to_original_col[uc_col] for uc_col in gender_verb_list if uc_col in uppercase_to_original_col]
 
     if not matching_gender_column:
         print('Cant find the gender column!')
         os._exit(1)
-    else:
-        # Male = 1, Female = 2
-        list_gender = patient_df[matching_gender_column].dropna().unique()
-        # if gender in numeric
-        if list_gender.max() == 1: # gender is in 0/1 form
-            print("The gender is in 0/1 form, changing to Male = 1, Female = 2. Fill null = -9.")
-            new_patient_df['S'] = patient_df[matching_gender_column].apply(lambda x: 2 if x == 0 else (1 if x == 1 else -9))
-        elif list_gender.max() == 2: # female is already 2
-            print("The gender is in mixed form, keep as original form. Fill null = -9.")
-            new_patient_df['S'] = patient_df[matching_gender_column]
-            new_patient_df['S'] = new_patient_df['S'].fillna(-9)
-        else: # gender in verb
-            print("The gender is string-like, changing to Male = 1, Female = 2.")
-            new_patient_df['Gender_upper'] = patient_df[matching_gender_column].astype(str).str.upper()
-            new_patient_df['S'] = new_patient_df['Gender_upper'].apply(lambda x: 1 if x in male_verb_list else (-9 if pd.isna(x) else 2))
-            new_patient_df.drop('Gender_upper', axis=1, inplace=True)
+    patient_df = load_patient_table(patient_file, [patient_id, matching_gender_column[0]], cache_folder)
+    gender = patient_df[matching_gender_column[0]]
+    new_patient_df = pd.DataFrame()
+    new_patient_df['ID'] = patient_df[patient_id]
+
+    # Male = 1, Female = 2
+    list_gender = gender.dropna().unique()
+    # if gender in numeric
+    if len(list_gender) and list_gender.max() == 1: # gender is in 0/1 form
+        print("The gender is in 0/1 form, changing to Male = 1, Female = 2. Fill null = -9.")
+        new_patient_df['S'] = np.where(gender == 1, 1, np.where(gender == 0, 2, -9))
+    elif len(list_gender) and list_gender.max() == 2: # female is already 2
+        print("The gender is in mixed form, keep as original form. Fill null = -9.")
+        new_patient_df['S'] = gender.fillna(-9)
+    else: # gender in verb
+        print("The gender is string-like, changing to Male = 1, Female = 2.")
+        new_patient_df['S'] = np.where(gender.astype(str).str.upper().isin(male_verb_list), 1, np.where(gender.isna(), -9, 2))
 
     # *Labels: ID S
     new_patient_df = new_patient_df.astype({"ID": str, "S": int})
     new_patient_df.drop_duplicates(subset=["ID"], inplace=True)
     print("Exporting file...")
     new_patient_df.to_csv(outputfilename, index=False)
-    del new_patient_df
+    del new_patient_df, patient_df
     gc.collect()
 
-def pheno_ID_filter(patient_file: Path, patient_id: str, phenotype: list, outputfilename: Path):
-    # function to return the file extension
-    print("Opening patient's file...")
-    file_extension = Path(patient_file).suffix
-    if file_extension == '.xlsx':
-        patient_df = pd.read_excel(patient_file)
-    elif file_extension == '.sav':
-        patient_df = pd.read_spss(patient_file, convert_categoricals=False)
-    elif file_extension == '.csv':
-        patient_df = pd.read_csv(patient_file)
+def pheno_ID_filter(patient_file: Path, patient_id: str, phenotype: list, outputfilename: Path, cache_folder: Path = None):
+    pheno_ID_filters(patient_file, patient_id, [phenotype], [outputfilename], cache_folder)
+
+def pheno_ID_filters(patient_file: Path, patient_id: str, phenotypes: list, outputfilenames: list, cache_folder: Path = None):
+    # One phenotype-based ID file per [phenotype, type], the ID and phenotype columns are read once
+    columns = patient_columns(patient_file, cache_folder)
+    patient_df = load_patient_table(patient_file, [patient_id] + [phenotype[0] for phenotype in phenotypes if phenotype[0] in columns], cache_folder)
     
-    new_patient_df = pd.DataFrame()
-    new_patient_df['ID'] = patient_df[patient_id]
+    for phenotype, outputfilename in zip(phenotypes, outputfilenames):
+        new_patient_df = pd.DataFrame()
+        new_patient_df['ID'] = patient_df[patient_id]
 
-    case_verb_list = ['CASE', 'YES', 'Y', '1']
-    if phenotype[0] not in patient_df.columns:
-        print('Cant find the phenotype in column! Current phenotype: ' + phenotype[0])
-        os._exit(1)
-    else:
-        new_patient_df[phenotype[0]] = patient_df[phenotype[0]]
-        if phenotype[1] == "category":
-            new_patient_df[phenotype[0]] = new_patient_df[phenotype[0]].astype(float)
-            list_pheno = new_patient_df[phenotype[0]].dropna().unique()
-            if len(list_pheno) > 2: # if phenotype is more than 2
-                print("The control/case group is not binary (eg 0/1), stop program.")
-                os._exit(1)
-            else:
-                # control = 1, case = 2
-                if list_pheno.max() == 1: 
-                    # if phenotype in numeric and 0/1 form
-                    print("Change the phenotype 0/1 to control = 1, case = 2, missing = -9.")
-                    new_patient_df['P'] = new_patient_df[phenotype[0]].apply(lambda x: 2 if x == 1 else (1 if x == 0 else -9))
-                elif list_pheno.max() == 2:
-                    print("The control/case group might be 1/2, keep original serial.")
-                    new_patient_df['P'] = new_patient_df[phenotype[0]]
-                else: 
-                    # if phenotype in verb
-                    print("The phenotype is string-like, changing the phenotype to control = 1, case = 2.")
-                    new_patient_df['Pheno_upper'] = new_patient_df[phenotype[0]].str.upper()
-                    new_patient_df['P'] = new_patient_df['Pheno_upper'].isin(case_verb_list).replace({True: 2, False: 1})
-                    new_patient_df.drop('Pheno_upper', axis=1, inplace=True)
-        elif phenotype[1] == "continuous":  
-            # if the phenotype is continuous
-            new_patient_df['P'] = new_patient_df[phenotype[0]]
-        else:
-            print("Wrong argument of type of phenotype!! Must be category or continuous!!")
+        case_verb_list = ['CASE', 'YES', 'Y', '1']
+        if phenotype[0] not in patient_df.columns:
+            print('Cant find the phenotype in column! Current phenotype: ' + phenotype[0])
             os._exit(1)
+        else:
+            new_patient_df[phenotype[0]] = patient_df[phenotype[0]]
+            if phenotype[1] == "category":
+                new_patient_df[phenotype[0]] = new_patient_df[phenotype[0]].astype(float)
+                list_pheno = new_patient_df[phenotype[0]].dropna().unique()
+                if len(list_pheno) > 2: # if phenotype is more than 2
+                    print("The control/case group is not binary (eg 0/1), stop program.")
+                    os._exit(1)
+                else:
+                    # control = 1, case = 2
+                    if list_pheno.max() == 1: 
+                        # if phenotype in numeric and 0/1 form
+                        print("Change the phenotype 0/1 to control = 1, case = 2, missing = -9.")
+                        new_patient_df['P'] = np.where(new_patient_df[phenotype[0]] == 1, 2, np.where(new_patient_df[phenotype[0]] == 0, 1, -9))
+                    elif list_pheno.max() == 2:
+                        print("The control/case group might be 1/2, keep original serial.")
+                        new_patient_df['P'] = new_patient_df[phenotype[0]]
+                    else: 
+                        # if phenotype in verb
+                        print("The phenotype is string-like, changing the phenotype to control = 1, case = 2.")
+                        new_patient_df['P'] = np.where(new_patient_df[phenotype[0]].str.upper().isin(case_verb_list), 2, 1)
+            elif phenotype[1] == "continuous":  
+                # if the phenotype is continuous
+                new_patient_df['P'] = new_patient_df[phenotype[0]]
+            else:
+                print("Wrong argument of type of phenotype!! Must be category or continuous!!")
+                os._exit(1)
     
-    # fill phenotype = -9 if missing
-    new_patient_df['P'] = new_patient_df['P'].fillna(-9)
-    # *Labels: FID ID P
-    print("Adding columns...")
-    new_patient_df.insert(0, "FID", 0)
-    new_patient_df.drop(phenotype[0], axis=1, inplace=True)    
-    new_patient_df.drop_duplicates(subset=["ID"], inplace=True)
+        # fill phenotype = -9 if missing
+        new_patient_df['P'] = new_patient_df['P'].fillna(-9)
+        # *Labels: FID ID P
+        print("Adding columns...")
+        new_patient_df.insert(0, "FID", 0)
+        new_patient_df.drop(phenotype[0], axis=1, inplace=True)    
+        new_patient_df.drop_duplicates(subset=["ID"], inplace=True)
+        print("Exporting file...")
+        new_patient_df.to_csv(outputfilename, sep="\t", index=False, header=False)
+        del new_patient_df
+    del patient_df
+    gc.collect()
+
+def covar_ID_filter(patient_file: Path, patient_id: str, covariates: list, outputfilename: Path, cache_folder: Path = None):
+    # plink covariate file of the given columns (numeric, -9 if missing)
+    columns = patient_columns(patient_file, cache_folder)
+    missing = [covariate for covariate in covariates if covariate not in columns]
+    if missing:
+        print('Cant find the covariates in column! Current covariates: ' + ", ".join(missing))
+        os._exit(1)
+    patient_df = load_patient_table(patient_file, [patient_id] + covariates, cache_folder)
+    # *Labels: FID IID covariates...
+    covar_df = pd.DataFrame({'FID': 0, 'IID': patient_df[patient_id].astype(str)})
+    for covariate in covariates:
+        covar_df[covariate] = pd.to_numeric(patient_df[covariate], errors='coerce').fillna(-9)
+    covar_df.drop_duplicates(subset=["IID"], inplace=True)
     print("Exporting file...")
-    new_patient_df.to_csv(outputfilename, sep="\t", index=False, header=False)
-    del patient_df, new_patient_df
+    covar_df.to_csv(outputfilename, sep=" ", index=False)
+    del patient_df, covar_df
     gc.collect()
\ No newline at end of file
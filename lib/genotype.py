@@ -0,0 +1,341 @@
+from pathlib import Path
+from bisect import bisect_left
+import io
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+# Genotype calls, the position in the tuple is the code saved in reduced files
+GENOTYPE_CALLS = (
+    '--',
+    'AA', 'AT', 'AC', 'AG',
+    'TA', 'TT', 'TC', 'TG',
+    'CA', 'CT', 'CC', 'CG',
+    'GA', 'GT', 'GC', 'GG',
+    'II', 'ID', 'DI', 'DD',
+    'UU')
+
+def make_call_table():
+    # Lookup table of (first byte, second byte) -> code, unknown calls -> 0
+    call_table = np.zeros((256, 256), dtype=np.uint8)
+    for code, call in enumerate(GENOTYPE_CALLS):
+        call_table[ord(call[0]), ord(call[1])] = code
+    return call_table
+
+CALL_TABLE = make_call_table()
+
+def encode_call_array(calls):
+    # Encode an arrow string array of calls (eg 'AG|0.9512') to uint8 codes,
+    # only the first two bytes of every call are looked up in CALL_TABLE
+    if isinstance(calls, pa.ChunkedArray):
+        if calls.num_chunks == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.concatenate([encode_call_array(c) for c in calls.chunks])
+    if pa.types.is_null(calls.type):
+        return np.zeros(len(calls), dtype=np.uint8)
+    if not (pa.types.is_string(calls.type) or pa.types.is_large_string(calls.type)):
+        calls = calls.cast(pa.string())
+
+    num = len(calls)
+    validity, offset_buffer, data_buffer = calls.buffers()
+    offset_type = np.int64 if pa.types.is_large_string(calls.type) else np.int32
+    offsets = np.frombuffer(offset_buffer, dtype=offset_type)[calls.offset:calls.offset + num + 1]
+    if data_buffer is None or num == 0:
+        return np.zeros(num, dtype=np.uint8)
+    data = np.frombuffer(data_buffer, dtype=np.uint8)
+    # a column of empty calls has an empty data buffer: all missing
+    if len(data) == 0:
+        return np.zeros(num, dtype=np.uint8)
+
+    starts = offsets[:-1]
+    has_call = (offsets[1:] - starts) >= 2
+    codes = np.zeros(num, dtype=np.uint8)
+    codes[has_call] = CALL_TABLE[data[starts[has_call]], data[starts[has_call] + 1]]
+    if validity is not None and calls.null_count > 0:
+        codes[calls.is_null().to_numpy(zero_copy_only=False)] = 0
+    return codes
+
+def encode_call_table(chunk: pa.Table):
+    # Encode all sample columns (2nd column to the end) of a matrix chunk,
+    # return codes with shape SNPs x samples (column-major, one sample per column)
+    codes = np.empty((chunk.num_rows, chunk.num_columns - 1), dtype=np.uint8, order='F')
+    for j in range(1, chunk.num_columns):
+        codes[:, j - 1] = encode_call_array(chunk.column(j))
+    return codes
+
+def read_matrix_header(matrix_file: Path, skip_rows: int):
+    # Column names of the matrix file, the first (empty) column is the SNP name
+    with open(matrix_file, 'r') as f:
+        for _ in range(skip_rows):
+            f.readline()
+        names = f.readline().rstrip('\r\n').split('\t')
+    names[0] = 'SNPs'
+    return names
+
+class MatrixRange(io.RawIOBase):
+    # Read-only view of the bytes [start, end) of a matrix file
+    def __init__(self, matrix_file: Path, start: int, end: int):
+        self.f = open(matrix_file, 'rb')
+        self.f.seek(start)
+        self.left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.left)
+        if size <= 0:
+            return 0
+        data = self.f.read(size)
+        buffer[:len(data)] = data
+        self.left -= len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def matrix_data_ranges(matrix_file: Path, skip_rows: int, split_bytes: int):
+    # Split the SNP lines of a matrix file into byte ranges of about split_bytes,
+    # every range starts and ends on a line boundary
+    with open(matrix_file, 'rb') as f:
+        for _ in range(skip_rows + 1):
+            f.readline()
+        start = f.tell()
+        end = f.seek(0, io.SEEK_END)
+        ranges = []
+        while start < end:
+            f.seek(min(start + max(split_bytes, 1), end))
+            f.readline()
+            stop = min(f.tell(), end)
+            ranges.append((start, stop))
+            start = stop
+    return ranges if ranges else [(end, end)]
+
+def read_matrix_chunks(matrix_file: Path, skip_rows: int, chunk_size: int, byte_range: tuple = None):
+    # Stream the matrix file (or a byte range of its SNP lines) as arrow tables
+    # of chunk_size SNPs, all columns kept as strings
+    names = read_matrix_header(matrix_file, skip_rows)
+    read_options = pv.ReadOptions(skip_rows=skip_rows + 1, column_names=names, block_size=1 << 24)
+    source = str(matrix_file)
+    if byte_range is not None:
+        if byte_range[1] <= byte_range[0]:
+            return
+        read_options = pv.ReadOptions(column_names=names, block_size=1 << 24)
+        source = MatrixRange(matrix_file, byte_range[0], byte_range[1])
+    reader = pv.open_csv(
+        source,
+        read_options=read_options,
+        parse_options=pv.ParseOptions(delimiter='\t'),
+        convert_options=pv.ConvertOptions(column_types={name: pa.string() for name in names}))
+    batches = []
+    rows = 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        while rows >= chunk_size:
+            table = pa.Table.from_batches(batches)
+            yield table.slice(0, chunk_size)
+            rest = table.slice(chunk_size)
+            batches = rest.to_batches()
+            rows = rest.num_rows
+    if rows > 0:
+        yield pa.Table.from_batches(batches)
+
+# Alleles of the calls, '0' is a missing allele
+ALLELES = ('0', 'A', 'T', 'C', 'G', 'I', 'D')
+
+def make_allele_tables():
+    # code -> (first allele, second allele) and (first allele, second allele) -> code
+    call_alleles = np.zeros((len(GENOTYPE_CALLS), 2), dtype=np.uint8)
+    pair_code = np.zeros((len(ALLELES), len(ALLELES)), dtype=np.uint8)
+    for code, call in enumerate(GENOTYPE_CALLS):
+        if call[0] in ALLELES and call[1] in ALLELES:
+            call_alleles[code] = (ALLELES.index(call[0]), ALLELES.index(call[1]))
+            pair_code[ALLELES.index(call[0]), ALLELES.index(call[1])] = code
+    return call_alleles, pair_code
+
+CALL_ALLELES, PAIR_CODE = make_allele_tables()
+
+def count_alleles(codes):
+    # Count every allele of each SNP (row), return SNPs x ALLELES counts
+    first = CALL_ALLELES[codes, 0]
+    second = CALL_ALLELES[codes, 1]
+    counts = np.zeros((codes.shape[0], len(ALLELES)), dtype=np.int64)
+    for allele in range(1, len(ALLELES)):
+        counts[:, allele] = np.count_nonzero(first == allele, axis=1) + np.count_nonzero(second == allele, axis=1)
+    return counts
+
+def infer_alleles(codes):
+    # PLINK-style alleles of each SNP: A1 = minor allele, A2 = major allele,
+    # A1 is '0' (index 0) if the SNP is monomorphic or not called at all
+    return alleles_from_counts(count_alleles(codes))
+
+def alleles_from_counts(counts):
+    # A1 / A2 of each SNP from its SNPs x ALLELES counts (see infer_alleles)
+    order = np.argsort(-counts, axis=1, kind='stable')
+    rows = np.arange(counts.shape[0])
+    a2 = order[:, 0].astype(np.uint8)
+    a1 = order[:, 1].astype(np.uint8)
+    a1[counts[rows, a1] == 0] = 0
+    a2[counts[rows, a2] == 0] = 0
+    return a1, a2
+
+def codes_to_2bit(codes, a1, a2):
+    # PLINK .bed genotype values: 0 = hom A1, 1 = missing, 2 = het, 3 = hom A2,
+    # calls with other alleles (or UU) are set to missing
+    first = CALL_ALLELES[codes, 0]
+    second = CALL_ALLELES[codes, 1]
+    a1 = a1.reshape(-1, 1)
+    a2 = a2.reshape(-1, 1)
+    first_a1 = (first == a1) & (first != 0)
+    second_a1 = (second == a1) & (second != 0)
+    first_a2 = (first == a2) & (first != 0)
+    second_a2 = (second == a2) & (second != 0)
+    values = np.ones(codes.shape, dtype=np.uint8)
+    values[first_a1 & second_a1] = 0
+    values[(first_a1 & second_a2) | (first_a2 & second_a1)] = 2
+    values[first_a2 & second_a2] = 3
+    return values
+
+def plink_2bit_to_codes(values, a1, a2):
+    # Back from PLINK genotype values to genotype codes (het calls are written as A1A2)
+    a1 = a1.reshape(-1, 1)
+    a2 = a2.reshape(-1, 1)
+    code_table = np.stack([PAIR_CODE[a1, a1], np.zeros_like(a1), PAIR_CODE[a1, a2], PAIR_CODE[a2, a2]], axis=1)[:, :, 0]
+    return np.take_along_axis(code_table, values.astype(np.intp), axis=1)
+
+def pack_2bit(values):
+    # Pack 2-bit values of each row, 4 samples per byte with the first sample in the lowest bits
+    snps, samples = values.shape
+    padded = np.zeros((snps, (samples + 3) // 4 * 4), dtype=np.uint8)
+    padded[:, :samples] = values
+    padded = padded.reshape(snps, -1, 4)
+    return padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+def unpack_2bit(packed, samples: int):
+    # Unpack rows of packed bytes back to 2-bit values, keep the first `samples` values
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+    values = (packed[:, :, None] >> shifts) & 3
+    return values.reshape(packed.shape[0], -1)[:, :samples]
+
+# Reduced parquet files: 'uint8' keeps one uint8 code column per sample,
+# 'packed' keeps the PLINK 2-bit genotypes of all samples in one column
+# with the A1/A2 allele table of each SNP (sample IDs in the file metadata)
+def reduce_schema(samples: list, packed: bool = False, width: int = 0):
+    if packed:
+        metadata = {b'reduce_format': b'packed', b'samples': json.dumps(list(samples)).encode()}
+        fields = [('SNPs', pa.string()), ('A1', pa.string()), ('A2', pa.string()), ('Genotypes', pa.binary(width))]
+    else:
+        metadata = {b'reduce_format': b'uint8'}
+        fields = [('SNPs', pa.string())] + [(str(sample), pa.uint8()) for sample in samples]
+    return pa.schema(fields, metadata=metadata)
+
+def reduce_table(snps, codes, samples: list, packed: bool = False):
+    # Arrow table of a reduced file from SNP names and SNPs x samples codes
+    snps = pa.array(snps, type=pa.string()) if not isinstance(snps, (pa.Array, pa.ChunkedArray)) else snps
+    if packed:
+        a1, a2 = infer_alleles(codes)
+        packed_codes = np.ascontiguousarray(pack_2bit(codes_to_2bit(codes, a1, a2)))
+        width = packed_codes.shape[1]
+        genotypes = pa.FixedSizeBinaryArray.from_buffers(pa.binary(width), len(packed_codes), [None, pa.py_buffer(packed_codes)])
+        allele_names = np.array(ALLELES, dtype=object)
+        arrays = [snps, pa.array(allele_names[a1], type=pa.string()), pa.array(allele_names[a2], type=pa.string()), genotypes]
+        return pa.Table.from_arrays(arrays, schema=reduce_schema(samples, True, width))
+    arrays = [snps] + [pa.array(codes[:, j], type=pa.uint8()) for j in range(codes.shape[1])]
+    return pa.Table.from_arrays(arrays, schema=reduce_schema(samples))
+
+def reduce_file_format(reduce_file: Path):
+    metadata = pq.read_schema(reduce_file).metadata or {}
+    return metadata.get(b'reduce_format', b'uint8').decode()
+
+def reduce_file_samples(reduce_file: Path):
+    # Sample IDs of a reduced file, read from the parquet schema only
+    schema = pq.read_schema(reduce_file)
+    metadata = schema.metadata or {}
+    if metadata.get(b'reduce_format') == b'packed':
+        return json.loads(metadata[b'samples'])
+    return [name for name in schema.names if name != 'SNPs']
+
+def packed_column_bytes(column, width: int):
+    # View a fixed size binary column as a SNPs x width uint8 array
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    data = np.frombuffer(column.buffers()[1], dtype=np.uint8)
+    return data[column.offset * width:(column.offset + len(column)) * width].reshape(len(column), width)
+
+def packed_table_codes(table: pa.Table, selected):
+    # Codes (SNPs x samples) of the sample positions `selected` from the Genotypes, A1, A2 columns of a packed table
+    width = table.schema.field('Genotypes').type.byte_width
+    packed_codes = packed_column_bytes(table.column('Genotypes'), width)
+    selected = np.asarray(selected, dtype=np.int64)
+    values = (packed_codes[:, selected // 4] >> ((selected % 4) * 2).astype(np.uint8)) & 3
+    allele_index = {allele: i for i, allele in enumerate(ALLELES)}
+    a1 = np.array([allele_index.get(a, 0) for a in table.column('A1').to_pylist()], dtype=np.uint8)
+    a2 = np.array([allele_index.get(a, 0) for a in table.column('A2').to_pylist()], dtype=np.uint8)
+    return plink_2bit_to_codes(values, a1, a2)
+
+def read_reduce_file(reduce_file: Path, columns: list = None):
+    # Read a reduced file as a DataFrame of SNPs + uint8 code columns of samples,
+    # columns = list of sample IDs to read (default: all samples)
+    if reduce_file_format(reduce_file) == 'packed':
+        samples = reduce_file_samples(reduce_file)
+        table = pq.read_table(reduce_file)
+        if columns is None:
+            selected = list(range(len(samples)))
+        else:
+            position = {sample: i for i, sample in enumerate(samples)}
+            selected = [position[sample] for sample in columns]
+        codes = packed_table_codes(table, selected)
+        df = pd.DataFrame(codes, columns=[samples[i] for i in selected])
+        df.insert(0, 'SNPs', table.column('SNPs').to_pandas())
+        return df
+
+    df = pq.read_table(reduce_file, columns=None if columns is None else ['SNPs'] + list(columns)).to_pandas()
+    # reduced files written before the uint8 schema keep int64 or float (missing) codes
+    for col in df.columns[1:]:
+        if df[col].dtype != np.uint8:
+            df[col] = df[col].fillna(0).astype(np.uint8)
+    return df
+
+def csv_genotype_dtype(csv_file: Path, key_columns: list):
+    # dtype of a csv with key columns and uint8 genotype columns, so codes are not widened
+    columns = pd.read_csv(csv_file, nrows=0).columns
+    return {col: (str if col in key_columns else np.uint8) for col in columns}
+
+def row_groups_with(parquet: pq.ParquetFile, column: str, values: list):
+    # Row groups whose min / max statistics of the column can hold one of the values
+    # (a row group without statistics is always kept)
+    wanted = sorted(set(values))
+    index = parquet.schema_arrow.get_field_index(column)
+    row_groups = []
+    for rg in range(parquet.num_row_groups):
+        statistics = parquet.metadata.row_group(rg).column(index).statistics
+        if statistics is None or not statistics.has_min_max:
+            row_groups.append(rg)
+            continue
+        i = bisect_left(wanted, statistics.min)
+        if i < len(wanted) and wanted[i] <= statistics.max:
+            row_groups.append(rg)
+    return row_groups
+
+def read_row_range(parquet_file: Path, start: int, stop: int, columns: list = None):
+    # Rows [start, stop) of a parquet file as an arrow table, only the row groups
+    # overlapping the range are read
+    parquet = pq.ParquetFile(parquet_file)
+    row_groups = []
+    first_row = None
+    offset = 0
+    for rg in range(parquet.num_row_groups):
+        rows = parquet.metadata.row_group(rg).num_rows
+        if offset < stop and offset + rows > start:
+            if first_row is None:
+                first_row = offset
+            row_groups.append(rg)
+        offset += rows
+    if not row_groups:
+        return parquet.schema_arrow.empty_table() if columns is None else parquet.schema_arrow.empty_table().select(columns)
+    table = parquet.read_row_groups(row_groups, columns=columns)
+    return table.slice(start - first_row, stop - start)
@@ -0,0 +1,109 @@
+from pathlib import Path
+import gc
+import os
+import numpy as np
+from lib.assoc import BYTE_DOSAGE, BYTE_OBSERVED, read_bim, read_fam
+from lib.trace import span
+
+# LD pruning on PLINK binary files (same as plink --indep-pairwise <window> <step> <r2>):
+# r2 of every SNP pair closer than the window is computed on the samples called in both SNPs
+# (block matrix products of dosages and observed flags, one tile of SNPs at a time),
+# then windows slide by step SNPs and the lower-MAF SNP of each pair above the threshold is pruned.
+# Dosage sums are integers below 2^24 for less than 4 million samples, float32 products are exact.
+BYTE_DOSAGE_32 = BYTE_DOSAGE.astype(np.float32)
+BYTE_OBSERVED_32 = BYTE_OBSERVED.astype(np.float32)
+# plink --not-chr 0 x y xy
+PRUNE_SKIP_CHR = ('0', '23', '24', '25', 'X', 'Y', 'XY')
+
+def read_tile(bed, start: int, stop: int, samples: int):
+    packed = np.asarray(bed[start:stop])
+    g = np.take(BYTE_DOSAGE_32, packed, axis=0).reshape(len(packed), -1)[:, :samples]
+    w = np.take(BYTE_OBSERVED_32, packed, axis=0).reshape(len(packed), -1)[:, :samples]
+    return g, w
+
+def tile_sums(g, w, rows: int):
+    # Sx, N, Sxx, Sxy, Sy, Syy of the row SNPs (first `rows` of the tile) with every SNP of the tile,
+    # each pair on the samples called in both SNPs (g is 0 at missing calls)
+    gg = g * g
+    left = (np.concatenate([g[:rows], w[:rows], gg[:rows]]) @ w.T).astype(np.float64)
+    right = (w[:rows] @ np.concatenate([g, gg]).T).astype(np.float64)
+    sxy = (g[:rows] @ g.T).astype(np.float64)
+    return left[:rows], left[rows:2 * rows], left[2 * rows:], sxy, right[:, :len(g)], right[:, len(g):]
+
+def band_r2(bed, start: int, stop: int, samples: int, window: int, threshold: float, tile: int):
+    # SNP pairs (i, j), i < j < i + window, of the SNPs [start, stop) with r2 above the threshold,
+    # and the MAF of the SNPs; tiles of `tile` SNPs are paired with themselves and the next window - 1 SNPs
+    pairs_i, pairs_j = [], []
+    maf = np.zeros(stop - start)
+    for first in range(start, stop, tile):
+        last = min(first + tile, stop)
+        end = min(last + window - 1, stop)
+        rows = last - first
+        g, w = read_tile(bed, first, end, samples)
+        sx, n, sxx, sxy, sy, syy = tile_sums(g, w, rows)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = sxy - sx * sy / n
+            r2 = cov * cov / ((sxx - sx * sx / n) * (syy - sy * sy / n))
+        # keep the band j - i in [1, window - 1]
+        i, j = np.nonzero(r2 > threshold)
+        band = (j > i) & (j - i < window)
+        pairs_i.append(i[band] + first - start)
+        pairs_j.append(j[band] + first - start)
+        called = np.diagonal(n)
+        freq = np.divide(np.diagonal(sx), 2 * called, out=np.zeros(rows), where=called > 0)
+        maf[first - start:last - start] = np.minimum(freq, 1 - freq)
+        del g, w
+    return np.concatenate(pairs_i).astype(np.int64), np.concatenate(pairs_j).astype(np.int64), maf
+
+def greedy_prune(pairs_i, pairs_j, maf, snps: int, window: int, step: int):
+    # Slide the window by step SNPs; a pair is first seen in the first window holding its second SNP,
+    # it is used only if its first SNP is still in that window, pairs of a window in (i, j) order.
+    # Of a pair with both SNPs remaining the lower-MAF SNP is pruned (the second SNP on ties)
+    window_of_j = np.maximum(0, -(-(pairs_j - window + 1) // step))
+    seen = pairs_i >= window_of_j * step
+    pairs_i, pairs_j, window_of_j = pairs_i[seen], pairs_j[seen], window_of_j[seen]
+    order = np.lexsort((pairs_j, pairs_i, window_of_j))
+    pruned = np.zeros(snps, dtype=bool)
+    maf = maf.tolist()
+    for i, j in zip(pairs_i[order].tolist(), pairs_j[order].tolist()):
+        if pruned[i] or pruned[j]:
+            continue
+        if maf[i] < (1 - 1e-6) * maf[j]:
+            pruned[i] = True
+        else:
+            pruned[j] = True
+    return pruned
+
+def ld_prune(bed_prefix: Path, output_prefix: Path, window: int = 50, step: int = 5, threshold: float = 0.2, memory_mb: int = 512):
+    # Write <output_prefix>.prune.in / .prune.out of the SNPs of a PLINK binary file set, every chr on its own,
+    # chr 0, X, Y and XY are left out (as plink --not-chr 0 x y xy)
+    bim = read_bim(bed_prefix) if os.path.getsize(str(bed_prefix) + r".bim") > 0 else None
+    if bim is None or len(bim) == 0:
+        # no SNP left (eg a chr filtered out by QC): empty lists as plink, the .bed has no SNP to map
+        for ext in [r".prune.in", r".prune.out"]:
+            open(str(output_prefix) + ext, 'w').close()
+        return 0, 0
+    samples = len(read_fam(str(bed_prefix) + r".fam"))
+    bed = np.memmap(str(bed_prefix) + r".bed", dtype=np.uint8, mode='r', offset=3).reshape(len(bim), -1)
+    # a tile of about 2 windows (its products grow with tile x (tile + window)),
+    # less if the memory budget cannot hold g, w, g^2 of the tile and their copies (float32)
+    tile = max(1, min(2 * window, (memory_mb * 1024 * 1024) // (32 * max(samples, 1)) - window))
+    pruned = np.zeros(len(bim), dtype=bool)
+    used = ~bim['CHR'].str.upper().isin(PRUNE_SKIP_CHR).to_numpy()
+    chrs = bim['CHR'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, chrs[1:] != chrs[:-1]])
+    for start, stop in zip(starts, np.r_[starts[1:], len(bim)]):
+        if not used[start]:
+            continue
+        with span("ld chr", chr=str(chrs[start]), rows=stop - start, columns=samples, bytes_read=(stop - start) * bed.shape[1]) as record:
+            pairs_i, pairs_j, maf = band_r2(bed, start, stop, samples, window, threshold, tile)
+            pruned[start:stop] = greedy_prune(pairs_i, pairs_j, maf, stop - start, window, step)
+            record["pairs"] = len(pairs_i)
+        print("LD prune: chr " + str(chrs[start]) + ", " + str(int(pruned[start:stop].sum())) + " of " + str(stop - start) + " SNPs pruned.")
+    with open(str(output_prefix) + r".prune.in", 'w', newline='\n') as f:
+        f.writelines(snp + '\n' for snp in bim['SNP'][used & ~pruned])
+    with open(str(output_prefix) + r".prune.out", 'w', newline='\n') as f:
+        f.writelines(snp + '\n' for snp in bim['SNP'][used & pruned])
+    del bed
+    gc.collect()
+    return int((used & ~pruned).sum()), int((used & pruned).sum())
@@ -1,66 +1,132 @@
 from pathlib import Path
 import pandas as pd
 import gc
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lib.catalog import file_stat
+from lib.snpmap import read_snp_map
+from lib.store import merged_file_list
+from lib.trace import span, file_size
 
-def merge_temp_file(temp_folder: Path, merged_folder: Path, SNP_list_file: Path, case_num: int):
+def align_to_snp_map(snp_index: pd.Index, temp_snps: pd.Series):
+    # Row indexer of a temp file for every SNP of the sorted map (-1 if the SNP is not in the file),
+    # a SNP repeated in the file takes its first row
+    temp_index = pd.Index(temp_snps.astype(str))
+    if temp_index.is_unique:
+        return temp_index.get_indexer(snp_index)
+    rows = pd.Series(np.arange(len(temp_index)), index=temp_index)[~temp_index.duplicated()]
+    return rows.reindex(snp_index).fillna(-1).to_numpy(dtype=np.int64)
+
+def write_merged_file(snp_ids: pa.Array, blocks: list, samples: list, outputfilename: Path):
+    # Columns of all aligned blocks (SNPs x samples, uint8) next to the SNP_id column
+    with span("write merged file", file=Path(outputfilename).name, rows=len(snp_ids), columns=len(samples)) as record:
+        arrays = [snp_ids]
+        for block in blocks:
+            arrays += [pa.array(block[:, j], type=pa.uint8()) for j in range(block.shape[1])]
+        table = pa.Table.from_arrays(arrays, names=['SNP_id'] + samples)
+        pq.write_table(table, outputfilename, row_group_size=100000)
+        record["bytes_written"] = file_size(outputfilename)
+
+# Merged files record how they were made, so new cases can be appended to them (--append):
+# merge_state.json = {"key": SNP map hash and merge parameters, "sources": reduced file -> [mtime, size]}
+MERGE_STATE_NAME = "merge_state.json"
+
+def merge_temp_file(temp_folder: Path, merged_folder: Path, SNP_list_file: Path, case_num: int, memory_mb: int = 0, first_num: int = 1):
+    # first_num = number of the first merged file (the next number when appending to existing merged files)
     temp_files = [str(f) for f in Path(temp_folder).iterdir() if f.match("*.parquet")]
     temp_files.sort()
-    num = 1
+    num = first_num
     zfill_num = len(str(len(temp_files)))
     print("There are " + str(len(temp_files)) + " temp files in the folder.")
 
-    # Add SNP map (first column)
-    result_df = pd.read_csv(SNP_list_file, usecols=['SNP_id'])
+    # SNP map (first column), every temp file is aligned to its order
+    snp_ids = read_snp_map(SNP_list_file, ['SNP_id'])['SNP_id']
+    snp_index = pd.Index(snp_ids)
+    snp_array = pa.array(snp_ids, type=pa.string())
+    if memory_mb > 0:
+        # aligned blocks and the arrow copy written out are both about SNPs x cases bytes
+        case_num = max(1, int(memory_mb * 1024 * 1024 // (2 * max(len(snp_ids), 1))))
+        print("Memory budget " + str(memory_mb) + " MB, merge by " + str(case_num) + " cases.")
 
-    # Add columns with loop
+    blocks = []
+    samples = []
+    last_snps = None
+    indexer = None
     for i in range(len(temp_files)):
         print("Merging file: "+ temp_files[i])
-        temp_df = pd.read_parquet(temp_files[i])
-        result_df = pd.merge(result_df, temp_df, on="SNP_id")
+        with span("merge temp file", file=Path(temp_files[i]).name, bytes_read=file_size(temp_files[i])) as record:
+            temp_df = pd.read_parquet(temp_files[i])
+            # Temp files of the same chip share the SNP order, reuse the indexer
+            if last_snps is None or not last_snps.equals(temp_df['SNP_id']):
+                indexer = align_to_snp_map(snp_index, temp_df['SNP_id'])
+                last_snps = temp_df['SNP_id']
+            codes = temp_df.iloc[:, 1:].to_numpy(dtype=np.uint8)
+            block = np.zeros((len(snp_index), codes.shape[1]), dtype=np.uint8, order='F')
+            found = indexer >= 0
+            block[found] = codes[indexer[found]]
+            blocks.append(block)
+            samples += [str(col) for col in temp_df.columns[1:]]
+            record.update(rows=len(temp_df), columns=codes.shape[1])
+            del temp_df, codes
+        # number of columns counts the SNP_id column, as in the file name
         if i < len(temp_files)-1:
-            if len(result_df.columns) > case_num:
-                print("Collect cases number: " + str(len(result_df.columns)) + ", generating merged file "+ str(num).zfill(zfill_num) +"...")
+            if len(samples) + 1 > case_num:
+                print("Collect cases number: " + str(len(samples) + 1) + ", generating merged file "+ str(num).zfill(zfill_num) +"...")
                 Path(merged_folder).mkdir(parents=True, exist_ok=True)
-                result_df.to_csv(str(merged_folder) + r'/merged_' + str(num).zfill(zfill_num) + r'_' + str(len(result_df.columns)) + r'.csv', index=False)
+                write_merged_file(snp_array, blocks, samples, str(merged_folder) + r'/merged_' + str(num).zfill(zfill_num) + r'_' + str(len(samples) + 1) + r'.parquet')
                 num += 1
-                result_df = pd.read_csv(SNP_list_file, usecols=['SNP_id'])
+                blocks = []
+                samples = []
+                gc.collect()
         else:
-            print("Finishing... Collect cases number: " + str(len(result_df.columns)) + ", generating merged file "+ str(num).zfill(zfill_num) +"...")
-            result_df.to_csv(str(merged_folder) + r'/merged_' + str(num).zfill(zfill_num) + r'_' + str(len(result_df.columns)) + r'.csv', index=False)
-            del temp_df, result_df
+            print("Finishing... Collect cases number: " + str(len(samples) + 1) + ", generating merged file "+ str(num).zfill(zfill_num) +"...")
+            Path(merged_folder).mkdir(parents=True, exist_ok=True)
+            write_merged_file(snp_array, blocks, samples, str(merged_folder) + r'/merged_' + str(num).zfill(zfill_num) + r'_' + str(len(samples) + 1) + r'.parquet')
+            del blocks
             gc.collect()
 
-def merge_selected_SNP_by_range(filted_folder: Path, chr:str, input_snp_range_file: Path, chr_map_file: Path, outputfilename: Path):
-    file_list = [str(f) for f in Path(filted_folder).iterdir() if f.match("*.csv")]
-    file_list.sort()
-    print("There are " + str(len(file_list)) + " filted files in the folder.")
-
-    snp_range_df = pd.read_csv(input_snp_range_file)
-    selected_chr = snp_range_df[snp_range_df["chr"] == chr]
-    start, end = selected_chr["start"].values[0], selected_chr["end"].values[0]
-    del snp_range_df, selected_chr
-    gc.collect()
-
-    for i in range(len(file_list)):
-        print('Loading file: '+ file_list[i])
-        temp_df = pd.read_csv(file_list[i], skiprows=range(1, start + 1), nrows = end - start + 1)
-        row_count, col_count = temp_df.shape
-        print('The size of df is ' + str(row_count) + ' by ' + str(col_count) + ', merging file: ' + file_list[i])
-        if i == 0:
-            merged_df = temp_df
-        else:
-            merged_df = pd.merge(merged_df, temp_df, on="SNP_id")
-            del temp_df
-            gc.collect()
+def merged_samples(merged_folder: Path):
+    # Sample IDs of the merged files, in order of the files
+    samples = []
+    for f in merged_file_list(merged_folder):
+        samples += pq.read_schema(f).names[1:]
+    return samples
 
-    # Insert chr and BP from SNP map
-    print("Inserting SNP map data...")
-    snp_map_df = pd.read_csv(chr_map_file, usecols=['chr', 'BP'])
-    merged_df.insert(1, "chr", snp_map_df['chr'])
-    merged_df.insert(2, "BP", snp_map_df['BP'])
+def write_merge_state(merged_folder: Path, key: dict, sources: list, append: bool = False):
+    # Record the key and the reduced files the merged files were made from (added to the old ones if append)
+    state_file = Path(merged_folder) / MERGE_STATE_NAME
+    state = {"key": key, "sources": {}}
+    if append and os.path.exists(state_file):
+        with open(state_file) as f:
+            state["sources"] = json.load(f)["sources"]
+    for source in sources:
+        state["sources"][str(source)] = list(file_stat(source))
+    with open(str(state_file) + r".tmp", 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(str(state_file) + r".tmp", state_file)
 
-    row_count, col_count = merged_df.shape
-    print('The size of merged df is ' + str(row_count) + ' by ' + str(col_count) + ', exporting file: ' + str(outputfilename))
-    merged_df.to_csv(outputfilename, index=False)
-    del snp_map_df, merged_df
-    gc.collect()
\ No newline at end of file
+def merge_append_ids(merged_folder: Path, filter_file: Path, key: dict):
+    # IDs of the dataset (ID filter) that are not in the merged files yet, None if the merged files cannot be extended:
+    # no state, other key (SNP map or merge parameters), a reduced file they came from changed or was removed,
+    # or a merged case is no longer in the dataset
+    state_file = Path(merged_folder) / MERGE_STATE_NAME
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        state = json.load(f)
+    if state["key"] != json.loads(json.dumps(key)):
+        print("Merged files were made with another SNP map or merge parameters.")
+        return None
+    for source, (mtime, size) in state["sources"].items():
+        if not os.path.exists(source) or file_stat(source) != (mtime, size):
+            print("Reduced file changed or removed: " + source)
+            return None
+    merged = set(merged_samples(merged_folder))
+    wanted = pd.read_csv(filter_file, dtype={'ID': str})['ID'].tolist()
+    if merged - set(wanted):
+        print(str(len(merged - set(wanted))) + " merged cases are not in the dataset any more.")
+        return None
+    return [i for i in wanted if i not in merged]
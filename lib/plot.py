@@ -0,0 +1,149 @@
+from pathlib import Path
+import gc
+import importlib.util
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Manhattan / Q-Q plots and top SNPs of an association file in this process (same files as SNP_manhattan_top.R),
+# the many non-significant points are thinned to one point per pixel before drawing
+PLOT_WIDTH = 1080
+PLOT_HEIGHT = 608
+SUGGESTIVE_P = 0.00001
+GENOMEWIDE_P = 5e-8
+# plink chromosome codes -> labels of the Manhattan plot
+CHR_LABELS = {23: 'X', 24: 'Y', 25: 'XY', 26: 'MT'}
+CHR_CODES = {label: code for code, label in CHR_LABELS.items()}
+
+def assoc_parquet(assoc_file: Path):
+    # the parquet written next to the association file by the NumPy engine, if it is not older than the text file
+    parquet_file = Path(str(assoc_file) + r".parquet")
+    if os.path.exists(parquet_file) and os.path.getmtime(parquet_file) >= os.path.getmtime(assoc_file):
+        return parquet_file
+    return None
+
+def read_assoc(assoc_file: Path, p_value: float, chunksize: int = 1000000):
+    # CHR, BP, P of every SNP and the full rows with P <= p_value sorted by P of a plink .assoc.linear / .assoc.logistic,
+    # rows with NA are left out (as na.omit in R); the text file is read once in chunks
+    parquet_file = assoc_parquet(assoc_file)
+    if parquet_file is not None:
+        assoc_df = pq.read_table(parquet_file, columns=['CHR', 'BP', 'P']).to_pandas()
+        top_df = pq.read_table(parquet_file, filters=[('P', '<=', p_value)]).to_pandas()
+    else:
+        columns, top_chunks = [], []
+        for chunk in pd.read_csv(assoc_file, sep=r"\s+", na_values=["NA"], chunksize=chunksize):
+            columns.append(chunk[['CHR', 'BP', 'P']])
+            top_chunks.append(chunk[chunk['P'] <= p_value])
+        assoc_df = pd.concat(columns, ignore_index=True)
+        top_df = pd.concat(top_chunks, ignore_index=True)
+    return assoc_df.dropna().reset_index(drop=True), top_df.dropna().sort_values(by="P", kind='stable')
+
+def thin_points(x, y, keep, x_range: tuple, y_range: tuple, width: int, height: int):
+    # Indices of the points to draw: all points with keep = True and one point per pixel of the others
+    x_bin = np.clip(((x - x_range[0]) / max(x_range[1] - x_range[0], 1e-12) * (width - 1)).astype(np.int64), 0, width - 1)
+    y_bin = np.clip(((y - y_range[0]) / max(y_range[1] - y_range[0], 1e-12) * (height - 1)).astype(np.int64), 0, height - 1)
+    grid = np.full(width * height, -1, dtype=np.int64)
+    thinned = np.flatnonzero(~keep)
+    grid[x_bin[thinned] * height + y_bin[thinned]] = thinned
+    return np.sort(np.concatenate([grid[grid >= 0], np.flatnonzero(keep)]))
+
+def chr_codes(chr):
+    # chr as plink codes (the parquet of the NumPy engine keeps the .bim chr names)
+    if pd.api.types.is_numeric_dtype(chr):
+        return chr
+    return pd.to_numeric(chr.astype(str).str.upper().replace(CHR_CODES), errors='coerce')
+
+def manhattan_plot(assoc_df: pd.DataFrame, top_df: pd.DataFrame, title: str, plot_file: Path):
+    # assoc_df: CHR, BP, P of every SNP, top_df: rows with P below the suggestive line sorted by P (for the SNP names)
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    assoc_df = assoc_df.assign(CHR=chr_codes(assoc_df['CHR'])).dropna()
+    chrs = assoc_df['CHR'].to_numpy(dtype=np.int64)
+    bp = assoc_df['BP'].to_numpy(dtype=np.float64)
+    logp = -np.log10(assoc_df['P'].to_numpy(dtype=np.float64))
+    # plink writes the SNPs in (chr, BP) order, sort only if not
+    if np.any((chrs[1:] < chrs[:-1]) | ((chrs[1:] == chrs[:-1]) & (bp[1:] < bp[:-1]))):
+        order = np.lexsort((bp, chrs))
+        chrs, bp, logp = chrs[order], bp[order], logp[order]
+    # chr after chr on one axis (as qqman)
+    starts = np.flatnonzero(np.r_[True, chrs[1:] != chrs[:-1]])
+    stops = np.r_[starts[1:], len(chrs)]
+    x = np.empty(len(bp))
+    color = np.zeros(len(bp), dtype=np.int64)
+    chr_offsets = {}
+    ticks = []
+    offset = 0.0
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        chr_offsets[chrs[start]] = offset - bp[start]
+        x[start:stop] = bp[start:stop] + chr_offsets[chrs[start]]
+        color[start:stop] = i % 2
+        ticks.append((x[start] + x[stop - 1]) / 2)
+        offset = x[stop - 1] + 1
+    finite = np.isfinite(logp)
+    ymax = max(np.ceil(logp[finite].max()) if finite.any() else 1, -np.log10(GENOMEWIDE_P) + 1)
+    logp = np.where(finite, logp, ymax)
+
+    shown = thin_points(x, logp, logp >= -np.log10(SUGGESTIVE_P), (0, max(offset, 1)), (0, ymax), PLOT_WIDTH, PLOT_HEIGHT)
+    fig, ax = plt.subplots(figsize=(PLOT_WIDTH / 100, PLOT_HEIGHT / 100), dpi=100)
+    for c, name in enumerate(["#00008B", "#CD8500"]): # blue4, orange3
+        at = shown[color[shown] == c]
+        ax.plot(x[at], logp[at], linestyle="none", marker="o", markersize=2.5, color=name)
+    ax.axhline(-np.log10(SUGGESTIVE_P), color="blue", linewidth=1)
+    ax.axhline(-np.log10(GENOMEWIDE_P), color="red", linewidth=1)
+    # name of the top SNP of every chr above the suggestive line (annotatePval of qqman)
+    top_df = top_df.assign(CHR=chr_codes(top_df['CHR'])).drop_duplicates(subset=['CHR'])
+    for chr, snp_bp, snp, p in zip(top_df['CHR'], top_df['BP'], top_df['SNP'], top_df['P']):
+        if chr in chr_offsets:
+            ax.annotate(str(snp), (snp_bp + chr_offsets[chr], min(-np.log10(max(p, 1e-300)), ymax)),
+                        textcoords="offset points", xytext=(0, 4), ha="center", fontsize=7)
+    ax.set_xticks(ticks)
+    ax.set_xticklabels([CHR_LABELS.get(chrs[start], str(chrs[start])) for start in starts], fontsize=7)
+    ax.set_xlim(-offset * 0.01, offset * 1.01)
+    ax.set_ylim(0, ymax)
+    ax.set_xlabel("Chromosome")
+    ax.set_ylabel(r"$-\log_{10}(p)$")
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(plot_file, format="tiff")
+    plt.close(fig)
+
+def qq_plot(p, title: str, plot_file: Path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    observed = -np.log10(np.sort(np.asarray(p, dtype=np.float64)))
+    n = len(observed)
+    # expected -log10 p of n uniform p-values (ppoints of R)
+    a = 3 / 8 if n <= 10 else 1 / 2
+    expected = -np.log10((np.arange(1, n + 1) - a) / (n + 1 - 2 * a))
+    shown = thin_points(expected, observed, observed >= -np.log10(SUGGESTIVE_P), (0, 7), (0, 12), PLOT_WIDTH, PLOT_HEIGHT)
+    fig, ax = plt.subplots(figsize=(PLOT_WIDTH / 100, PLOT_HEIGHT / 100), dpi=100)
+    ax.plot(expected[shown], observed[shown], linestyle="none", marker="D", markersize=5, color="#00008B")
+    ax.plot([0, 7], [0, 7], color="red", linewidth=1)
+    ax.set_xlim(0, 7)
+    ax.set_ylim(0, 12)
+    ax.set_xlabel(r"Expected $-\log_{10}(p)$")
+    ax.set_ylabel(r"Observed $-\log_{10}(p)$")
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(plot_file, format="tiff")
+    plt.close(fig)
+
+def plot_assoc(assoc_file: Path, phenotype: str, manhattan_file: Path, qq_file: Path, top_snp_file: Path):
+    # Part 9 without R: Manhattan plot, Q-Q plot and the SNPs with p <= 1e-5 sorted by p
+    if importlib.util.find_spec("matplotlib") is None:
+        raise ImportError("--plot_engine python needs matplotlib (pip install matplotlib)")
+    print("Loading association file: " + str(assoc_file))
+    assoc_df, top_df = read_assoc(assoc_file, SUGGESTIVE_P)
+    print("Found " + str(len(top_df)) + " SNPs with p <= " + format(SUGGESTIVE_P, "g") + ", exporting top SNPs: " + str(top_snp_file))
+    top_df.to_csv(top_snp_file, index=False)
+    print("Drawing Manhattan plot of " + str(len(assoc_df)) + " SNPs: " + str(manhattan_file))
+    manhattan_plot(assoc_df, top_df, ("Manhattan Plot of " + phenotype).replace("_", " "), manhattan_file)
+    print("Drawing Q-Q plot: " + str(qq_file))
+    qq_plot(assoc_df['P'].to_numpy(), "Q-Q plot of SNP GWAS p-values", qq_file)
+    del assoc_df, top_df
+    gc.collect()
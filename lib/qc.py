@@ -0,0 +1,213 @@
+from pathlib import Path
+import gc
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lib.genotype import GENOTYPE_CALLS, ALLELES, CALL_ALLELES, alleles_from_counts
+from lib.snpmap import read_snp_map
+from lib.store import GenotypeStore
+from lib.trace import span
+
+# Genotype QC of the genotype store before the bed files are written, the plink filters
+# --mind (samples), then --geno, --hwe and --maf (SNPs) computed from the 0-21 codes.
+# Reports (also the filter masks of Parts 5-6, column PASS):
+#   SNP report:    chr, SNP, BP, A1, A2, counts of hom A1 / het / hom A2 / missing calls, MAF, F_MISS, P_HWE, PASS
+#                  (one row per SNP of the sorted SNP map, one row group per chr)
+#   sample report: ID, N_MISS, N_GENO, F_MISS, PASS (like plink --missing .imiss)
+QC_SNP_COLUMNS = ['chr', 'SNP', 'BP', 'A1', 'A2', 'C_HOM_A1', 'C_HET', 'C_HOM_A2', 'C_MISS', 'MAF', 'F_MISS', 'P_HWE', 'PASS']
+
+# copies of every allele (ALLELES, '0' not counted) in the call of every code
+CODE_ALLELE_COUNTS = np.zeros((len(GENOTYPE_CALLS), len(ALLELES)), dtype=np.int64)
+for allele in range(1, len(ALLELES)):
+    CODE_ALLELE_COUNTS[:, allele] = (CALL_ALLELES[:, 0] == allele).astype(np.int64) + (CALL_ALLELES[:, 1] == allele)
+
+def code_classes(a1, a2):
+    # SNPs x codes tables of the calls that are hom A1, het or hom A2 (same rule as codes_to_2bit)
+    first = CALL_ALLELES[None, :, 0]
+    second = CALL_ALLELES[None, :, 1]
+    a1 = a1.reshape(-1, 1)
+    a2 = a2.reshape(-1, 1)
+    first_a1 = (first == a1) & (first != 0)
+    second_a1 = (second == a1) & (second != 0)
+    first_a2 = (first == a2) & (first != 0)
+    second_a2 = (second == a2) & (second != 0)
+    return first_a1 & second_a1, (first_a1 & second_a2) | (first_a2 & second_a1), first_a2 & second_a2
+
+def genotype_counts(codes, rows=None, alleles=None):
+    # Per SNP (row) counts of hom A1, het, hom A2 and missing calls and per sample (column) missing calls,
+    # in blocks of rows: one bincount of (row, code) gives the code histogram of every SNP of the block.
+    # rows = SNPs counted in the sample missingness (default: all),
+    # alleles = (a1, a2) to use, inferred from the codes (A1 = minor allele) if not given
+    m, n = codes.shape
+    counts = np.zeros((m, 4), dtype=np.int64)
+    sample_missing = np.zeros(n, dtype=np.int64)
+    a1_all = np.zeros(m, dtype=np.uint8)
+    a2_all = np.zeros(m, dtype=np.uint8)
+    block = max(1, (1 << 22) // max(n, 1))
+    calls = len(GENOTYPE_CALLS)
+    for start in range(0, m, block):
+        stop = min(start + block, m)
+        index = codes[start:stop].astype(np.intp)
+        index += (np.arange(stop - start) * calls)[:, None]
+        histogram = np.bincount(index.ravel(order='K'), minlength=(stop - start) * calls).reshape(-1, calls)
+        if alleles is None:
+            a1, a2 = alleles_from_counts(histogram @ CODE_ALLELE_COUNTS)
+        else:
+            a1, a2 = alleles[0][start:stop], alleles[1][start:stop]
+        hom_a1, het, hom_a2 = code_classes(a1, a2)
+        counts[start:stop, 0] = (histogram * hom_a1).sum(axis=1)
+        counts[start:stop, 1] = (histogram * het).sum(axis=1)
+        counts[start:stop, 2] = (histogram * hom_a2).sum(axis=1)
+        counts[start:stop, 3] = n - counts[start:stop, :3].sum(axis=1)
+        missing = ~(hom_a1 | het | hom_a2)
+        if rows is not None:
+            missing[~rows[start:stop]] = False
+        sample_missing += np.count_nonzero(missing.ravel()[index], axis=0)
+        a1_all[start:stop] = a1
+        a2_all[start:stop] = a2
+        del index
+    return a1_all, a2_all, counts, sample_missing
+
+def log_factorials(n: int):
+    # log(k!) of k = 0..n
+    table = np.zeros(n + 1)
+    table[1:] = np.cumsum(np.log(np.arange(1, n + 1)))
+    return table
+
+def hwe_exact(hom_a1, het, hom_a2, max_cells: int = 1 << 21):
+    # Exact test of Hardy-Weinberg equilibrium of every SNP (Wigginton et al. 2005, as plink --hwe without midp):
+    # p = sum of the probabilities of the het counts that are not more likely than the observed one,
+    # all het counts of a block of SNPs are evaluated at once from a log-factorial table.
+    # SNPs are sorted by rare allele count so a block holds SNPs of similar width.
+    hom_a1 = np.asarray(hom_a1, dtype=np.int64)
+    het = np.asarray(het, dtype=np.int64)
+    hom_a2 = np.asarray(hom_a2, dtype=np.int64)
+    n = hom_a1 + het + hom_a2
+    rare = np.minimum(2 * hom_a1 + het, 2 * hom_a2 + het)
+    p = np.ones(len(n))
+    if len(n) == 0:
+        return p
+    log_fact = log_factorials(int(2 * n.max()) + 1)
+    log2 = np.log(2)
+    order = np.argsort(rare, kind='stable')
+    start = 0
+    while start < len(order):
+        stop = min(len(order), start + max(1, max_cells // (rare[order[start]] // 2 + 1)))
+        stop = min(stop, start + max(1, max_cells // (rare[order[stop - 1]] // 2 + 1)))
+        snps = order[start:stop]
+        n_rare = rare[snps][:, None]
+        n_common = 2 * n[snps][:, None] - n_rare
+        width = int(rare[snps].max()) // 2 + 1
+        # het counts with the parity of the rare allele count
+        hets = n_rare % 2 + 2 * np.arange(width)[None, :]
+        possible = hets <= n_rare
+        hets = np.minimum(hets, n_rare)
+        log_p = hets * log2 - log_fact[(n_rare - hets) // 2] - log_fact[(n_common - hets) // 2] - log_fact[hets]
+        log_p[~possible] = -np.inf
+        observed = het[snps][:, None]
+        log_observed = observed * log2 - log_fact[(n_rare - observed) // 2] - log_fact[(n_common - observed) // 2] - log_fact[observed]
+        prob = np.exp(log_p - log_p.max(axis=1, keepdims=True))
+        tail = np.where(log_p <= log_observed + 1e-9, prob, 0).sum(axis=1)
+        p[snps] = np.minimum(tail / prob.sum(axis=1), 1)
+        start = stop
+    return p
+
+def snp_qc_table(chr_map: pd.DataFrame, a1, a2, counts, maf: float, geno: float, hwe: float, rows):
+    # SNP report of one chr, rows = SNPs written to the bed files (chr and BP != 0)
+    called = counts[:, :3].sum(axis=1)
+    total = called + counts[:, 3]
+    freq = np.divide(2 * counts[:, 0] + counts[:, 1], 2 * called, out=np.zeros(len(called)), where=called > 0)
+    minor = np.minimum(freq, 1 - freq)
+    f_miss = np.divide(counts[:, 3], total, out=np.ones(len(total)), where=total > 0)
+    p_hwe = hwe_exact(counts[:, 0], counts[:, 1], counts[:, 2])
+    allele_names = np.array(ALLELES, dtype=object)
+    return pd.DataFrame({
+        'chr': chr_map['chr'].to_numpy(),
+        'SNP': chr_map['SNP_id'].to_numpy(),
+        'BP': chr_map['BP'].to_numpy(),
+        'A1': allele_names[a1],
+        'A2': allele_names[a2],
+        'C_HOM_A1': counts[:, 0],
+        'C_HET': counts[:, 1],
+        'C_HOM_A2': counts[:, 2],
+        'C_MISS': counts[:, 3],
+        'MAF': minor,
+        'F_MISS': f_miss,
+        'P_HWE': p_hwe,
+        'PASS': rows & (minor >= maf) & (f_miss <= geno) & (p_hwe >= hwe)})
+
+def genotype_qc(store_folder: Path, snp_map_file: Path, ranges: dict, chrs: list, chunksize: int,
+                maf: float, geno: float, mind: float, hwe: float, snp_report: Path, sample_report: Path):
+    # Pass 1: genotype counts of every SNP and missing calls of every sample (over all chrs, as plink --mind),
+    # pass 2: the samples failing --mind are read again (their columns only) and taken out of the SNP counts
+    snp_map_df = read_snp_map(snp_map_file, ['SNP_id', 'chr', 'BP'])
+    store = GenotypeStore(store_folder)
+    chr_counts = {}
+    chr_rows = {}
+    samples = None
+    sample_missing = None
+    sample_called = 0
+    for chr in chrs:
+        if str(chr) not in ranges:
+            continue
+        start, end = ranges[str(chr)]
+        chr_map = snp_map_df.iloc[start:end + 1]
+        chr_rows[chr] = (start, end + 1)
+        rows = ((chr_map['chr'] != "0") & (chr_map['BP'] != "0")).to_numpy()
+        print("QC: Count genotypes of chr: " + str(chr))
+        parts = []
+        offset = 0
+        for chunk_samples, snp_ids, codes in store.iter_range(start, end + 1, chunksize):
+            with span("qc chunk", chr=str(chr), rows=len(snp_ids), columns=len(chunk_samples), bytes_read=codes.nbytes):
+                a1, a2, counts, missing = genotype_counts(codes, rows[offset:offset + len(snp_ids)])
+            if samples is None:
+                samples = chunk_samples
+                sample_missing = np.zeros(len(samples), dtype=np.int64)
+            sample_missing += missing
+            parts.append((a1, a2, counts))
+            offset += len(snp_ids)
+            del codes
+        sample_called += int(rows.sum())
+        chr_counts[chr] = (chr_map, rows, np.concatenate([a[0] for a in parts]), np.concatenate([a[1] for a in parts]), np.concatenate([a[2] for a in parts]))
+        gc.collect()
+    if samples is None:
+        raise FileNotFoundError(str(store_folder))
+
+    # --mind
+    f_miss = sample_missing / max(sample_called, 1)
+    sample_df = pd.DataFrame({'ID': samples, 'N_MISS': sample_missing, 'N_GENO': sample_called, 'F_MISS': f_miss, 'PASS': f_miss <= mind})
+    removed = sample_df.loc[~sample_df['PASS'], 'ID'].tolist()
+    print("QC: " + str(len(removed)) + " of " + str(len(samples)) + " cases removed by --mind " + str(mind) + ".")
+
+    # --geno, --hwe, --maf on the remaining samples
+    writer = None
+    kept_snps = 0
+    all_snps = 0
+    for chr, (chr_map, rows, a1, a2, counts) in chr_counts.items():
+        if removed:
+            offset = 0
+            for _, snp_ids, codes in store.iter_range(*chr_rows[chr], chunksize, removed):
+                stop = offset + len(snp_ids)
+                counts[offset:stop] -= genotype_counts(codes, alleles=(a1[offset:stop], a2[offset:stop]))[2]
+                offset = stop
+        table = pa.Table.from_pandas(snp_qc_table(chr_map, a1, a2, counts, maf, geno, hwe, rows), preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(str(snp_report), table.schema)
+        writer.write_table(table)
+        kept_snps += int(table.column('PASS').to_numpy().sum())
+        all_snps += int(rows.sum())
+    writer.close()
+    sample_df.to_parquet(sample_report, index=False)
+    print("QC: " + str(kept_snps) + " of " + str(all_snps) + " SNPs passed --geno " + str(geno) + " --hwe " + str(hwe) + " --maf " + str(maf) + ".")
+    del chr_counts, snp_map_df, store
+    gc.collect()
+
+def qc_snp_mask(snp_report: Path, chr: str):
+    # PASS of the SNPs of one chr, in order of the chr SNP map
+    return pq.read_table(snp_report, columns=['PASS'], filters=[('chr', '=', str(chr))]).column('PASS').to_numpy()
+
+def qc_samples(sample_report: Path):
+    # IDs of the samples passing --mind
+    sample_df = pd.read_parquet(sample_report, columns=['ID', 'PASS'])
+    return sample_df.loc[sample_df['PASS'], 'ID'].tolist()
@@ -0,0 +1,125 @@
+from timeit import default_timer as timer
+from pathlib import Path
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from lib.catalog import catalog_sample_index
+from lib.genotype import GENOTYPE_CALLS, ALLELES, infer_alleles, codes_to_2bit, reduce_file_format, reduce_file_samples, packed_table_codes, row_groups_with
+from lib.store import GenotypeStore
+
+# Genotypes of some SNPs of some samples without plink, from the genotype store of a dataset (SNP index and
+# memory-mapped blocks) or from the reduced files (catalog of the samples, row groups pruned by the SNP names):
+#   query(["rs1883832", "rs11569323"], ids, store_folder="patient/SNP_files/store")
+#   python -m lib.query --snps rs1883832,rs11569323 --ids ids.txt --store patient/SNP_files/store --output genotypes.csv
+# One row per sample (ID) and one column per SNP found, in the order asked:
+#   dosage: count of the A1 allele (column <SNP>_<A1> as plink --recodeA), empty if missing; A1 is the minor
+#           allele of all samples of the store (as in the bed files), or of the returned samples for reduced files
+#   calls:  genotype call (eg AG), empty if missing
+FORMATS = ["dosage", "calls"]
+# PLINK 2-bit values (hom A1, missing, het, hom A2) -> count of A1
+DOSAGE = np.array([2, np.nan, 1, 0])
+
+def store_codes(store_folder: Path, snps: list, ids: list = None):
+    # SNPs found, samples, their codes (SNPs x samples) and the codes of all samples (for the alleles)
+    store = GenotypeStore(store_folder)
+    rows = store.find_snps(snps)
+    found = rows >= 0
+    positions = store.sample_positions(ids)
+    samples = [store.samples[i] for i in positions]
+    codes = store.read(rows[found], positions)
+    all_codes = codes if len(positions) == len(store.samples) else store.read(rows[found])
+    return [snp for snp, f in zip(snps, found) if f], samples, codes, all_codes
+
+def reduced_codes(reduce_folder: Path, snps: list, ids: list = None):
+    # SNPs found, samples and their codes (SNPs x samples); a SNP missing on the chip of a file is missing (0)
+    sample_index = catalog_sample_index(reduce_folder, ids)
+    files = {}
+    for sample, reduce_file in sample_index.items():
+        files.setdefault(reduce_file, []).append(sample)
+    wanted = pa.array(snps, type=pa.string())
+    parts = []
+    for reduce_file, samples in files.items():
+        parquet = pq.ParquetFile(reduce_file)
+        row_groups = row_groups_with(parquet, 'SNPs', snps)
+        if not row_groups:
+            continue
+        packed = reduce_file_format(reduce_file) == 'packed'
+        table = parquet.read_row_groups(row_groups, columns=['SNPs', 'A1', 'A2', 'Genotypes'] if packed else ['SNPs'] + samples)
+        table = table.filter(pc.is_in(table.column('SNPs').cast(pa.string()), value_set=wanted))
+        if packed:
+            position = {sample: i for i, sample in enumerate(reduce_file_samples(reduce_file))}
+            part = pd.DataFrame(packed_table_codes(table, [position[sample] for sample in samples]), columns=samples)
+        else:
+            # reduced files written before the uint8 schema keep int64 or float (missing) codes
+            part = table.select(samples).to_pandas().fillna(0).astype(np.uint8)
+        part.index = table.column('SNPs').to_pandas().astype(str)
+        parts.append(part[~part.index.duplicated()])
+    samples = [sample for samples in files.values() for sample in samples]
+    codes_df = pd.concat(parts, axis=1) if parts else pd.DataFrame(index=pd.Index([], dtype=str))
+    found = [snp for snp in snps if snp in codes_df.index]
+    codes = codes_df.reindex(index=found, columns=samples).fillna(0).to_numpy(dtype=np.uint8)
+    return found, samples, codes, codes
+
+def query(snps: list, ids: list = None, format: str = "dosage", store_folder: Path = None, reduce_folder: Path = None):
+    # DataFrame of ID + one column per SNP found (see above), ids = sample IDs (default: all samples)
+    if format not in FORMATS:
+        raise ValueError("format must be one of " + ", ".join(FORMATS) + ": " + str(format))
+    snps = list(dict.fromkeys(str(snp) for snp in snps))
+    ids = None if ids is None else list(dict.fromkeys(str(i) for i in ids))
+    if store_folder is not None:
+        found, samples, codes, all_codes = store_codes(store_folder, snps, ids)
+    elif reduce_folder is not None:
+        found, samples, codes, all_codes = reduced_codes(reduce_folder, snps, ids)
+    else:
+        raise ValueError("query needs a genotype store or a folder of reduced files")
+    if len(found) < len(snps):
+        print(str(len(snps) - len(found)) + " SNPs not found: " + ", ".join(snp for snp in snps if snp not in set(found)))
+    if ids is not None and len(set(samples)) < len(ids):
+        print(str(len(ids) - len(set(samples))) + " samples not found.")
+
+    if format == "calls":
+        calls = np.array(GENOTYPE_CALLS, dtype=object)
+        calls[0] = None
+        genotype_df = pd.DataFrame(calls[codes].T, columns=found)
+    else:
+        a1, a2 = infer_alleles(all_codes)
+        genotype_df = pd.DataFrame(DOSAGE[codes_to_2bit(codes, a1, a2)].T, columns=[snp + "_" + ALLELES[a] for snp, a in zip(found, a1)]).astype("Int8")
+    genotype_df.insert(0, "ID", samples)
+    if ids is not None:
+        # samples in the order asked
+        genotype_df = genotype_df.drop_duplicates(subset="ID").set_index("ID").reindex([i for i in ids if i in set(samples)]).reset_index()
+    return genotype_df
+
+def parse_list(value: str):
+    # Comma-delimited values, or a file with one value per line
+    if os.path.isfile(value):
+        with open(value) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Genotypes of some SNPs of some samples from the genotype store or the reduced files")
+    parser.add_argument("--snps", required=True, type=str, help="SNPs to read, comma-delimited (eg rs1883832,rs11569323) or a file with one SNP per line")
+    parser.add_argument("--ids", type=str, help="Sample IDs to read, comma-delimited or a file with one ID per line (default: all samples)")
+    parser.add_argument("--format", type=str, default="dosage", choices=FORMATS, help="Count of the A1 allele (dosage) or genotype calls (default: dosage)")
+    parser.add_argument("--store", type=Path, help="Genotype store of a dataset (eg <dataset>/SNP_files/store)")
+    parser.add_argument("--SNP_folder", type=Path, help="Folder of reduced SNP files, used if there is no --store")
+    parser.add_argument("--output", type=Path, help="CSV file of the genotypes (default: print them)")
+    args = parser.parse_args()
+    if args.store is None and args.SNP_folder is None:
+        parser.error("--store or --SNP_folder is required")
+
+    start = timer()
+    genotype_df = query(parse_list(args.snps), parse_list(args.ids) if args.ids else None, args.format, args.store, args.SNP_folder)
+    if args.output:
+        genotype_df.to_csv(args.output, index=False)
+        print("Exported " + str(len(genotype_df)) + " samples x " + str(genotype_df.shape[1] - 1) + " SNPs to " + str(args.output) + " in " + format(timer() - start, ".2f") + " s.")
+    else:
+        print(genotype_df.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import ctypes
+import os
+import sys
+from lib.trace import span
+
+def available_memory_mb():
+    # Free physical memory of the host (MB), None if it cannot be read
+    try:
+        if sys.platform == "win32":
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullAvailPhys // (1024 * 1024)
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_chr_memory_mb(snps: int, samples: int, chunk_size: int, bed_writer: str):
+    # Rough peak memory of Parts 4-6 of one chr in a worker process
+    # (codes are read from the memory-mapped genotype store, the page cache is not counted)
+    base = 300
+    if bed_writer == "native":
+        # one chunk of codes plus allele / 2-bit temporaries
+        return base + min(snps, chunk_size) * samples * 12 // (1024 * 1024)
+    # one chunk of codes rendered to csv, then a sample block of codes and its rendered ped bytes
+    return base + 128 + min(snps, chunk_size) * samples * 12 // (1024 * 1024)
+
+def estimate_plink_memory_mb(snps: int, samples: int):
+    # plink --make-bed keeps 2-bit genotypes of the chr plus its workspace
+    return 256 + snps * samples // 2 // (1024 * 1024)
+
+def estimate_prune_memory_mb(snps: int, ld_memory_mb: int):
+    # LD pruning of one chr: its .bim table and r2 pairs plus the tile budget (the .bed is memory-mapped)
+    return 300 + snps * 256 // (1024 * 1024) + ld_memory_mb
+
+def estimate_plot_memory_mb(snps: int):
+    # Plots of Part 9 in process: the association table read from parquet / text and the plot arrays
+    return 300 + snps * 200 // (1024 * 1024)
+
+def run_job(name: str, memory_mb: int, func, args: tuple):
+    # Python part of a job in a worker process, traced (and profiled) as one span
+    with span("job", profile=True, job=name, memory_mb=memory_mb):
+        return func(*args)
+
+class MemoryGate:
+    # Admit jobs while the sum of their estimated memory stays under the limit,
+    # a job larger than the limit still runs when nothing else is running
+    def __init__(self, limit_mb: int):
+        self.limit_mb = limit_mb
+        self.used_mb = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, memory_mb: int):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used_mb == 0 or self.used_mb + memory_mb <= self.limit_mb)
+            self.used_mb += memory_mb
+
+    async def release(self, memory_mb: int):
+        async with self.condition:
+            self.used_mb -= memory_mb
+            self.condition.notify_all()
+
+async def run_jobs_async(jobs: list, workers: int, memory_limit_mb: int):
+    loop = asyncio.get_running_loop()
+    gate = MemoryGate(memory_limit_mb)
+    slots = asyncio.Semaphore(max(workers, 1))
+    results = [None] * len(jobs)
+
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        async def run(i: int, job: dict):
+            start = timer()
+            error = ""
+            try:
+                # Python part of the job in the process pool
+                async with slots:
+                    await gate.acquire(job["memory_mb"])
+                    try:
+                        print("Start job: " + job["name"] + " (estimated " + str(job["memory_mb"]) + " MB)")
+                        await loop.run_in_executor(executor, run_job, job["name"], job["memory_mb"], job["func"], job["args"])
+                    finally:
+                        await gate.release(job["memory_mb"])
+                # then its commands (eg plink) as async subprocesses
+                for command, memory_mb in job.get("commands", []):
+                    async with slots:
+                        await gate.acquire(memory_mb)
+                        try:
+                            command_start = timer()
+                            with span("command", job=job["name"], program=command.split()[0], command=command, memory_mb=memory_mb) as record:
+                                process = await asyncio.create_subprocess_shell(command)
+                                returncode = await process.wait()
+                                record["returncode"] = returncode
+                            print("Command of job " + job["name"] + " finished in " + format(timer() - command_start, ".1f") + " s.")
+                        finally:
+                            await gate.release(memory_mb)
+                    if returncode != 0:
+                        raise RuntimeError("command exited with code " + str(returncode) + ": " + command)
+            except Exception as e:
+                error = repr(e)
+            results[i] = {"name": job["name"], "seconds": timer() - start, "error": error}
+            print("Finish job: " + job["name"] + " in " + format(results[i]["seconds"], ".1f") + " s" + (" (FAILED: " + error + ")" if error else "."))
+
+        await asyncio.gather(*(run(i, job) for i, job in enumerate(jobs)))
+    return results
+
+def run_jobs(jobs: list, workers: int, memory_limit_mb: int):
+    # Run jobs ({name, memory_mb, func, args, commands: [(command, memory_mb)]}) at the same time,
+    # at most `workers` running and their estimated memory under memory_limit_mb
+    return asyncio.run(run_jobs_async(jobs, workers, memory_limit_mb))
@@ -1,73 +1,118 @@
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import gc
+from lib.genotype import read_reduce_file
+from lib.catalog import catalog_sample_index
+from lib.snpmap import read_snp_map
+from lib.trace import span, file_size
 
-def select_reduce_by_id(reduce_folder: Path, filter_file: Path, temp_folder: Path):
-    filter_df = pd.read_csv(filter_file)
-    id_list = filter_df['ID'].tolist()
+def select_reduce_by_id(reduce_folder: Path, filter_file: Path, temp_folder: Path, ids: list = None):
+    # ids = cases to select instead of all cases of the ID filter (eg only the new cases when appending),
+    # returns the reduced files that were read
+    filter_df = pd.read_csv(filter_file, dtype={'ID': str})
+    id_list = filter_df['ID'].tolist() if ids is None else [str(i) for i in ids]
     print("There are " + str(len(id_list)) + " cases in the ID filter.")
 
-    files = [str(f) for f in Path(reduce_folder).iterdir() if f.match("*.parquet")]
+    files = [str(f.resolve()) for f in Path(reduce_folder).iterdir() if f.match("*.parquet")]
     files.sort()
     print("There are " + str(len(files)) + " files in the folder.")
 
-    selected_id_df = pd.DataFrame()
+    # Group the wanted IDs by file (sample ID -> file from the catalog), keeping the column order of each file
+    sample_index = catalog_sample_index(reduce_folder)
+    wanted_ids = set(id_list)
+    file_ids = {}
+    for sample, file in sample_index.items():
+        if sample in wanted_ids:
+            file_ids.setdefault(file, []).append(sample)
+    not_found = wanted_ids - set(sample_index)
+    print("Indexed " + str(len(sample_index)) + " cases in the folder, " + str(len(file_ids)) + " files have cases in the ID filter.")
+
     num = 1
     zfill_num = len(str(len(files)))
-
+    remaining = len(wanted_ids)
     for i in range(len(files)):
-        df = pd.read_parquet(files[i])
-        try:
-            matched_id_df = df[df.columns.intersection(id_list)]
-            if len(matched_id_df.columns) > 0:
-                # Add back column SNP_id
-                matched_id_df.insert(0, "SNP_id", df['SNPs'])
-            
-                # remove matched ID from id_list
-                ids_to_remove = matched_id_df.columns.to_list()
-                id_list = [item for item in id_list if item not in ids_to_remove]
-                print("Found "+ str(len(matched_id_df.columns)) + " cases in file: " + Path(files[i]).stem +". Saving temp file " + str(num).zfill(zfill_num) + " ... There are " + str(len(id_list)) + " cases not found yet.")
-                matched_id_df.to_parquet(str(temp_folder) + r"/temp_" + str(num).zfill(zfill_num) + r".parquet", index=False)
-                num += 1
-        except KeyError:
+        if files[i] not in file_ids:
             continue
-        
-    del filter_df, id_list, df, matched_id_df, selected_id_df
+        # Read only the matched columns
+        temp_file = str(temp_folder) + r"/temp_" + str(num).zfill(zfill_num) + r".parquet"
+        with span("select file", file=Path(files[i]).name, columns=len(file_ids[files[i]])) as record:
+            matched_id_df = read_reduce_file(files[i], columns=file_ids[files[i]])
+            matched_id_df.rename(columns={'SNPs': 'SNP_id'}, inplace=True)
+            remaining -= len(file_ids[files[i]])
+            print("Found "+ str(len(file_ids[files[i]])) + " cases in file: " + Path(files[i]).stem +". Saving temp file " + str(num).zfill(zfill_num) + " ... There are " + str(remaining) + " cases not found yet.")
+            matched_id_df.to_parquet(temp_file, index=False)
+            record.update(rows=len(matched_id_df), bytes_read=int(matched_id_df.memory_usage(deep=False).sum()), bytes_written=file_size(temp_file))
+        num += 1
+        del matched_id_df
+        gc.collect()
+
+    if not_found:
+        print(str(len(not_found)) + " cases in the ID filter were not found in any file.")
+    sources = [f for f in files if f in file_ids]
+    del filter_df, id_list, sample_index, file_ids
     gc.collect()
+    return sources
 
 def selected_chr_SNP_map(selected_chr: str, snp_map_file: Path, selected_chr_file: Path):
-    SNP_df = pd.read_csv(snp_map_file, low_memory=False)
-    selected_chr_df = SNP_df[SNP_df['chr'] == str(selected_chr)]
+    # SNPs of the chr: its row group of the sorted map
+    selected_chr_df = read_snp_map(snp_map_file, ['chr', 'SNP_id', 'BP'], selected_chr)
     selected_chr_df.to_csv(selected_chr_file, index=False)
-    del SNP_df, selected_chr_df
+    del selected_chr_df
     gc.collect()
 
+def window_min(values, lo, hi):
+    # min of values[lo[i]:hi[i]] (hi > lo) for every i, from a sparse table of minimums over 2^j elements
+    # (only up to the longest window)
+    length = hi - lo
+    levels = [values]
+    while 2 ** len(levels) <= length.max():
+        k = 2 ** (len(levels) - 1)
+        levels.append(np.minimum(levels[-1][:-k], levels[-1][k:]))
+    level = np.frexp(length)[1] - 1
+    result = np.empty(len(values), dtype=values.dtype)
+    for j in np.unique(level):
+        at = level == j
+        result[at] = np.minimum(levels[j][lo[at]], levels[j][hi[at] - 2 ** j])
+    return result
+
+def distance_clump(chrs, bp, p, distance: int):
+    # Greedy best-P clumping by distance: the SNP with the smallest P is kept and every SNP within `distance` BP
+    # of it on the same chr is dropped, then the next best remaining SNP, and so on. SNPs must be sorted by chr and BP.
+    # Every round keeps all remaining SNPs that have the smallest P of their window (they are kept by the greedy order too),
+    # ties of P go to the first SNP, missing P last
+    n = len(bp)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    # one coordinate for all chr, chr are more than `distance` apart
+    chr_index = np.r_[0, np.cumsum(chrs[1:] != chrs[:-1])]
+    bp = np.asarray(bp, dtype=np.int64)
+    pos = bp - bp.min() + chr_index * (bp.max() - bp.min() + 2 * distance + 1)
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.lexsort((np.arange(n), p))] = np.arange(n)
+    index = np.arange(n)
+    while len(index):
+        lo = np.searchsorted(pos, pos - distance, side='left')
+        hi = np.searchsorted(pos, pos + distance, side='right')
+        best = rank == window_min(rank, lo, hi)
+        keep[index[best]] = True
+        # drop the SNPs within the distance of the kept ones
+        cover = np.zeros(len(pos) + 1, dtype=np.int64)
+        np.add.at(cover, lo[best], 1)
+        np.add.at(cover, hi[best], -1)
+        remaining = np.cumsum(cover[:-1]) == 0
+        index, pos, rank = index[remaining], pos[remaining], rank[remaining]
+    return keep
+
 def select_clump_snp(clump_file: Path, clump_kb:int, final_clump_file: Path):
+    # Keep the best SNP (smallest P) of every clump_kb window, works on a plink .clumped file or a whole association file
     clump_snp = pd.read_table(clump_file, sep = "\s+")
-    clump_snp.sort_values(by=["CHR","BP"], inplace=True, ascending=True)
+    clump_snp.sort_values(by=["CHR","BP"], inplace=True, ascending=True, kind='stable')
     clump_snp.reset_index(drop=True, inplace=True)
-    final_snp_list = []
-    for i in range(0, clump_snp.shape[0]):
-        if i == 0:
-            final_snp_list.append(clump_snp.loc[i, ])
-        else:
-            if clump_snp['CHR'][i] != clump_snp['CHR'][i-1]:
-                final_snp_list.append(clump_snp.loc[i, ])
-            else:
-                # Check if the difference is within the threshold (num kb)
-                if clump_snp['BP'][i] - clump_snp['BP'][i-1] > clump_kb * 1000:
-                    final_snp_list.append(clump_snp.loc[i, ])
-                else:
-                    # Compare the p-values and keep the SNP with the smaller p-value
-                    if clump_snp['P'][i] < clump_snp['P'][i-1]:
-                        if clump_snp['BP'][i] - final_snp_list[-1]['BP'] > clump_kb * 1000:
-                            final_snp_list.append(clump_snp.loc[i, ])
-                        else:
-                            if clump_snp['P'][i] < final_snp_list[-1]['P']:
-                                final_snp_list[-1] = clump_snp.loc[i, ]
-    final_df = pd.concat(final_snp_list, axis=1).T
-    final_df['P'] = final_df['P'].astype('float')
-    final_df.reset_index(drop=True, inplace=True)
+    clump_snp['P'] = pd.to_numeric(clump_snp['P'], errors='coerce')
+    keep = distance_clump(clump_snp['CHR'].to_numpy(), clump_snp['BP'].to_numpy(), clump_snp['P'].to_numpy(), clump_kb * 1000)
+    final_df = clump_snp[keep].reset_index(drop=True)
     final_df.to_csv(final_clump_file, index=False)
 
 def select_top_list(top_list_file: Path):
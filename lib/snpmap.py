@@ -0,0 +1,75 @@
+from pathlib import Path
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Sorted SNP map of the dataset as one parquet file: SNP_id, chr, BP (as in the source map) sorted by chr in
+# CHR_ORDER then by BP, one row group per chr, and the chr ranges (chr -> first, last row) in the file metadata,
+# so the rows of a chr are read without parsing the rest of the map.
+# chr not in CHR_ORDER come after it in sorted order.
+CHR_ORDER = [str(i) for i in range(1, 23)] + ["X", "Y", "XY", "MT"]
+RANGES_KEY = b"chr_ranges"
+
+def chr_labels(values):
+    # chr as text, numbers (eg 1, or 1.0 read from a column with missing values) as integers
+    labels = []
+    for value in values:
+        label = str(value).strip()
+        try:
+            number = float(label)
+            if number == int(number):
+                label = str(int(number))
+        except (ValueError, OverflowError):
+            pass
+        labels.append(label)
+    return labels
+
+def sort_snp_map(snp_df: pd.DataFrame):
+    # Sorted map (index reset) and chr -> (start, end) rows: chr codes in CHR_ORDER (labels of the distinct
+    # values only), a stable sort by chr code and numeric BP, and the ranges by searchsorted on the sorted codes
+    value_codes, values = pd.factorize(snp_df['chr'], use_na_sentinel=False)
+    labels = chr_labels(values)
+    others = sorted(set(labels) - set(CHR_ORDER))
+    rank = {chr: i for i, chr in enumerate(CHR_ORDER + others)}
+    chr_codes = np.array([rank[label] for label in labels], dtype=np.int16)[value_codes]
+    # BP that is not a number goes last in its chr
+    bp = snp_df['BP'] if pd.api.types.is_numeric_dtype(snp_df['BP']) else pd.to_numeric(snp_df['BP'], errors='coerce')
+    bp = bp.to_numpy(dtype=np.float64)
+    bp = np.where(np.isnan(bp), np.inf, bp)
+    order = np.lexsort((bp, chr_codes))
+    snp_df = snp_df.iloc[order].reset_index(drop=True)
+    snp_df['chr'] = np.array(labels, dtype=object)[value_codes[order]]
+    sorted_codes = chr_codes[order]
+    categories = np.arange(len(CHR_ORDER) + len(others))
+    starts = np.searchsorted(sorted_codes, categories, side='left')
+    ends = np.searchsorted(sorted_codes, categories, side='right')
+    ranges = {(CHR_ORDER + others)[c]: (int(starts[c]), int(ends[c]) - 1) for c in categories if ends[c] > starts[c]}
+    return snp_df, ranges
+
+def write_snp_map(snp_df: pd.DataFrame, ranges: dict, outputfilename: Path):
+    # SNP_id, chr, BP as text (as they are written to the map / bim files), one row group per chr
+    arrays = []
+    for column in ['SNP_id', 'chr', 'BP']:
+        array = pa.array(snp_df[column], from_pandas=True)
+        arrays.append(array if array.type == pa.string() else array.cast(pa.string()))
+    table = pa.Table.from_arrays(arrays, names=['SNP_id', 'chr', 'BP']).replace_schema_metadata({RANGES_KEY: json.dumps(ranges).encode()})
+    with pq.ParquetWriter(outputfilename, table.schema, use_dictionary=['chr']) as writer:
+        for start, end in ranges.values():
+            writer.write_table(table.slice(start, end - start + 1), row_group_size=end - start + 1)
+
+def snp_map_ranges(snp_map_file: Path):
+    # chr -> (start, end) rows of the sorted map, from the file metadata
+    metadata = pq.read_schema(snp_map_file).metadata
+    return {chr: (start, end) for chr, (start, end) in json.loads(metadata[RANGES_KEY]).items()}
+
+def read_snp_map(snp_map_file: Path, columns: list = None, chr: str = None):
+    # The sorted map (all columns as text), or only the rows of one chr (its row group, empty if not in the map)
+    columns = columns or ['SNP_id', 'chr', 'BP']
+    if chr is None:
+        return pq.read_table(snp_map_file, columns=columns).to_pandas()
+    ranges = snp_map_ranges(snp_map_file)
+    if str(chr) not in ranges:
+        return pd.DataFrame({column: pd.Series(dtype=str) for column in columns})
+    return pq.ParquetFile(snp_map_file).read_row_group(list(ranges).index(str(chr)), columns=columns).to_pandas()
@@ -0,0 +1,223 @@
+from pathlib import Path
+import gc
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lib.cache import replace_output
+from lib.genotype import row_groups_with
+from lib.snpmap import read_snp_map
+from lib.trace import span, file_size
+
+# Genotype store of the merged files: one dense uint8 matrix of codes per merged file (SNPs x its samples,
+# SNP-major .npy, rows in order of the sorted SNP map) opened with numpy.memmap, and two sidecars:
+#   snps.parquet: SNP_id, chr, BP of every row
+#   snp_index.parquet: SNP_id -> row, sorted by SNP_id, a lookup reads only the row groups whose range holds the IDs
+#   samples.csv:  ID, block (matrix file) and column of every sample
+#   blocks.csv:   block, its merged file and the mtime, size of that file
+# A chr is a range of rows, so its slice of every block is contiguous on disk and read through the page cache.
+STORE_SNPS = "snps.parquet"
+STORE_SNP_INDEX = "snp_index.parquet"
+STORE_SAMPLES = "samples.csv"
+STORE_BLOCKS = "blocks.csv"
+
+def merged_file_list(merged_folder: Path):
+    # Merged files in order of their number (merged_<number>_<columns>.parquet), appended files come last
+    def number(f):
+        try:
+            return int(Path(f).stem.split("_")[1])
+        except (IndexError, ValueError):
+            return 0
+    return sorted((str(f) for f in Path(merged_folder).iterdir() if f.match("*.parquet")), key=lambda f: (number(f), f))
+
+def store_block(merged_file: Path, block_file: Path, snps: int):
+    # Copy one merged file row group by row group into a block, returns its sample IDs
+    merged = pq.ParquetFile(merged_file)
+    samples = merged.schema_arrow.names[1:]
+    if merged.metadata.num_rows != snps:
+        raise ValueError(str(merged_file) + " has " + str(merged.metadata.num_rows) + " SNPs, the SNP map has " + str(snps) + ".")
+    block = np.lib.format.open_memmap(block_file, mode='w+', dtype=np.uint8, shape=(snps, len(samples)))
+    offset = 0
+    for rg in range(merged.num_row_groups):
+        table = merged.read_row_group(rg)
+        rows = table.num_rows
+        # columns are contiguous in the row group, rows in the block: one transposed copy
+        codes = np.empty((len(samples), rows), dtype=np.uint8)
+        for j, column in enumerate(table.columns[1:]):
+            codes[j] = column.to_numpy(zero_copy_only=False)
+        block[offset:offset + rows] = codes.T
+        offset += rows
+        del table, codes
+    block.flush()
+    del block
+    gc.collect()
+    return samples
+
+def write_snp_index(snp_ids: pd.Series, index_file: Path):
+    index_df = pd.DataFrame({'SNP_id': snp_ids.astype(str).to_numpy(), 'row': np.arange(len(snp_ids), dtype=np.int64)})
+    index_df = index_df.sort_values(by='SNP_id', kind='stable')
+    pq.write_table(pa.Table.from_pandas(index_df, preserve_index=False), str(index_file) + r".tmp", row_group_size=65536, use_dictionary=False)
+    os.replace(str(index_file) + r".tmp", index_file)
+
+def reusable_blocks(store_folder: Path, file_list: list, snp_map_df: pd.DataFrame):
+    # Blocks of an existing store that can be kept (block -> merged file), None if the store has to be rebuilt:
+    # missing store, other SNP map, or a merged file of a block changed or removed
+    store_folder = Path(store_folder)
+    if not os.path.exists(store_folder / STORE_BLOCKS) or not os.path.exists(store_folder / STORE_SNPS):
+        return None
+    if not pq.read_table(store_folder / STORE_SNPS).to_pandas().equals(snp_map_df[['SNP_id', 'chr', 'BP']]):
+        return None
+    sources = {Path(f).name: f for f in file_list}
+    blocks_df = pd.read_csv(store_folder / STORE_BLOCKS, dtype={'block': str, 'source': str})
+    for source, mtime, size in zip(blocks_df['source'], blocks_df['mtime'], blocks_df['size']):
+        if source not in sources or (os.stat(sources[source]).st_mtime, os.stat(sources[source]).st_size) != (mtime, size):
+            return None
+    return dict(zip(blocks_df['block'], blocks_df['source']))
+
+def build_genotype_store(merged_folder: Path, snp_map_file: Path, store_folder: Path):
+    # One block per merged file; blocks of merged files that did not change are kept and only new merged files
+    # (eg cases appended to the dataset) are copied, otherwise the store is rebuilt in a temp folder.
+    # Blocks are written as <block>.tmp and renamed, a half-written block is never used
+    file_list = merged_file_list(merged_folder)
+    print("There are " + str(len(file_list)) + " merged files in the folder.")
+    snp_map_df = read_snp_map(snp_map_file, ['SNP_id', 'chr', 'BP'])
+    kept = reusable_blocks(store_folder, file_list, snp_map_df)
+    if kept is None:
+        target_folder = Path(str(store_folder) + r".tmp")
+        if os.path.exists(target_folder):
+            shutil.rmtree(target_folder)
+        target_folder.mkdir(parents=True)
+        kept = {}
+        sample_df = pd.DataFrame({'ID': [], 'block': [], 'column': []})
+    else:
+        target_folder = Path(store_folder)
+        sample_df = pd.read_csv(target_folder / STORE_SAMPLES, dtype={'ID': str, 'block': str})
+        print("Genotype store: keep " + str(len(kept)) + " blocks.")
+    sources = {source: block for block, source in kept.items()}
+    sample_rows = []
+    block_rows = []
+    for f in file_list:
+        source = Path(f).name
+        if source in sources:
+            block_name = sources[source]
+            sample_rows.append(sample_df[sample_df['block'] == block_name])
+        else:
+            print("Storing file: " + f)
+            block_name = Path(f).stem + r".npy"
+            with span("store block", file=source, rows=len(snp_map_df), bytes_read=file_size(f)) as record:
+                samples = store_block(f, target_folder / (block_name + r".tmp"), len(snp_map_df))
+                os.replace(target_folder / (block_name + r".tmp"), target_folder / block_name)
+                record.update(columns=len(samples), bytes_written=file_size(target_folder / block_name))
+            sample_rows.append(pd.DataFrame({'ID': samples, 'block': block_name, 'column': np.arange(len(samples))}))
+        stat = os.stat(f)
+        block_rows.append({'block': block_name, 'source': source, 'mtime': stat.st_mtime, 'size': stat.st_size})
+    # sidecars last, the store only lists finished blocks
+    if not os.path.exists(target_folder / STORE_SNPS):
+        pq.write_table(pa.Table.from_pandas(snp_map_df, preserve_index=False), target_folder / STORE_SNPS)
+    if not os.path.exists(target_folder / STORE_SNP_INDEX):
+        write_snp_index(snp_map_df['SNP_id'], target_folder / STORE_SNP_INDEX)
+    sample_df = pd.concat(sample_rows, ignore_index=True) if sample_rows else sample_df
+    sample_df.to_csv(target_folder / (STORE_SAMPLES + r".tmp"), index=False)
+    os.replace(target_folder / (STORE_SAMPLES + r".tmp"), target_folder / STORE_SAMPLES)
+    pd.DataFrame(block_rows, columns=['block', 'source', 'mtime', 'size']).to_csv(target_folder / (STORE_BLOCKS + r".tmp"), index=False)
+    os.replace(target_folder / (STORE_BLOCKS + r".tmp"), target_folder / STORE_BLOCKS)
+    print("Genotype store: " + str(len(snp_map_df)) + " SNPs x " + str(len(sample_df)) + " cases.")
+    if target_folder != Path(store_folder):
+        replace_output(target_folder, store_folder)
+
+class GenotypeStore:
+    def __init__(self, store_folder: Path):
+        self.store_folder = Path(store_folder)
+        if not os.path.exists(self.store_folder / STORE_SAMPLES):
+            raise FileNotFoundError(str(self.store_folder))
+        sample_df = pd.read_csv(self.store_folder / STORE_SAMPLES, dtype={'ID': str, 'block': str})
+        self.samples = sample_df['ID'].tolist()
+        self.block_names = list(dict.fromkeys(sample_df['block']))
+        self.sample_block = sample_df['block'].map({name: i for i, name in enumerate(self.block_names)}).to_numpy()
+        self.sample_column = sample_df['column'].to_numpy()
+        self.blocks = [np.load(self.store_folder / name, mmap_mode='r') for name in self.block_names]
+        # the SNP table is read when first used, a query of a few SNPs uses the SNP index only
+        self.snp_table = None
+
+    @property
+    def snps(self):
+        if self.snp_table is None:
+            self.snp_table = pq.read_table(self.store_folder / STORE_SNPS).to_pandas()
+        return self.snp_table
+
+    def chr_range(self, chr: str):
+        # [start, stop) rows of one chr, (0, 0) if the chr is not in the store
+        rows = np.flatnonzero(self.snps['chr'].to_numpy() == str(chr))
+        if len(rows) == 0:
+            return 0, 0
+        return int(rows[0]), int(rows[-1]) + 1
+
+    def snp_rows(self, snp_ids: list):
+        # Row of every SNP_id (-1 if not in the store)
+        return pd.Index(self.snps['SNP_id']).get_indexer(pd.Index([str(snp) for snp in snp_ids]))
+
+    def find_snps(self, snp_ids: list):
+        # Row of every SNP_id (-1 if not in the store) from the SNP index, made first for stores built without it
+        index_file = self.store_folder / STORE_SNP_INDEX
+        if not os.path.exists(index_file):
+            write_snp_index(self.snps['SNP_id'], index_file)
+        snp_ids = [str(snp) for snp in snp_ids]
+        index = pq.ParquetFile(index_file)
+        row_groups = row_groups_with(index, 'SNP_id', snp_ids)
+        if not row_groups:
+            return np.full(len(snp_ids), -1, dtype=np.int64)
+        found = index.read_row_groups(row_groups).to_pandas()
+        found = found[found['SNP_id'].isin(snp_ids)].drop_duplicates(subset='SNP_id')
+        positions = pd.Index(found['SNP_id']).get_indexer(snp_ids)
+        return np.where(positions >= 0, found['row'].to_numpy(dtype=np.int64)[np.maximum(positions, 0)] if len(found) else -1, -1)
+
+    def sample_positions(self, ids: list = None):
+        # Positions of the wanted sample IDs in store order (default: all samples)
+        if ids is None:
+            return np.arange(len(self.samples))
+        wanted = set(str(i) for i in ids)
+        return np.array([i for i, sample in enumerate(self.samples) if sample in wanted], dtype=np.int64)
+
+    def block_views(self, start: int, stop: int):
+        # Zero-copy views of the rows [start, stop) of every block
+        return [block[start:stop] for block in self.blocks]
+
+    def read(self, rows, positions=None):
+        # Codes of the rows (slice or row indices) x samples at the positions (default: all), SNPs x samples uint8
+        positions = self.sample_positions() if positions is None else np.asarray(positions, dtype=np.int64)
+        n = len(range(len(self.snps))[rows]) if isinstance(rows, slice) else len(rows)
+        codes = np.empty((n, len(positions)), dtype=np.uint8, order='F')
+        for b, block in enumerate(self.blocks):
+            at = np.flatnonzero(self.sample_block[positions] == b)
+            if len(at) == 0:
+                continue
+            columns = self.sample_column[positions[at]]
+            if len(columns) == block.shape[1] and np.array_equal(columns, np.arange(block.shape[1])):
+                codes[:, at] = block[rows]
+            elif isinstance(rows, slice):
+                codes[:, at] = block[rows][:, columns]
+            else:
+                # only the wanted cells of the block are gathered
+                codes[:, at] = block[np.ix_(np.asarray(rows), columns)]
+        return codes
+
+    def iter_range(self, start: int, stop: int, chunksize: int, ids: list = None):
+        # Stream the rows [start, stop) by chunks of SNPs: yields (sample IDs, SNP_id, SNPs x samples uint8 codes),
+        # ids = sample IDs to read (default: all samples), in store order
+        positions = self.sample_positions(ids)
+        samples = [self.samples[i] for i in positions]
+        snp_ids = self.snps['SNP_id']
+        for first in range(start, stop, max(chunksize, 1)):
+            last = min(first + chunksize, stop)
+            with span("store read", rows=last - first, columns=len(positions)) as record:
+                codes = self.read(slice(first, last), positions)
+                record["bytes_read"] = codes.nbytes
+            yield samples, snp_ids.iloc[first:last].tolist(), codes
+
+    def iter_chr(self, chr: str, chunksize: int, ids: list = None):
+        start, stop = self.chr_range(chr)
+        if start == stop:
+            raise FileNotFoundError(str(self.store_folder) + r": chr " + str(chr))
+        return self.iter_range(start, stop, chunksize, ids)
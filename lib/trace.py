@@ -0,0 +1,220 @@
+from timeit import default_timer as timer
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+import cProfile
+import ctypes
+import json
+import os
+import sys
+import time
+
+# Trace of a run as JSON lines (--trace <file>): one line per span (a stage, a file, a chunk, a job or a command)
+# with wall time, CPU time of the process and of its finished child processes (plink, R), memory and what the
+# span counted (rows, columns, bytes_read, bytes_written, ...; bytes_read is the size of the input file, or of the
+# decoded data if only a part of a file is read). The trace file, run id and profiler are passed to worker
+# processes by environment variables, every process appends its own lines.
+# With --profile, the outermost profiled span of every process (stages, jobs) is dumped to <trace>.profiles/.
+# Memory of a span:
+#   rss_start_mb / rss_end_mb: resident memory of the process when the span starts / ends
+#   process_peak_rss_mb:       peak of the process since it started, not of the span (worker processes run many jobs)
+#   max_child_rss_mb:          peak of the largest child process finished so far, not of the children of the span
+TRACE_ENV = "SNP_TRACE_FILE"
+RUN_ENV = "SNP_TRACE_RUN"
+PROFILE_ENV = "SNP_TRACE_PROFILE"
+PROFILERS = ["cprofile", "pyinstrument"]
+current_span = ContextVar("current_span", default=None)
+active_profile = [None]
+
+def start_trace(trace_file: Path, profiler: str = None):
+    # Trace this process and the processes it starts, returns the run id
+    trace_file = Path(trace_file).resolve()
+    trace_file.parent.mkdir(parents=True, exist_ok=True)
+    os.environ[TRACE_ENV] = str(trace_file)
+    os.environ[RUN_ENV] = time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid())
+    if profiler:
+        os.environ[PROFILE_ENV] = profiler
+    print("Trace: " + str(trace_file) + " (run " + os.environ[RUN_ENV] + ")" + (", profiler " + profiler if profiler else ""))
+    return os.environ[RUN_ENV]
+
+def tracing():
+    return os.environ.get(TRACE_ENV) is not None
+
+def windows_memory_counters():
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+    ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+    return counters
+
+def peak_memory_mb(children: bool = False):
+    # Peak resident memory (MB) of this process since it started (or of its largest finished child process, POSIX only),
+    # pages of memory-mapped files count too; None if it cannot be read
+    try:
+        if sys.platform == "win32":
+            return None if children else windows_memory_counters().PeakWorkingSetSize / (1024 * 1024)
+        import resource
+        # ru_maxrss is in KB (bytes on macOS)
+        unit = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss * unit / (1024 * 1024)
+    except (AttributeError, ImportError, OSError):
+        return None
+
+def memory_mb():
+    # Resident memory (MB) of this process now (Windows and Linux), None if it cannot be read
+    try:
+        if sys.platform == "win32":
+            return windows_memory_counters().WorkingSetSize / (1024 * 1024)
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def cpu_seconds():
+    # CPU time of this process and of its finished child processes (the children are 0 on Windows)
+    t = os.times()
+    return t.user + t.system, t.children_user + t.children_system
+
+def file_size(path: Path):
+    # size of a file or of all files of a folder, 0 if missing
+    if os.path.isdir(path):
+        return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def start_profile(name: str):
+    # Profile of the outermost profiled span of the process, None if profiling is off or already running
+    kind = os.environ.get(PROFILE_ENV)
+    if not kind or active_profile[0] is not None:
+        return None
+    if kind == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+        except ImportError:
+            print("Trace: pyinstrument is not installed (pip install pyinstrument), using cProfile.")
+            os.environ[PROFILE_ENV] = kind = "cprofile"
+    if kind == "pyinstrument":
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    active_profile[0] = (kind, profiler, name)
+    return active_profile[0]
+
+def stop_profile(profile):
+    kind, profiler, name = profile
+    active_profile[0] = None
+    profile_folder = Path(os.environ[TRACE_ENV] + r".profiles")
+    profile_folder.mkdir(parents=True, exist_ok=True)
+    stem = "".join(c if c.isalnum() else "_" for c in name) + "_" + os.environ.get(RUN_ENV, "") + "_" + str(os.getpid())
+    if kind == "pyinstrument":
+        profiler.stop()
+        with open(profile_folder / (stem + r".html"), 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(profile_folder / (stem + r".prof"))
+
+def write_span(record: dict):
+    # one write per line, lines of processes appending at the same time do not mix
+    # (NumPy numbers as numbers, paths and the rest as strings)
+    with open(os.environ[TRACE_ENV], 'a', encoding='utf-8', newline='\n') as f:
+        f.write(json.dumps(record, default=lambda v: v.item() if hasattr(v, "item") else str(v)) + '\n')
+
+def begin_span(name: str, **fields):
+    # Start of a span that ends somewhere else (eg a stage of the stage cache), None if not tracing
+    if not tracing():
+        return None
+    return {"span": name, "parent": current_span.get(), "fields": fields, "start_time": time.time(), "start": timer(), "cpu": cpu_seconds(), "rss": memory_mb()}
+
+def end_span(handle: dict, error: str = "", **fields):
+    if handle is None:
+        return
+    wall = timer() - handle["start"]
+    cpu, child_cpu = cpu_seconds()
+    write_span(dict({"run": os.environ.get(RUN_ENV), "span": handle["span"], "parent": handle["parent"], "pid": os.getpid(),
+                     "start": round(handle["start_time"], 3), "wall_s": round(wall, 4), "cpu_s": round(cpu - handle["cpu"][0], 4),
+                     "child_cpu_s": round(child_cpu - handle["cpu"][1], 4), "rss_start_mb": handle["rss"], "rss_end_mb": memory_mb(),
+                     "process_peak_rss_mb": peak_memory_mb(), "max_child_rss_mb": peak_memory_mb(children=True)},
+                    **handle["fields"], **fields, error=error))
+
+@contextmanager
+def span(name: str, profile: bool = False, **fields):
+    # Time a block: with span("merge file", file=f) as record: ... record["rows"] = n
+    # the fields and what the block adds to record are written with the timings when the block ends
+    record = dict(fields)
+    handle = begin_span(name)
+    if handle is None:
+        yield record
+        return
+    token = current_span.set(name)
+    profiling = start_profile(name) if profile else None
+    error = ""
+    try:
+        yield record
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if profiling is not None:
+            stop_profile(profiling)
+        current_span.reset(token)
+        end_span(handle, error, **record)
+
+def read_trace(trace_file: Path, run: str = None):
+    # Spans of one run (default: the last run) of a trace file
+    records = []
+    with open(trace_file, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    run = run or (records[-1]["run"] if records else None)
+    return [r for r in records if r.get("run") == run]
+
+def number(value, digits: str):
+    return "-" if value is None else format(value, digits)
+
+def trace_summary(trace_file: Path = None, run: str = None):
+    # Table of the spans of a run by name: count, wall / CPU / child CPU time, largest RSS at the start or end of a span
+    # (not a peak during the spans), rows and MB read / written
+    trace_file = trace_file or os.environ.get(TRACE_ENV)
+    if trace_file is None or not os.path.exists(trace_file):
+        return []
+    records = read_trace(trace_file, run or os.environ.get(RUN_ENV))
+    rows = {}
+    for r in records:
+        row = rows.setdefault(r["span"], {"span": r["span"], "count": 0, "wall_s": 0.0, "cpu_s": 0.0, "child_cpu_s": 0.0, "rss_mb": None,
+                                          "rows": 0, "bytes_read": 0, "bytes_written": 0, "errors": 0})
+        row["count"] += 1
+        for key in ["wall_s", "cpu_s", "child_cpu_s"]:
+            row[key] += r[key]
+        for key in ["rows", "bytes_read", "bytes_written"]:
+            row[key] += r.get(key) or 0
+        for key in ["rss_start_mb", "rss_end_mb"]:
+            if r.get(key) is not None:
+                row["rss_mb"] = max(row["rss_mb"] or 0, r[key])
+        row["errors"] += 1 if r.get("error") else 0
+    print("Trace summary of run " + str(records[0]["run"] if records else None) + " (" + str(trace_file) + "):")
+    print("  " + "span".ljust(32) + "count".rjust(7) + "wall s".rjust(10) + "cpu s".rjust(10) + "child s".rjust(10) + "RSS MB".rjust(9)
+          + "rows".rjust(12) + "read MB".rjust(10) + "write MB".rjust(10))
+    for row in rows.values():
+        print("  " + row["span"][:32].ljust(32) + str(row["count"]).rjust(7) + number(row["wall_s"], ".2f").rjust(10) + number(row["cpu_s"], ".2f").rjust(10)
+              + number(row["child_cpu_s"], ".2f").rjust(10) + number(row["rss_mb"], ".0f").rjust(9) + str(row["rows"]).rjust(12)
+              + number(row["bytes_read"] / (1024 * 1024), ".1f").rjust(10) + number(row["bytes_written"] / (1024 * 1024), ".1f").rjust(10)
+              + (" (" + str(row["errors"]) + " failed)" if row["errors"] else ""))
+    return list(rows.values())
+
+def main():
+    # Summary of a trace file: python -m lib.trace <trace file> [run]
+    if len(sys.argv) < 2:
+        print("usage: python -m lib.trace <trace file> [run]")
+        return
+    trace_summary(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
 from pathlib import Path
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import sys
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import gc
+from lib.genotype import ALLELES, GENOTYPE_CALLS, encode_call_table, read_matrix_header, read_matrix_chunks, matrix_data_ranges, reduce_schema, reduce_table, infer_alleles, codes_to_2bit, pack_2bit
+from lib.store import GenotypeStore
+from lib.trace import span, file_size
 
 def split_transform_row(row):
     # Mapping dictionary
@@ -16,33 +25,161 @@ def split_transform_row(row):
     # Map each element in the row using the dictionary, make sure to convert to string if necessary
     return row.apply(lambda x: mapping_dict.get(str(x).split('|')[0]))
 
-def make_reduce_file(matrix_folder: Path, skip_rows: int, chunk_size: int, reduce_folder: Path):
+def reduce_matrix_part(matrix_file: Path, skip_rows: int, chunk_size: int, output_file: Path, encoder: str = "vectorized", packed: bool = False, byte_range: tuple = None, row_group_size: int = 100000):
+    # Encode one matrix file (or a byte range of its SNP lines) to a reduced parquet file,
+    # every encoded chunk is written straight out as row groups of at most row_group_size SNPs
+    start_file = timer()
+    names = read_matrix_header(matrix_file, skip_rows)
+    schema = reduce_schema(names[1:], packed, (len(names) + 2) // 4)
+    chunk_num = 1
+    snps = 0
+    total_calls = 0
+    total_seconds = 0.0
+    with span("reduce file", profile=True, file=Path(matrix_file).name, columns=len(names) - 1,
+              bytes_read=byte_range[1] - byte_range[0] if byte_range else file_size(matrix_file)) as record:
+        writer = pq.ParquetWriter(output_file, schema, use_dictionary=['SNPs', 'A1', 'A2'] if packed else True)
+        try:
+            for chunk in read_matrix_chunks(matrix_file, skip_rows, chunk_size, byte_range):
+                print("Working on chunk: " + str(chunk_num) + " of " + str(Path(matrix_file).name) + ". Applying transformer ...")
+                with span("reduce chunk", chunk=chunk_num, rows=chunk.num_rows, columns=chunk.num_columns - 1, bytes_read=chunk.nbytes):
+                    start = timer()
+                    if encoder == "legacy":
+                        codes = chunk.to_pandas().iloc[:, 1:].apply(split_transform_row, axis=1).fillna(0).to_numpy(dtype=np.uint8)
+                    else:
+                        codes = encode_call_table(chunk)
+                    seconds = timer() - start
+                    calls = codes.size
+                    total_calls += calls
+                    total_seconds += seconds
+                    print("Encoded " + str(calls) + " calls in " + format(seconds, ".2f") + " s (" + format(calls / max(seconds, 1e-9), ",.0f") + " calls/s).")
+                    writer.write_table(reduce_table(chunk.column(0), codes, names[1:], packed), row_group_size=row_group_size)
+                snps += chunk.num_rows
+                chunk_num += 1
+                del chunk, codes
+                gc.collect()
+        finally:
+            writer.close()
+        record.update(rows=snps, bytes_written=file_size(output_file))
+    return {"snps": snps, "calls": total_calls, "encode_seconds": total_seconds, "seconds": timer() - start_file}
+
+def run_reduce_job(job: dict):
+    # Wrapper for the process pool, errors are returned instead of raised
+    try:
+        return reduce_matrix_part(**job)
+    except Exception as e:
+        return {"error": repr(e)}
+
+def concat_reduce_parts(part_files: list, output_file: Path):
+    # Copy the row groups of reduced part files (same samples) into one file
+    writer = None
+    for part_file in part_files:
+        part = pq.ParquetFile(part_file)
+        if writer is None:
+            writer = pq.ParquetWriter(output_file, part.schema_arrow)
+        for rg in range(part.num_row_groups):
+            writer.write_table(part.read_row_group(rg))
+    writer.close()
+
+def make_reduce_file(matrix_folder: Path, skip_rows: int, chunk_size: int, reduce_folder: Path, encoder: str = "vectorized", packed: bool = False, workers: int = 1, split_mb: int = 0, row_group_size: int = 100000,
+                     append: bool = False):
+    # append = only encode matrix files without a reduced file newer than them (eg a new genotyping batch)
     temp_files = [str(f) for f in Path(matrix_folder).iterdir() if f.match("*.txt")]
     temp_files.sort()
     print("There are " + str(len(temp_files)) + " temp files in the matrix folder.")
+    if append:
+        reduced = [str(reduce_folder) + r'/' + str(Path(f).stem) + r".parquet" for f in temp_files]
+        new_files = [f for f, r in zip(temp_files, reduced) if not os.path.exists(r) or os.path.getmtime(r) < os.path.getmtime(f)]
+        print("Append: " + str(len(temp_files) - len(new_files)) + " files are already reduced, " + str(len(new_files)) + " files to encode.")
+        temp_files = new_files
 
+    # Jobs of every file, large files are split to byte ranges if split_mb is given.
+    # Outputs are written as <stem>.parquet.tmp (or <stem>.partNNN.parquet.tmp) and renamed when done
+    jobs = []
+    file_parts = []
+    for i in range(len(temp_files)):
+        stem = str(Path(temp_files[i]).stem)
+        ranges = [None]
+        if split_mb > 0:
+            ranges = matrix_data_ranges(temp_files[i], skip_rows, split_mb * 1024 * 1024)
+        parts = []
+        for p in range(len(ranges)):
+            if len(ranges) == 1:
+                part_file = str(reduce_folder) + r'/' + stem + r".parquet.tmp"
+            else:
+                part_file = str(reduce_folder) + r'/' + stem + r".part" + str(p + 1).zfill(len(str(len(ranges)))) + r".parquet.tmp"
+            parts.append(len(jobs))
+            jobs.append({"matrix_file": temp_files[i], "skip_rows": skip_rows, "chunk_size": chunk_size, "output_file": part_file,
+                         "encoder": encoder, "packed": packed, "byte_range": ranges[p], "row_group_size": row_group_size})
+        file_parts.append(parts)
+    if split_mb > 0:
+        print("Split into " + str(len(jobs)) + " jobs of about " + str(split_mb) + " MB.")
+
+    results = [None] * len(jobs)
+    if workers > 1 and len(jobs) > 1:
+        print("Encoding with " + str(workers) + " workers...")
+        pool_args = {"max_workers": workers}
+        if sys.version_info >= (3, 11):
+            # restart workers after every job so memory of each worker stays bounded
+            pool_args["max_tasks_per_child"] = 1
+        with ProcessPoolExecutor(**pool_args) as executor:
+            futures = {executor.submit(run_reduce_job, jobs[j]): j for j in range(len(jobs))}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = {"error": repr(e)}
+    else:
+        for j in range(len(jobs)):
+            results[j] = run_reduce_job(jobs[j])
+
+    # Rename finished files, report timing and errors per file
+    report = []
     for i in range(len(temp_files)):
         post_filename = str(Path(temp_files[i]).stem) + r".parquet"
-        post_map_chunks = []
-        chunk_num = 1
-        for chunk in pd.read_csv(temp_files[i], skiprows=skip_rows, sep="\t", chunksize=chunk_size):
-            print("Working on chunk: " + str(chunk_num) + ". Applying transformer ...")
-            chunk.iloc[:, 1:] = chunk.iloc[:, 1:].apply(split_transform_row, axis=1)
-            post_map_chunks.append(chunk)
-            chunk_num += 1
-            del chunk
-            gc.collect()
+        part_files = [jobs[j]["output_file"] for j in file_parts[i]]
+        part_results = [results[j] for j in file_parts[i]]
+        errors = [r["error"] for r in part_results if "error" in r]
+        row = {"file": str(Path(temp_files[i]).name), "snps": 0, "seconds": 0.0, "calls_per_second": 0.0, "error": ""}
+        if errors:
+            row["error"] = "; ".join(errors)
+        else:
+            try:
+                if len(part_files) == 1:
+                    os.replace(part_files[0], str(reduce_folder) + r'/' + post_filename)
+                else:
+                    concat_reduce_parts(part_files, str(reduce_folder) + r'/' + post_filename + r".tmp")
+                    os.replace(str(reduce_folder) + r'/' + post_filename + r".tmp", str(reduce_folder) + r'/' + post_filename)
+                print("Exporting reduced file: " + str(post_filename))
+                calls = sum(r["calls"] for r in part_results)
+                encode_seconds = sum(r["encode_seconds"] for r in part_results)
+                row["snps"] = sum(r["snps"] for r in part_results)
+                row["seconds"] = sum(r["seconds"] for r in part_results)
+                row["calls_per_second"] = calls / max(encode_seconds, 1e-9)
+            except Exception as e:
+                row["error"] = repr(e)
+        for part_file in part_files:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+        report.append(row)
 
-        df = pd.concat(post_map_chunks, axis=0)
-        df.rename(columns={'Unnamed: 0': 'SNPs'}, inplace=True)
-        print("Exporting reduced file: " + str(post_filename))
-        df.to_parquet(str(reduce_folder) + r'/' + post_filename, index=False)
-        del post_map_chunks, df
-        gc.collect()
+    print("Encoder (" + encoder + ") summary:")
+    for row in report:
+        if row["error"]:
+            print("  " + row["file"] + ": FAILED (" + row["error"] + ")")
+        else:
+            print("  " + row["file"] + ": " + str(row["snps"]) + " SNPs in " + format(row["seconds"], ".2f") + " s (" + format(row["calls_per_second"], ",.0f") + " calls/s)")
+    failed = [row["file"] for row in report if row["error"]]
+    if failed:
+        print(str(len(failed)) + " of " + str(len(report)) + " files failed: " + ", ".join(failed))
+    gc.collect()
+    return report
 
-def make_map_file(patient_snp_map: Path, map_file: Path):
+def make_map_file(patient_snp_map: Path, map_file: Path, snp_keep=None):
+    # snp_keep = QC mask of the SNPs (rows of the file), default: all SNPs
     print("Loading file...")
-    map_df = pd.read_csv(patient_snp_map, usecols=['SNP_id', 'chr', 'BP'], dtype={'SNP_id': str, 'chr': str, 'BP': str})
+    map_df = pd.read_csv(patient_snp_map, usecols=['SNP_id', 'chr', 'BP'], dtype={'SNP_id': str, 'chr': str, 'BP': str})[['SNP_id', 'chr', 'BP']]
+    if snp_keep is not None:
+        map_df = map_df[snp_keep]
 
     # remove chr or BP == '0'
     print("Removing chr or BP == 0")
@@ -60,85 +197,164 @@ def make_map_file(patient_snp_map: Path, map_file: Path):
     del map_df
     gc.collect()
 
-# the mapping function
-def reverse_transform_row(row):
-    # Mapping dictionary
-    mapping_dict = {
-        '0': '0 0',
-        '1': 'A A', '2': 'A T', '3': 'A C', '4': 'A G',
-        '5': 'T A', '6': 'T T', '7': 'T C', '8': 'T G',
-        '9': 'C A', '10': 'C T', '11': 'C C', '12': 'C G',
-        '13': 'G A', '14': 'G T', '15': 'G C', '16': 'G G',
-        '17': 'I I', '18': 'I D', '19': 'D I', '20': 'D D',
-        '21': '0 0'
-        }
-    # Map each element in the row using the dictionary, make sure to convert to string if necessary
-    return ' '.join(row.apply(lambda x: mapping_dict.get(str(int(x)))))
+def make_ped_table():
+    # code -> PED genotype bytes with the trailing separator, eg 4 -> b'A G ', 0 and 21 (and unknown codes) -> b'0 0 '
+    ped_table = np.frombuffer(b'0 0 ' * 256, dtype=np.uint8).reshape(256, 4).copy()
+    for code, call in enumerate(GENOTYPE_CALLS):
+        if code not in (0, 21):
+            ped_table[code] = np.frombuffer((call[0] + ' ' + call[1] + ' ').encode(), dtype=np.uint8)
+    return ped_table
 
-def make_ped_file(patient_snp_map: Path, dataseta_ID_file: Path, chunksize: int, ped_file: Path):
-    print("Loading file...")
-    post_T_chunks = []
-    chunk_num = 1
-    for chunk in pd.read_csv(patient_snp_map, chunksize = chunksize, dtype={'SNP_id': str, 'chr': str, 'BP': str}):
-        print("Working on chunk: " + str(chunk_num) + ". Removing chr or BP == 0 ...")
-        chunk = chunk.query('chr != "0" & BP != "0"')
-        print("Transposing columns and rows...")
-        chunk_T = chunk.iloc[:, 3:].transpose()
-        del chunk
-        print("Applying transformer...")
-        chunk_T.reset_index(inplace=True)
-        chunk_T['Combined'] = chunk_T.iloc[:, 1:].apply(reverse_transform_row, axis=1)
-        chunk_T = chunk_T[['index', 'Combined']] # Remain necessary columns
-        chunk_T.columns = ['ID', 'Genotype']  # Rename for clarity
-        post_T_chunks.append(chunk_T['Genotype'])
-        chunk_num = chunk_num + 1
-        gc.collect()
-
-    # Concatenating all the transposed chunks together
-    print("concate chunks...")
-    df_transposed = pd.concat(post_T_chunks, axis=1)
-    del post_T_chunks
-    # Reset the index of the transposed DataFrame
-    df_transposed.reset_index(inplace=True, drop=True)
-
-    # insert ID from last chunk_T
-    df_transposed.insert(0, "ID", chunk_T['ID'])
-    del chunk_T
-    gc.collect()
+PED_TABLE = make_ped_table()
 
-    # Combine transposed data into 'Combined'
-    df_transposed['Combined'] = df_transposed.iloc[:, 1:].apply(lambda row: ' '.join(row.astype(str)), axis=1)
-    df_transposed = df_transposed[['ID', 'Combined']] # Remain necessary columns
-    df_transposed.columns = ['ID', 'Genotype'] # Rename for clarity
+def make_ped_file(store_folder: Path, chr: str, chr_map_file: Path, dataseta_ID_file: Path, ped_file: Path, snp_keep=None, sample_keep: list = None):
+    # snp_keep / sample_keep = QC mask of the SNPs (rows of the chr map) / IDs of the samples to write, default: all
+    print("Loading file...")
+    store = GenotypeStore(store_folder)
+    start, stop = store.chr_range(chr)
+    snp_map_df = pd.read_csv(chr_map_file, usecols=['chr', 'BP'], dtype=str)
+    # remove chr or BP == '0'
+    keep = ((snp_map_df['chr'] != "0") & (snp_map_df['BP'] != "0")).to_numpy()
+    if snp_keep is not None:
+        keep &= snp_keep
+    positions = store.sample_positions(sample_keep)
+    ids = [store.samples[i] for i in positions]
+    snps = int(keep.sum())
 
-    print("Adding S column...")
+    # *Labels: FID ID F M S P
+    print("Adding FID, F, M, S, P columns...")
     pt_df_raw = pd.read_csv(dataseta_ID_file) # *Labels: ID S
-    df_transposed = df_transposed.merge(pt_df_raw, how='left', on='ID')
+    id_df = pd.DataFrame({'ID': ids}).merge(pt_df_raw, how='left', on='ID')
     del pt_df_raw
-    gc.collect()
-
-    # *Labels: FID ID F M S P Genotype
-    print("Adding FID, F, M, P columns...")
-    df_transposed.loc[:, 'FID'] = 0
-    df_transposed.loc[:, 'F'] = 0
-    df_transposed.loc[:, 'M'] = 0
-    df_transposed.loc[:, 'P'] = -9 # default = missing (-9)
-        
-    print("Re-arranging...")
-    df_transposed = df_transposed[['FID', 'ID', 'F', 'M', 'S', 'P', 'Genotype']]
+    id_df.loc[:, 'FID'] = 0
+    id_df.loc[:, 'F'] = 0
+    id_df.loc[:, 'M'] = 0
+    id_df.loc[:, 'P'] = -9 # default = missing (-9)
+    id_df = id_df[['FID', 'ID', 'F', 'M', 'S', 'P']]
+    prefixes = id_df.to_csv(sep="\t", index=False, header=False, lineterminator="\n").split("\n")
 
+    # Read the codes of a block of samples at a time from the store (SNPs x block, 1 byte per call),
+    # render their genotype bytes through PED_TABLE and stream every sample line
     print('Exporting file: ' + str(ped_file))
-    df_transposed.to_csv(ped_file, sep="\t", index=False, header=False)
-    del df_transposed
+    line_end = os.linesep.encode()
+    block = max(1, (1 << 26) // max(4 * snps, 1))
+    with open(ped_file, 'wb') as f:
+        for first in range(0, len(id_df), block):
+            with span("ped block", chr=str(chr), rows=snps, columns=len(positions[first:first + block])) as record:
+                written = f.tell()
+                codes = store.read(slice(start, stop), positions[first:first + block])[keep]
+                rendered = PED_TABLE[codes.T]
+                rendered = rendered.reshape(rendered.shape[0], -1)
+                for i in range(rendered.shape[0]):
+                    f.write((prefixes[first + i] + "\t").encode())
+                    f.write(rendered[i, :-1].tobytes())
+                    f.write(line_end)
+                record.update(bytes_read=(stop - start) * rendered.shape[0], bytes_written=f.tell() - written)
+            del codes, rendered
+    print("Found " + str(snps) + " SNPs of " + str(len(ids)) + " cases!")
+    del id_df, store
     gc.collect()
 
-def extract_raw_to_csv(raw_file: Path, id_name: str, pheno_name:str, output_file: Path):
-    raw_df = pd.read_csv(raw_file, sep=" ")
-    raw_df.drop(columns=['FID', 'SEX', 'PAT', 'MAT'], inplace=True)
-    raw_df.rename(columns={'IID': id_name, 'PHENOTYPE': pheno_name}, inplace=True)
-    raw_df = raw_df[raw_df[pheno_name] != -9]
-    # Convert columns from the 3rd column to the end (zero-indexed, so 2 means the 3rd column)
-    # raw_df.iloc[:, 2:] = raw_df.iloc[:, 2:].astype("Int64")
-    raw_df.to_csv(output_file, index=False)
-    del raw_df
-    gc.collect()
+# PLINK 1.9 chromosome codes in .bim files
+PLINK_CHR_CODES = {'X': '23', 'Y': '24', 'XY': '25', 'MT': '26'}
+
+def make_fam_file(samples: list, dataseta_ID_file: Path, ID_phenotype_file: Path, fam_file: Path):
+    # *Labels: FID ID F M S P (sex 0 if unknown, phenotype -9 if missing)
+    pt_df = pd.read_csv(dataseta_ID_file, dtype={'ID': str}) # *Labels: ID S
+    sex = dict(zip(pt_df['ID'], pt_df['S']))
+    pheno = {}
+    if ID_phenotype_file is not None:
+        pheno_df = pd.read_csv(ID_phenotype_file, sep="\t", header=None, names=['FID', 'ID', 'P'], dtype=str) # *Labels: FID ID P
+        pheno = dict(zip(pheno_df['ID'], pheno_df['P']))
+    with open(fam_file, 'w', newline='\n') as f:
+        for sample in samples:
+            s = sex.get(sample)
+            s = str(int(s)) if s in (1, 2) else '0'
+            f.write('0 ' + str(sample) + ' 0 0 ' + s + ' ' + str(pheno.get(sample, '-9')) + '\n')
+
+def make_bed_file(store_folder: Path, chr: str, chr_map_file: Path, dataseta_ID_file: Path, ID_phenotype_file: Path, chunksize: int, bed_prefix: Path,
+                  snp_keep=None, sample_keep: list = None):
+    # Write PLINK binary files (SNP-major .bed, .bim, .fam) straight from the genotype codes of the chr in the store,
+    # alleles of each SNP are inferred from the codes (A1 = minor allele, A2 = major allele),
+    # snp_keep / sample_keep = QC mask of the SNPs (rows of the chr map) / IDs of the samples to write, default: all
+    snp_map_df = pd.read_csv(chr_map_file, usecols=['SNP_id', 'chr', 'BP'], dtype={'SNP_id': str, 'chr': str, 'BP': str})
+    offset = 0
+    snps = 0
+    allele_names = np.array(ALLELES, dtype=object)
+    with open(str(bed_prefix) + r".bed", 'wb') as bed, open(str(bed_prefix) + r".bim", 'w', newline='\n') as bim:
+        # magic number + SNP-major mode
+        bed.write(bytes([0x6c, 0x1b, 0x01]))
+        chunk_num = 1
+        store = GenotypeStore(store_folder)
+        samples = [store.samples[i] for i in store.sample_positions(sample_keep)]
+        for chunk_samples, snp_ids, codes in store.iter_chr(chr, chunksize, sample_keep):
+            # the .fam file is written from samples, every chunk must hold the same samples in the same order
+            assert chunk_samples == samples
+            print("Working on chunk: " + str(chunk_num) + ". Packing genotypes...")
+            with span("bed chunk", chr=str(chr), chunk=chunk_num, columns=len(samples), bytes_read=codes.nbytes) as record:
+                written = bed.tell()
+                chunk_map = snp_map_df.iloc[offset:offset + len(snp_ids)]
+                offset += len(snp_ids)
+                # remove chr or BP == 0
+                keep = ((chunk_map['chr'] != "0") & (chunk_map['BP'] != "0")).to_numpy()
+                if snp_keep is not None:
+                    keep &= snp_keep[offset - len(snp_ids):offset]
+                codes = codes[keep]
+                chunk_map = chunk_map[keep]
+                a1, a2 = infer_alleles(codes)
+                bed.write(np.ascontiguousarray(pack_2bit(codes_to_2bit(codes, a1, a2))).tobytes())
+                bim_df = pd.DataFrame({
+                    'chr': chunk_map['chr'].replace(PLINK_CHR_CODES).to_numpy(),
+                    'SNP': chunk_map['SNP_id'].to_numpy(),
+                    'cM': 0,
+                    'BP': chunk_map['BP'].to_numpy(),
+                    'A1': allele_names[a1],
+                    'A2': allele_names[a2]})
+                bim_df.to_csv(bim, sep="\t", index=False, header=False)
+                record.update(rows=len(bim_df), bytes_written=bed.tell() - written)
+            snps += len(bim_df)
+            chunk_num += 1
+            del codes, bim_df
+            gc.collect()
+    make_fam_file(samples, dataseta_ID_file, ID_phenotype_file, str(bed_prefix) + r".fam")
+    print("Exported " + str(snps) + " SNPs of " + str(len(samples)) + " cases to: " + str(bed_prefix) + r".bed")
+
+# PLINK genotype values (hom A1, missing, het, hom A2) -> count of A1, as plink --recodeA
+A1_COUNTS = np.array([2, np.nan, 1, 0])
+
+def extract_snp_file(store_folder: Path, bed_prefix: Path, ID_phenotype_file: Path, snps: list, id_name: str, pheno_name: str, output_file: Path):
+    # Genotypes of some SNPs as plink --bfile <bed_prefix> --pheno --recodeA include-alt, read from the genotype store:
+    # samples of the .fam with a phenotype, SNPs of the .bim with their A1/A2, one column <SNP>_<A1>(/<A2>) of A1 counts per SNP
+    # (empty if missing); returns the number of SNPs written
+    bim_df = pd.read_csv(str(bed_prefix) + r".bim", sep=r"\s+", header=None, usecols=[1, 4, 5], names=['SNP', 'A1', 'A2'], dtype=str)
+    bim_df = bim_df.drop_duplicates(subset='SNP').set_index('SNP')
+    snps = list(dict.fromkeys(str(snp) for snp in snps))
+    if not all(snp in bim_df.index for snp in snps):
+        print("SNPs not in " + str(bed_prefix) + r".bim: " + ", ".join(snp for snp in snps if snp not in bim_df.index))
+    snps = [snp for snp in snps if snp in bim_df.index]
+    fam_df = pd.read_csv(str(bed_prefix) + r".fam", sep=r"\s+", header=None, usecols=[1], names=['ID'], dtype=str)
+    pheno_df = pd.read_csv(ID_phenotype_file, sep="\t", header=None, names=['FID', 'ID', 'P'], dtype=str)
+    pheno = fam_df['ID'].map(dict(zip(pheno_df['ID'], pheno_df['P'])))
+    # samples without a phenotype (-9) are left out
+    value = pd.to_numeric(pheno, errors='coerce')
+    keep = (value.notna() & (value != -9)).to_numpy()
+    ids = fam_df['ID'][keep].tolist()
+    store = GenotypeStore(store_folder)
+    rows = store.find_snps(snps)
+    found = rows >= 0
+    if not found.all():
+        print(str(len(snps) - found.sum()) + " SNPs not in the genotype store: " + ", ".join(snp for snp, f in zip(snps, found) if not f))
+    snps = [snp for snp, f in zip(snps, found) if f]
+    positions = store.sample_positions(ids)
+    order = pd.Index([store.samples[i] for i in positions]).get_indexer(ids)
+    codes = store.read(rows[found], positions[order])
+    allele_index = {allele: i for i, allele in enumerate(ALLELES)}
+    a1 = np.array([allele_index.get(allele, 0) for allele in bim_df.loc[snps, 'A1']], dtype=np.uint8)
+    a2 = np.array([allele_index.get(allele, 0) for allele in bim_df.loc[snps, 'A2']], dtype=np.uint8)
+    columns = [snp + "_" + bim_df.at[snp, 'A1'] + "(/" + bim_df.at[snp, 'A2'] + ")" for snp in snps]
+    extract_df = pd.DataFrame(A1_COUNTS[codes_to_2bit(codes, a1, a2)].T, columns=columns).astype("Int8")
+    extract_df.insert(0, id_name, ids)
+    extract_df.insert(1, pheno_name, pheno[keep].to_numpy())
+    extract_df.to_csv(output_file, index=False)
+    print("Extracted " + str(len(snps)) + " SNPs of " + str(len(ids)) + " cases to: " + str(output_file))
+    return len(snps)